@@ -0,0 +1,154 @@
+#!/usr/bin/env python3
+"""
+Stored message memory benchmark.
+
+Writes a chat log of N messages (default 1M) spread over the four rooms
+and a few hundred users, then compares the dicts the store used to hold
+with the MessageRecords it holds now:
+
+- bytes per message retained after loading the log (tracemalloc);
+- time to load the log and to save it again;
+- time to encode a history frame of HISTORY_LIMIT messages. For records
+  that is with messages loaded from the log (encoded on the spot) and
+  with messages that arrived while running (encoded once when stored).
+
+    python benchmarks/memory.py [--messages N] [--users U]
+"""
+
+import argparse
+import gc
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import settings
+from server.record import encode_frame
+from server.store import ChatStore
+
+ROOMS = ['general', 'random', 'tech', 'gaming']
+WORDS = ['hey', 'anyone', 'seen', 'the', 'new', 'build', 'lunch', 'meeting', 'is', 'at', 'noon',
+         'lol', 'thanks', 'ok', 'deploy', 'tonight', 'game', 'later', 'what', 'about', 'you']
+
+
+def write_log(path, count, users):
+    """A chat log as the server writes it, with IDs and timestamps"""
+    rng = random.Random(1)
+    names = [f'user{i}' for i in range(users)]
+    ts = int(time.time() * 1000) - count * 1000
+    history = {room: [] for room in ROOMS}
+    for i in range(count):
+        ts += rng.randrange(2000)
+        room = history[ROOMS[i % len(ROOMS)]]
+        room.append({
+            'username': rng.choice(names),
+            'content': ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 12))),
+            'id': len(room),
+            'ts': ts,
+            'timestamp': time.strftime('%H:%M:%S', time.localtime(ts // 1000))
+        })
+    with open(path, 'w') as f:
+        json.dump(history, f)
+
+
+def messages_like(store, count):
+    """Copies of the newest messages of 'general', as new message dicts"""
+    return [{'username': message.username, 'content': message.content}
+            for message in store.recent('general', count)]
+
+
+def measure(load):
+    """(retained bytes, seconds, result) of load()
+
+    Timed on its own first, since tracing every allocation slows it down.
+    """
+    gc.collect()
+    started = time.perf_counter()
+    load()
+    elapsed = time.perf_counter() - started
+    gc.collect()
+    tracemalloc.start()
+    result = load()
+    retained, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return retained, elapsed, result
+
+
+def timed(func, repeat):
+    started = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - started) / repeat
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--messages', type=int, default=1_000_000)
+    parser.add_argument('--users', type=int, default=300)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+    log_path = os.path.join(data_dir, 'chat_logs.json')
+    write_log(log_path, args.messages, args.users)
+    print(f"{args.messages} messages from {args.users} users, log {os.path.getsize(log_path) / 1024 ** 2:.0f} MB")
+
+    def load_dicts():
+        # What ChatStore kept before: the parsed dicts themselves, checked
+        # for IDs and timestamps the way its load() did
+        with open(log_path) as f:
+            history = json.load(f)
+        for messages in history.values():
+            next_id = last_ts = 0
+            for message in messages:
+                if not isinstance(message.get('id'), int) or message['id'] < next_id:
+                    message['id'] = next_id
+                if not isinstance(message.get('ts'), int) or message['ts'] < last_ts:
+                    message['ts'] = last_ts
+                next_id = message['id'] + 1
+                last_ts = message['ts']
+        return history
+
+    def load_records():
+        return ChatStore(log_path, ROOMS, json_window=settings.HISTORY_LIMIT)
+
+    dict_bytes, dict_load, history = measure(load_dicts)
+    frame = history['general'][-settings.HISTORY_LIMIT:]
+    dict_frame = timed(lambda: json.dumps({'type': 'history', 'room': 'general', 'messages': frame}), 200)
+    save_path = os.path.join(data_dir, 'saved.json')
+
+    def save_dicts():
+        with open(save_path, 'w') as f:
+            json.dump(history, f, indent=2)
+    dict_save = timed(save_dicts, 1)
+    del history, frame
+
+    record_bytes, record_load, store = measure(load_records)
+
+    def record_frame():
+        messages = store.recent('general', settings.HISTORY_LIMIT)
+        return timed(lambda: encode_frame({'type': 'history', 'room': 'general',
+                                           'messages': store.encode('general', messages)}), 200)
+    cold_frame = record_frame()
+    for message in messages_like(store, settings.HISTORY_LIMIT):
+        store.append('general', message)
+    warm_frame = record_frame()
+    store.path = save_path
+    record_save = timed(store.save, 1)
+
+    print(f"{'':<14} {'bytes/msg':>10} {'load s':>8} {'save s':>8} {'frame us':>9}")
+    for label, retained, load, save, frame_time in (
+            ('dicts', dict_bytes, dict_load, dict_save, dict_frame),
+            ('records', record_bytes, record_load, record_save, cold_frame)):
+        print(f"{label:<14} {retained / args.messages:>10.0f} {load:>8.2f} {save:>8.2f} {frame_time * 1e6:>9.0f}")
+    print(f"{'records, new':<14} {'':>10} {'':>8} {'':>8} {warm_frame * 1e6:>9.0f}")
+    print(f"records hold {record_bytes / dict_bytes:.0%} of the memory of dicts")
+
+
+if __name__ == "__main__":
+    main()
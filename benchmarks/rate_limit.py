@@ -0,0 +1,147 @@
+#!/usr/bin/env python3
+"""
+Rate limiting benchmark.
+
+Runs a local ChatServer, has several well-behaved clients chat at a steady
+pace in one room and measures how many of their messages an observer
+receives, first alone and then while an abusive client floods the same
+room and keeps starting uploads.
+
+    python benchmarks/rate_limit.py [--clients N] [--seconds S]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import settings
+
+
+def start_server():
+    with socket.socket() as probe:
+        probe.bind((settings.HOST, 0))
+        port = probe.getsockname()[1]
+
+    data_dir = tempfile.mkdtemp()
+    settings.PORT = port
+    settings.CHAT_LOG_PATH = os.path.join(data_dir, 'chat_logs.json')
+    settings.SEARCH_INDEX_DIR = os.path.join(data_dir, 'search_index')
+    settings.SNAPSHOT_PATH = os.path.join(data_dir, 'chat_snapshot.bin')
+    settings.ARCHIVE_DIR = os.path.join(data_dir, 'archive')
+    settings.HANDOFF_SOCKET_PATH = None
+    settings.ADMIN_SOCKET_PATH = None
+    settings.REPLICATION_SOCKET_PATH = None
+    settings.HISTORY_CACHE_DIR = None
+    settings.MAX_CONNECTIONS = 1000
+    settings.DEBUG = False
+
+    from server.server import ChatServer
+    server = ChatServer()
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.2)
+    return server
+
+
+def connect(username):
+    sock = socket.create_connection((settings.HOST, settings.PORT))
+    sock.sendall(json.dumps({'type': 'join', 'username': username, 'room': 'general'}).encode())
+    return sock
+
+
+def observe(sock, prefix, counter, stop):
+    """Count chat messages from well-behaved senders"""
+    from server.utils import MessageDecoder
+    decoder = MessageDecoder(settings.ENCODING)
+    sock.settimeout(0.2)
+    while not stop.is_set():
+        try:
+            data = sock.recv(settings.BUFFER_SIZE)
+        except socket.timeout:
+            continue
+        if not data:
+            break
+        for message in decoder.feed(data):
+            if message.get('type') == 'message' and message['username'].startswith(prefix):
+                counter[0] += 1
+
+
+def well_behaved(index, rate, seconds):
+    sock = connect(f'good{index}')
+    interval = 1 / rate
+    deadline = time.monotonic() + seconds
+    sent = 0
+    while time.monotonic() < deadline:
+        sock.sendall(json.dumps({'type': 'message', 'content': f'hello {sent}'}).encode())
+        sent += 1
+        time.sleep(interval)
+    time.sleep(0.5)
+    sock.close()
+    return sent
+
+
+def abuser(stop, sent):
+    frame = json.dumps({'type': 'message', 'content': 'spam' * 50}).encode()
+    upload = json.dumps({'type': 'large_message_start', 'total_size': 10 * 1024 * 1024}).encode()
+    while not stop.is_set():
+        try:
+            sock = connect('abuser')
+            while not stop.is_set():
+                sock.sendall(frame * 20 + upload)
+                sent[0] += 21
+        except OSError:
+            # Disconnected for ignoring the limits, come straight back
+            continue
+
+
+def run(clients, seconds, abusive):
+    stop = threading.Event()
+    received = [0]
+    observer = connect('observer')
+    observer_thread = threading.Thread(target=observe, args=(observer, 'good', received, stop), daemon=True)
+    observer_thread.start()
+
+    abuse_sent = [0]
+    if abusive:
+        threading.Thread(target=abuser, args=(stop, abuse_sent), daemon=True).start()
+
+    results = [0] * clients
+    def sender(i):
+        results[i] = well_behaved(i, settings.RATE_LIMIT_MESSAGES / 2, seconds)
+    threads = [threading.Thread(target=sender, args=(i,)) for i in range(clients)]
+    started = time.monotonic()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    elapsed = time.monotonic() - started
+    stop.set()
+    observer_thread.join()
+    observer.close()
+    return sum(results), received[0], elapsed, abuse_sent[0]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5)
+    args = parser.parse_args()
+
+    server = start_server()
+    for abusive in (False, True):
+        sent, received, elapsed, abuse = run(args.clients, args.seconds, abusive)
+        label = "with abuser   " if abusive else "without abuser"
+        print(f"{label}: {received}/{sent} good messages delivered "
+              f"({received / elapsed:.1f} msg/s), abuser frames sent: {abuse}")
+    print(f"server counters: {server.stats}")
+
+
+if __name__ == "__main__":
+    main()
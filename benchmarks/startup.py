@@ -0,0 +1,131 @@
+#!/usr/bin/env python3
+"""
+Client startup benchmark.
+
+Reports the import cost of the client entry point (python -X importtime)
+and, when a display is available, the time from launching a fresh
+interpreter to the first chat message rendered in ChatGUI.
+
+    python benchmarks/startup.py [--runs N]
+"""
+
+import argparse
+import json
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import settings
+
+# Runs in a child interpreter: open the chat window and exit on first render
+FIRST_RENDER_SCRIPT = """
+import sys, time
+sys.path.insert(0, {root!r})
+from config import settings
+settings.PORT = {port}
+settings.HISTORY_CACHE_DIR = {cache_dir!r}
+settings.DEBUG = False
+from client import gui
+
+original = gui.ChatGUI.display_message
+def display_message(self, message):
+    original(self, message)
+    self.root.update_idletasks()
+    print(time.time(), flush=True)
+    self.root.after(0, self.disconnect)
+gui.ChatGUI.display_message = display_message
+gui.open_chat_window('bench')
+"""
+
+
+def import_times(module):
+    """Return (total_us, [(cumulative_us, name), ...]) for importing module"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', f'import {module}'],
+        cwd=ROOT, capture_output=True, text=True
+    )
+    entries = []
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative_us, name = line[len('import time:'):].split('|')
+        # Nested imports are indented two spaces per level
+        entries.append((int(cumulative_us), name[1:].rstrip()))
+    total = sum(us for us, name in entries if not name.startswith(' '))
+    return total, sorted(((us, name.strip()) for us, name in entries), reverse=True)
+
+
+def start_server():
+    """Start a ChatServer on a free port with one message of history"""
+    with socket.socket() as probe:
+        probe.bind((settings.HOST, 0))
+        port = probe.getsockname()[1]
+
+    data_dir = tempfile.mkdtemp()
+    log_path = os.path.join(data_dir, 'chat_logs.json')
+    with open(log_path, 'w') as f:
+        json.dump({'general': [{'username': 'bench', 'content': 'hello', 'timestamp': '00:00:00'}],
+                   'random': [], 'tech': [], 'gaming': []}, f)
+
+    settings.PORT = port
+    settings.CHAT_LOG_PATH = log_path
+    settings.SEARCH_INDEX_DIR = os.path.join(data_dir, 'search_index')
+    settings.SNAPSHOT_PATH = os.path.join(data_dir, 'chat_snapshot.bin')
+    settings.ARCHIVE_DIR = os.path.join(data_dir, 'archive')
+    settings.HANDOFF_SOCKET_PATH = None
+    settings.ADMIN_SOCKET_PATH = None
+    settings.REPLICATION_SOCKET_PATH = None
+    settings.DEBUG = False
+
+    from server.server import ChatServer
+    server = ChatServer()
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.2)
+    return port
+
+
+def first_render_time(port):
+    started = time.time()
+    result = subprocess.run(
+        # A fresh history cache each run, not the user's own
+        [sys.executable, '-c', FIRST_RENDER_SCRIPT.format(root=ROOT, port=port, cache_dir=tempfile.mkdtemp())],
+        cwd=ROOT, capture_output=True, text=True, timeout=30
+    )
+    lines = result.stdout.split()
+    if result.returncode != 0 or not lines:
+        raise RuntimeError(result.stderr.strip() or "chat window exited without rendering")
+    return float(lines[0]) - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    args = parser.parse_args()
+
+    for module in ('main', 'client.gui'):
+        totals = [import_times(module)[0] for _ in range(args.runs)]
+        print(f"import {module}: best {min(totals) / 1000:.1f} ms over {args.runs} runs")
+    _, slowest = import_times('client.gui')
+    print("slowest imports for client.gui (cumulative):")
+    for us, name in slowest[:10]:
+        print(f"  {us / 1000:8.1f} ms  {name}")
+
+    if sys.platform != 'win32' and sys.platform != 'darwin' and not os.environ.get('DISPLAY'):
+        print("no display available, skipping first-render measurement")
+        return
+
+    port = start_server()
+    times = [first_render_time(port) for _ in range(args.runs)]
+    print(f"cold start to first rendered message: best {min(times) * 1000:.0f} ms, "
+          f"median {sorted(times)[len(times) // 2] * 1000:.0f} ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+TLS transport benchmark.
+
+Generates a throwaway self-signed certificate, runs a plain and a TLS
+ChatServer side by side and compares:
+
+- handshake: time to complete the TLS handshake, with a fresh session
+  and when resuming the previous connection's session;
+- reconnect: connect, handshake, send 'resume' and receive the history
+  reply, which is what a client does after its connection drops;
+- throughput: download rate of a large room history over each transport.
+
+    python benchmarks/tls.py [--connections N] [--history-mb M]
+"""
+
+import argparse
+import json
+import os
+import socket
+import statistics
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import settings
+
+
+def start_servers(data_dir):
+    from server.encryption import generate_self_signed
+    settings.TLS_CERT_FILE, settings.TLS_KEY_FILE = generate_self_signed(
+        os.path.join(data_dir, 'server.crt'), os.path.join(data_dir, 'server.key'))
+    settings.TLS_CA_FILE = settings.TLS_CERT_FILE
+    settings.HANDOFF_SOCKET_PATH = None
+    settings.ADMIN_SOCKET_PATH = None
+    settings.REPLICATION_SOCKET_PATH = None
+    settings.MAX_CONNECTIONS = 10000
+    settings.RATE_LIMIT_MESSAGES = settings.RATE_LIMIT_BURST = 10 ** 6
+    settings.DEBUG = False
+
+    from server.server import ChatServer
+    servers = {}
+    for tls in (False, True):
+        with socket.socket() as probe:
+            probe.bind((settings.HOST, 0))
+            settings.PORT = probe.getsockname()[1]
+        name = 'tls' if tls else 'plain'
+        settings.TLS_ENABLED = tls
+        settings.CHAT_LOG_PATH = os.path.join(data_dir, f'{name}_chat_logs.json')
+        settings.SEARCH_INDEX_DIR = os.path.join(data_dir, f'{name}_search_index')
+        settings.SNAPSHOT_PATH = os.path.join(data_dir, f'{name}_snapshot.bin')
+        settings.ARCHIVE_DIR = os.path.join(data_dir, f'{name}_archive')
+        server = ChatServer()
+        threading.Thread(target=server.start, daemon=True).start()
+        servers[name] = server
+    time.sleep(0.2)
+    return servers
+
+
+def fill_history(server, room, megabytes):
+    """Store enough messages that the room's history reply is this large"""
+    content = 'x' * (megabytes * 1024 * 1024 // settings.HISTORY_LIMIT)
+    for _ in range(settings.HISTORY_LIMIT):
+        server.store.append(room, {'username': 'bench', 'content': content})
+
+
+def connect(port, context=None, session=None):
+    """Return (socket, handshake seconds)"""
+    sock = socket.create_connection((settings.HOST, port))
+    sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    handshake = 0.0
+    if context is not None:
+        started = time.perf_counter()
+        sock = context.wrap_socket(sock, server_hostname=settings.TLS_SERVER_NAME, session=session)
+        handshake = time.perf_counter() - started
+    return sock, handshake
+
+
+def receive_history(sock):
+    """Read until the history reply has arrived; returns its size in bytes"""
+    from client.utils import MessageDecoder
+    decoder = MessageDecoder(settings.ENCODING)
+    received = 0
+    while True:
+        data = sock.recv(settings.BUFFER_SIZE)
+        if not data:
+            raise ConnectionError("Server closed the connection")
+        received += len(data)
+        for message in decoder.feed(data):
+            if message.get('type') == 'history':
+                return received
+
+
+def reconnect(port, room, context=None, session=None):
+    """One reconnect; returns (total seconds, handshake seconds, bytes, session, reused)"""
+    started = time.perf_counter()
+    sock, handshake = connect(port, context, session)
+    sock.sendall(json.dumps({'type': 'resume', 'username': 'bench', 'room': room, 'last_id': None}).encode())
+    size = receive_history(sock)
+    elapsed = time.perf_counter() - started
+    reused = bool(context and sock.session_reused)
+    # The TLS 1.3 ticket arrives after the handshake, so read it once data has flowed
+    session = sock.session if context is not None else None
+    sock.close()
+    return elapsed, handshake, size, session, reused
+
+
+def run(port, room, count, context=None, resume=False):
+    totals, handshakes, sizes, reused = [], [], [], 0
+    session = None
+    for _ in range(count):
+        elapsed, handshake, size, new_session, was_reused = reconnect(
+            port, room, context, session if resume else None)
+        totals.append(elapsed)
+        handshakes.append(handshake)
+        sizes.append(size)
+        reused += was_reused
+        if resume and new_session is not None:
+            session = new_session
+    return totals, handshakes, sizes, reused
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--connections', type=int, default=50)
+    parser.add_argument('--history-mb', type=int, default=4)
+    args = parser.parse_args()
+
+    data_dir = tempfile.mkdtemp()
+    servers = start_servers(data_dir)
+    for server in servers.values():
+        fill_history(server, 'tech', args.history_mb)
+
+    from client.utils import client_context
+    context = client_context(settings.TLS_CA_FILE)
+    ports = {name: server.port for name, server in servers.items()}
+
+    print(f"{args.connections} reconnects each; 'general' has an empty history, "
+          f"'tech' a {args.history_mb} MB one")
+    print(f"{'transport':<14} {'handshake ms':>13} {'reconnect ms':>13} {'resumed':>8} {'history MB/s':>13}")
+    for label, port, tls_context, resume in (
+            ('plain', ports['plain'], None, False),
+            ('tls full', ports['tls'], context, False),
+            ('tls resumed', ports['tls'], context, True)):
+        # Latency with a small reply, throughput with the large one
+        totals, handshakes, _, reused = run(port, 'general', args.connections, tls_context, resume)
+        big_totals, big_handshakes, sizes, _ = run(port, 'tech', max(3, args.connections // 10),
+                                                   tls_context, resume)
+        transfer = [total - handshake for total, handshake in zip(big_totals, big_handshakes)]
+        rate = statistics.median(size / seconds for size, seconds in zip(sizes, transfer)) / 1024 ** 2
+        print(f"{label:<14} {statistics.median(handshakes) * 1000:>13.2f} "
+              f"{statistics.median(totals) * 1000:>13.2f} {reused:>5}/{len(totals):<2} {rate:>13.1f}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,146 @@
+#!/usr/bin/env python3
+"""
+Typing indicator load benchmark.
+
+Runs a local ChatServer with a room full of ChatClients, first idle and
+then with most of them "typing" at a steady keystroke rate through
+ChatClient.notify_typing(). Reports how many typing frames clients send
+and receive, the bandwidth that costs per client, and the process CPU
+time compared with the idle room. The naive column is what one frame per
+keystroke per recipient would have cost.
+
+    python benchmarks/typing_load.py [--clients N] [--typists N] [--keys-per-second K] [--seconds S]
+"""
+
+import argparse
+import json
+import os
+import socket
+import sys
+import tempfile
+import threading
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from config import settings
+
+
+def start_server():
+    with socket.socket() as probe:
+        probe.bind((settings.HOST, 0))
+        port = probe.getsockname()[1]
+
+    data_dir = tempfile.mkdtemp()
+    settings.PORT = port
+    settings.CHAT_LOG_PATH = os.path.join(data_dir, 'chat_logs.json')
+    settings.SEARCH_INDEX_DIR = os.path.join(data_dir, 'search_index')
+    settings.SNAPSHOT_PATH = os.path.join(data_dir, 'chat_snapshot.bin')
+    settings.ARCHIVE_DIR = os.path.join(data_dir, 'archive')
+    settings.HANDOFF_SOCKET_PATH = None
+    settings.ADMIN_SOCKET_PATH = None
+    settings.REPLICATION_SOCKET_PATH = None
+    settings.HISTORY_CACHE_DIR = None
+    settings.MAX_CONNECTIONS = 10000
+    settings.DEBUG = False
+
+    from server.server import ChatServer
+    server = ChatServer()
+    threading.Thread(target=server.start, daemon=True).start()
+    time.sleep(0.2)
+    return server
+
+
+class Counter:
+    """Counts typing frames and their encoded size as a client receives them"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.frames = 0
+        self.bytes = 0
+        self.active = False
+
+    def __call__(self, message):
+        if message.get('type') == 'typing' and self.active:
+            size = len(json.dumps(message))
+            with self.lock:
+                self.frames += 1
+                self.bytes += size
+
+
+def measure(clients, counter, seconds, typists=(), keys_per_second=0):
+    """Run one phase; returns (keystrokes, frames sent, cpu seconds)"""
+    sent_before = sum(client.typing_frames for client in clients)
+    counter.active = True
+    cpu_start = time.process_time()
+    keystrokes = 0
+    deadline = time.monotonic() + seconds
+    interval = 1 / keys_per_second if keys_per_second else seconds
+    while time.monotonic() < deadline:
+        for client in typists:
+            client.notify_typing()
+            keystrokes += 1
+        time.sleep(interval)
+    cpu = time.process_time() - cpu_start
+    counter.active = False
+    for client in typists:
+        client.stop_typing()
+    sent = sum(client.typing_frames for client in clients) - sent_before
+    return keystrokes, sent, cpu
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--clients', type=int, default=300)
+    parser.add_argument('--typists', type=int, default=200)
+    parser.add_argument('--keys-per-second', type=float, default=5)
+    parser.add_argument('--seconds', type=float, default=10)
+    args = parser.parse_args()
+
+    start_server()
+    from client.client import ChatClient
+
+    counter = Counter()
+    clients = []
+    for i in range(args.clients):
+        client = ChatClient(f'user{i}')
+        client.set_message_callback(counter)
+        # Count typing frames on their way out
+        client.typing_frames = 0
+        send = client.send_message
+        def counting_send(message, client=client, send=send):
+            if message.get('type') == 'typing':
+                client.typing_frames += 1
+            return send(message)
+        client.send_message = counting_send
+        if not client.connect():
+            sys.exit("Could not connect to the benchmark server")
+        clients.append(client)
+    # Let the join announcements settle before measuring
+    time.sleep(2)
+
+    _, _, idle_cpu = measure(clients, counter, args.seconds)
+    idle_frames = counter.frames
+
+    typists = clients[:args.typists]
+    keystrokes, sent, typing_cpu = measure(clients, counter, args.seconds, typists, args.keys_per_second)
+    frames = counter.frames - idle_frames
+    per_client = frames / args.clients / args.seconds
+    bytes_per_client = counter.bytes / args.clients / args.seconds
+    naive = keystrokes * (args.clients - 1) / args.clients / args.seconds
+
+    print(f"{args.clients} clients in one room, {args.typists} typing at {args.keys_per_second:g} keys/s "
+          f"for {args.seconds:g}s")
+    print(f"keystrokes: {keystrokes}, typing frames sent: {sent} "
+          f"({sent / max(keystrokes, 1):.1%} of keystrokes)")
+    print(f"typing frames received per client: {per_client:.2f}/s, {bytes_per_client:.0f} B/s "
+          f"(naive: {naive:.0f} frames/s)")
+    print(f"process CPU: idle {idle_cpu / args.seconds:.1%}, typing {typing_cpu / args.seconds:.1%}")
+
+    for client in clients:
+        client.disconnect()
+
+
+if __name__ == "__main__":
+    main()
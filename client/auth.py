@@ -3,7 +3,6 @@ from tkinter import messagebox
 import json
 import os
 from config import settings
-import bcrypt
 
 # -------- Load & Save User Data -------- #
 def load_users():
@@ -37,6 +36,8 @@ def signup(username, password):
     if username in users:
         return False
 
+    import bcrypt  # Deferred so the login window opens without loading it
+
     hashed_password = bcrypt.hashpw(password.encode('utf-8'), bcrypt.gensalt())
     users[username] = hashed_password.decode('utf-8')  # Store as string
     save_users(users)
@@ -49,6 +50,8 @@ def login(username, password):
     stored_password = users.get(username)
 
     if stored_password:
+        import bcrypt
+
         # Compare entered password with hashed one
         return bcrypt.checkpw(password.encode('utf-8'), stored_password.encode('utf-8'))
 
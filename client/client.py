@@ -1,37 +1,64 @@
+import itertools
 import socket
 import json
+import random
 import threading
+import time
 from config import settings
+from client.sender import SendQueue
+from client.utils import MessageDecoder, client_context
+
+ACKED_TYPES = ('message', 'file', 'dm')  # Get a client ID and an 'ack' from the server
 
 class ChatClient:
     def __init__(self, username, room='general'):
         self.username = username
         self.room = room
         self.socket = None
+        self.stream = None  # The socket, or its TLSChannel; all reads and writes use it
         self.connected = False
         self.message_callback = None
         self.status_callback = None
+        self.last_ids = {}  # {room: last message ID seen}, sent on resume
+        self._closing = threading.Event()  # Set by disconnect(), stops reconnecting
+        # Frames are written by the send queue's thread, never the caller's
+        self.outbox = SendQueue(on_error=self._on_send_error)
+        self.pending = {}  # {cid: message} sent but not yet acknowledged
+        self._cid_prefix = f"{random.getrandbits(32):08x}"
+        self._cid_counter = itertools.count()
+        self.members = {}  # {room: frozenset of usernames}, replaced on every update
+        self.member_versions = {}  # {room: presence version the member set is at}
+        self.typing_sent = None  # monotonic time of the last "typing" frame, None when idle
+        self.tls_context = None
+        self.tls_session = None  # Offered on reconnect to skip the full TLS handshake
+        self.history_cache = self._open_history_cache()
         
     def connect(self):
         """Connect to the server"""
         try:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            self.socket.connect((settings.HOST, settings.PORT))
-            self.connected = True
+            self._open_socket()
             
-            # Join the room
+            # Join the room; with cached history only newer messages are sent.
+            # Written directly so it goes ahead of anything already queued.
             join_msg = {
                 'type': 'join',
                 'username': self.username,
-                'room': self.room
+                'room': self.room,
+                'last_id': self.last_ids.get(self.room)
             }
-            self.send_message(join_msg)
+            self._send_now(join_msg)
+            self.connected = True
+            self.outbox.resume(self.stream)
             
             # Start listening thread
-            listen_thread = threading.Thread(target=self._listen_for_messages)
+            listen_thread = threading.Thread(target=self._run)
             listen_thread.daemon = True
             listen_thread.start()
             
+            heartbeat_thread = threading.Thread(target=self._heartbeat)
+            heartbeat_thread.daemon = True
+            heartbeat_thread.start()
+            
             return True
             
         except Exception as e:
@@ -39,73 +66,313 @@ class ChatClient:
                 print(f"Connection error: {e}")
             return False
     
-    def disconnect(self):
-        """Disconnect from server"""
-        self.connected = False
-        if self.socket:
-            self.socket.close()
+    def _open_history_cache(self):
+        if not settings.HISTORY_CACHE_DIR:
+            return None
+        try:
+            from client.history_cache import HistoryCache
+            return HistoryCache(self.username, f"{settings.HOST}:{settings.PORT}")
+        except Exception as e:
+            if settings.DEBUG:
+                print(f"History cache unavailable: {e}")
+            return None
     
-    def send_message(self, message):
-        """Send a message to the server"""
-        if self.connected and self.socket:
+    def cached_history(self, room):
+        """Locally cached messages of a room, to paint before the server replies
+
+        They count as seen: the next join or change_room to this room only
+        asks the server for messages newer than the last one returned.
+        """
+        messages = []
+        if self.history_cache is not None:
             try:
-                # For large file messages, split into smaller chunks
-                if message.get('type') == 'file':
-                    return self.send_large_message(message)
-                else:
-                    self.socket.send(json.dumps(message).encode(settings.ENCODING))
-                    return True
+                messages = self.history_cache.recent(room, settings.HISTORY_LIMIT)
             except Exception as e:
                 if settings.DEBUG:
-                    print(f"Send error: {e}")
-                self.connected = False
-                return False
-        return False
+                    print(f"History cache read error: {e}")
+        if messages:
+            self.last_ids[room] = messages[-1]['id']
+        else:
+            self.last_ids.pop(room, None)
+        return messages
     
-    def send_large_message(self, message):
-        """Send large messages in chunks to avoid buffer overflow"""
+    def _update_history_cache(self, message):
+        """Keep the local cache in step with what the server sends"""
+        if self.history_cache is None:
+            return
+        msg_type = message.get('type')
+        room = message.get('room', self.room)
         try:
-            # Convert message to JSON string
-            message_str = json.dumps(message)
-            message_bytes = message_str.encode(settings.ENCODING)
-            
-            # If message is small enough, send normally
-            if len(message_bytes) <= settings.BUFFER_SIZE:
-                self.socket.send(message_bytes)
-                return True
+            if msg_type in ('message', 'file') and 'id' in message:
+                stored = {key: value for key, value in message.items() if key not in ('type', 'room')}
+                self.history_cache.extend(room, [stored])
+            elif msg_type == 'history':
+                if message.get('resumed'):
+                    self.history_cache.extend(room, message.get('messages') or [])
+                else:
+                    self.history_cache.replace(room, message.get('messages') or [])
+        except Exception as e:
+            if settings.DEBUG:
+                print(f"History cache write error: {e}")
+    
+    def _open_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect((settings.HOST, settings.PORT))
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        # The server pings quiet clients, so silence this long means it's gone
+        sock.settimeout(settings.TIMEOUT)
+        stream = sock
+        if settings.TLS_ENABLED:
+            from server.encryption import TLSChannel
+            if self.tls_context is None:
+                self.tls_context = client_context(settings.TLS_CA_FILE)
+            sock = self.tls_context.wrap_socket(
+                sock, server_hostname=settings.TLS_SERVER_NAME or settings.HOST,
+                session=self.tls_session)
+            # The listener and the send queue share the connection
+            stream = TLSChannel(sock)
+        self.socket = sock
+        self.stream = stream
+    
+    def _send_now(self, message):
+        """Write a frame on the calling thread, before the queue is resumed"""
+        self.stream.sendall(json.dumps(message).encode(settings.ENCODING))
+    
+    def _on_send_error(self, sock):
+        # Wake the listener, which notices the drop and reconnects
+        try:
+            sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+    
+    def disconnect(self):
+        """Disconnect from server"""
+        self._closing.set()
+        self.connected = False
+        self.outbox.close()
+        if self.history_cache is not None:
+            self.history_cache.close()
+        if self.socket:
+            # close() alone doesn't end the connection while the listener
+            # thread is blocked in recv() on it
+            try:
+                self.stream.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+            self.stream.close()
+    
+    def _run(self):
+        """Listen for messages, reconnecting whenever the connection drops"""
+        while True:
+            self._listen_for_messages()
+            if self._closing.is_set() or not self._reconnect():
+                break
+        
+        if self.status_callback:
+            self.status_callback("Disconnected")
+    
+    def _heartbeat(self):
+        """Ping the server whenever we have been quiet for HEARTBEAT_INTERVAL"""
+        while not self._closing.wait(settings.HEARTBEAT_INTERVAL / 4):
+            if self.connected and time.monotonic() - self.outbox.last_sent >= settings.HEARTBEAT_INTERVAL:
+                self.send_message({'type': 'ping'})
+    
+    def _reconnect(self):
+        """Reconnect with jittered exponential backoff and resume the room
+
+        The server is told the last message ID seen in the current room and
+        replies with only the messages missed while offline.
+        """
+        attempt = 0
+        while not self._closing.is_set():
+            if settings.RECONNECT_MAX_ATTEMPTS and attempt >= settings.RECONNECT_MAX_ATTEMPTS:
+                return False
             
-            # For large messages, send in chunks
-            chunk_size = settings.BUFFER_SIZE // 2  # Use half buffer size for safety
-            total_chunks = (len(message_bytes) + chunk_size - 1) // chunk_size
+            delay = min(settings.RECONNECT_MAX_DELAY, settings.RECONNECT_BASE_DELAY * 2 ** attempt)
+            attempt += 1
+            if self.status_callback:
+                self.status_callback(f"Reconnecting (attempt {attempt})...")
             
-            # Send message header
-            header = {
-                'type': 'large_message_start',
-                'total_size': len(message_bytes),
-                'total_chunks': total_chunks
-            }
-            self.socket.send(json.dumps(header).encode(settings.ENCODING))
+            # Full jitter so clients don't reconnect in lockstep after an outage
+            if self._closing.wait(random.uniform(0, delay)):
+                return False
             
-            # Send chunks
-            for i in range(0, len(message_bytes), chunk_size):
-                chunk = message_bytes[i:i + chunk_size]
-                chunk_msg = {
-                    'type': 'large_message_chunk',
-                    'chunk_index': i // chunk_size,
-                    'chunk_data': chunk.hex()  # Convert to hex for JSON compatibility
+            try:
+                self._open_socket()
+                self.typing_sent = None
+                resume_msg = {
+                    'type': 'resume',
+                    'username': self.username,
+                    'room': self.room,
+                    'last_id': self.last_ids.get(self.room)
                 }
-                self.socket.send(json.dumps(chunk_msg).encode(settings.ENCODING))
-            
-            # Send end marker
-            end_msg = {'type': 'large_message_end'}
-            self.socket.send(json.dumps(end_msg).encode(settings.ENCODING))
-            
+                self._send_now(resume_msg)
+                self.connected = True
+                self.outbox.resume(self.stream)
+                
+                # Anything unacknowledged may not have arrived; the server
+                # acks client IDs it already stored instead of storing twice
+                for message in list(self.pending.values()):
+                    self._enqueue(message)
+                if self.status_callback:
+                    self.status_callback("Connected")
+                return True
+            except Exception as e:
+                if settings.DEBUG:
+                    print(f"Reconnect error: {e}")
+        return False
+    
+    def _track_message_id(self, message):
+        """Remember the newest message ID per room
+
+        Returns False for a message that was already seen, e.g. one that
+        raced with a resume.
+        """
+        msg_type = message.get('type')
+        # Direct messages are numbered per conversation
+        room = message.get('conversation') or message.get('room', self.room)
+        
+        if msg_type in ('message', 'file', 'dm') and 'id' in message:
+            if message['id'] <= self.last_ids.get(room, -1):
+                return False
+            self.last_ids[room] = message['id']
+        
+        elif msg_type == 'history':
+            messages = message.get('messages') or []
+            if message.get('resumed'):
+                if messages and 'id' in messages[-1]:
+                    self.last_ids[room] = max(self.last_ids.get(room, -1), messages[-1]['id'])
+            elif messages and 'id' in messages[-1]:
+                self.last_ids[room] = messages[-1]['id']
+            else:
+                self.last_ids.pop(room, None)
+        
+        return True
+    
+    def _track_presence(self, message):
+        """Apply a member list snapshot or diff for the current room
+
+        Returns False if there is nothing new to show. A diff that doesn't
+        follow on from the version we hold means one was missed, so a fresh
+        snapshot is requested instead.
+        """
+        room = message.get('room')
+        if room != self.room:
+            return False
+        
+        if message['type'] == 'members':
+            self.members[room] = frozenset(message['members'])
+            self.member_versions[room] = message['version']
             return True
-            
-        except Exception as e:
-            if settings.DEBUG:
-                print(f"Large message send error: {e}")
+        
+        version = self.member_versions.get(room)
+        if version is None or message['version'] <= version:
+            return False
+        if message['base'] != version:
+            self.request_members(room)
+            return False
+        self.members[room] = (self.members[room] - frozenset(message['left'])) | frozenset(message['joined'])
+        self.member_versions[room] = message['version']
+        return True
+    
+    def send_message(self, message):
+        """Queue a message for the server without waiting on the network
+
+        Chat messages, files and direct messages get a client ID ('cid')
+        that is returned, and stay in self.pending until the server's 'ack'
+        or an 'error' refusing them arrives (either is passed to
+        message_callback too). Those are kept
+        while reconnecting and sent once the connection is back; other
+        frames are dropped while disconnected and False is returned.
+        """
+        if self._closing.is_set():
+            return False
+        if message.get('type') in ACKED_TYPES:
+            message.setdefault('cid', f"{self._cid_prefix}-{next(self._cid_counter)}")
+            self.pending[message['cid']] = message
+            if self.connected:
+                self._enqueue(message)
+            return message['cid']
+        if not self.connected:
+            return False
+        return self._enqueue(message)
+    
+    def _enqueue(self, message):
+        if message.get('type') == 'file':
+            # Bulk: written chunk by chunk, behind any chat frames
+            return self.outbox.put_bulk(self._large_message_frames(message))
+        return self.outbox.put(json.dumps(message).encode(settings.ENCODING))
+    
+    def _large_message_frames(self, message):
+        """Encoded frames for a message, split in chunks if it is large
+
+        A generator, so chunks are only encoded as the writer gets to them.
+        """
+        message_bytes = json.dumps(message).encode(settings.ENCODING)
+        
+        # If message is small enough, send normally
+        if len(message_bytes) <= settings.BUFFER_SIZE:
+            yield message_bytes
+            return
+        
+        # For large messages, send in chunks
+        chunk_size = settings.BUFFER_SIZE // 2  # Use half buffer size for safety
+        total_chunks = (len(message_bytes) + chunk_size - 1) // chunk_size
+        
+        # Send message header
+        header = {
+            'type': 'large_message_start',
+            'total_size': len(message_bytes),
+            'total_chunks': total_chunks,
+            'cid': message.get('cid')  # So a refused upload can be settled
+        }
+        yield json.dumps(header).encode(settings.ENCODING)
+        
+        # Send chunks
+        for i in range(0, len(message_bytes), chunk_size):
+            chunk = message_bytes[i:i + chunk_size]
+            chunk_msg = {
+                'type': 'large_message_chunk',
+                'chunk_index': i // chunk_size,
+                'chunk_data': chunk.hex()  # Convert to hex for JSON compatibility
+            }
+            yield json.dumps(chunk_msg).encode(settings.ENCODING)
+        
+        # Send end marker
+        yield json.dumps({'type': 'large_message_end'}).encode(settings.ENCODING)
+    
+    def _acknowledge(self, ack):
+        """Settle a pending message; False for a repeated ack after a resend"""
+        message = self.pending.pop(ack.get('cid'), None)
+        if message is None:
             return False
+        ack['sent_type'] = message['type']
+        ack['file_name'] = message.get('file_name')
+        
+        # Only when nothing can be missing in between; an ack may overtake
+        # the broadcast of a message stored just before ours
+        if ack['id'] == self.last_ids.get(ack['room'], -1) + 1:
+            self.last_ids[ack['room']] = ack['id']
+        
+        # Our own room messages aren't echoed back, cache them from the ack
+        if message['type'] in ('message', 'file') and self.history_cache is not None:
+            stored = {key: value for key, value in message.items() if key not in ('type', 'cid')}
+            stored.update(username=self.username, id=ack['id'], ts=ack['ts'], timestamp=ack['timestamp'])
+            try:
+                self.history_cache.extend(ack['room'], [stored])
+            except Exception as e:
+                if settings.DEBUG:
+                    print(f"History cache write error: {e}")
+        return True
+    
+    def _refused(self, error):
+        """Drop a pending message the server refused, so it isn't re-sent"""
+        message = self.pending.pop(error.get('cid'), None)
+        if message is None:
+            error.pop('cid', None)  # Settled already, nothing left to mark
+            return
+        error['sent_type'] = message['type']
+        error['file_name'] = message.get('file_name')
     
     def send_chat_message(self, content):
         """Send a chat message"""
@@ -113,46 +380,138 @@ class ChatClient:
             'type': 'message',
             'content': content
         }
+        # The server clears our typing state when the message arrives
+        self.typing_sent = None
         return self.send_message(message)
     
+    def notify_typing(self):
+        """Call on every keystroke; sends at most one frame per TYPING_SEND_INTERVAL"""
+        now = time.monotonic()
+        if self.typing_sent is not None and now - self.typing_sent < settings.TYPING_SEND_INTERVAL:
+            return True
+        self.typing_sent = now
+        return self.send_message({'type': 'typing', 'active': True})
+    
+    def stop_typing(self):
+        """Tell the room we stopped typing, if we said we were"""
+        if self.typing_sent is None:
+            return True
+        self.typing_sent = None
+        return self.send_message({'type': 'typing', 'active': False})
+    
     def send_file_message(self, file_message):
         """Send a file message"""
         return self.send_message(file_message)
     
+    def send_direct_message(self, to, content):
+        """Send a private message to one user, delivered later if they're offline"""
+        message = {
+            'type': 'dm',
+            'to': to,
+            'content': content
+        }
+        return self.send_message(message)
+    
+    def request_dm_history(self, other, last_id=None):
+        """Ask for a conversation's history, it arrives as a 'dm_history' message"""
+        message = {
+            'type': 'dm_history',
+            'with': other
+        }
+        if last_id is not None:
+            message['last_id'] = last_id
+        return self.send_message(message)
+    
+    def request_older_history(self, before_id, room=None, with_user=None):
+        """Ask for the page of messages before before_id, in a room or a conversation
+
+        The server answers with 'older_history'; pages reach into archived history.
+        """
+        message = {'type': 'older_history', 'before_id': before_id}
+        if with_user is not None:
+            message['with'] = with_user
+        else:
+            message['room'] = room or self.room
+        return self.send_message(message)
+    
+    def search(self, query, room=None, username=None, since=None, until=None):
+        """Search chat history, results arrive as a 'search_results' message"""
+        message = {
+            'type': 'search',
+            'query': query
+        }
+        filters = {'room': room, 'username': username, 'since': since, 'until': until}
+        message.update({key: value for key, value in filters.items() if value is not None})
+        return self.send_message(message)
+    
+    def request_members(self, room=None):
+        """Ask for a room's member list, it arrives as a 'members' message"""
+        return self.send_message({'type': 'members', 'room': room or self.room})
+    
     def change_room(self, new_room):
-        """Change to a different chat room"""
+        """Change to a different chat room
+
+        Call cached_history(new_room) first to get only the messages that
+        aren't cached yet; otherwise the server sends the full history.
+        """
         message = {
             'type': 'change_room',
-            'room': new_room
+            'room': new_room,
+            'last_id': self.last_ids.get(new_room)
         }
+        # Switch before sending so the new room's member list isn't dropped
+        # if it arrives before send_message() returns; the old room's list
+        # would go stale since its diffs stop coming
+        old_room = self.room
+        self.typing_sent = None  # Leaving the room ends typing there
+        self.members.pop(old_room, None)
+        self.member_versions.pop(old_room, None)
+        self.room = new_room
         if self.send_message(message):
-            self.room = new_room
+            self.last_ids.pop(old_room, None)  # Messages there stop coming
             return True
+        self.room = old_room
         return False
     
     def _listen_for_messages(self):
-        """Listen for incoming messages from server"""
+        """Listen for incoming messages from server
+
+        Runs on its own thread and never touches the UI: each decoded message
+        is handed to message_callback, which is expected to only enqueue it.
+        """
+        decoder = MessageDecoder(settings.ENCODING)
         while self.connected:
             try:
-                data = self.socket.recv(settings.BUFFER_SIZE).decode(settings.ENCODING)
+                data = self.stream.recv(settings.BUFFER_SIZE)
                 if not data:
                     break
-                
-                # Debug
-                if settings.DEBUG:
-                    try:
-                        peer = self.socket.getpeername()
-                    except:
-                        peer = None
-                    print(f"[DEBUG] Received raw data from {peer}: {data}")
 
-                message = json.loads(data)
+                for message in decoder.feed(data):
+                    if settings.DEBUG:
+                        print(f"[DEBUG] Parsed message: {message}")
 
-                if settings.DEBUG:
-                    print(f"[DEBUG] Parsed message: {message}")
+                    msg_type = message.get('type')
+                    if msg_type == 'ping':
+                        self.send_message({'type': 'pong'})
+                        continue
+                    if msg_type == 'pong':
+                        continue
+
+                    if msg_type == 'ack':
+                        if not self._acknowledge(message):
+                            continue
+                    elif msg_type == 'error':
+                        self._refused(message)
+                    elif msg_type in ('members', 'presence'):
+                        if not self._track_presence(message):
+                            continue
+                    elif not self._track_message_id(message):
+                        continue
+                    else:
+                        self._update_history_cache(message)
 
-                if self.message_callback:
-                    self.message_callback(message)
+                    if self.message_callback:
+                        self.message_callback(message)
                     
             except Exception as e:
                 if settings.DEBUG:
@@ -160,8 +519,15 @@ class ChatClient:
                 break
         
         self.connected = False
-        if self.status_callback:
-            self.status_callback("Disconnected")
+        self.outbox.pause()
+        try:
+            # Keep the TLS session (TLS 1.3 tickets arrive after the
+            # handshake) so the next connection can resume it
+            if getattr(self.socket, 'session', None) is not None:
+                self.tls_session = self.socket.session
+            self.stream.close()
+        except Exception:
+            pass
     
     def set_message_callback(self, callback):
         """Set callback for incoming messages"""
@@ -0,0 +1,115 @@
+import time
+from collections import deque
+from config import settings
+
+
+class UIDispatcher:
+    """Hand work from network threads over to the Tk main loop.
+
+    Tk widgets may only be touched from the thread running mainloop(), so
+    background threads only append to a deque (append/popleft are
+    thread-safe) and never wait on the UI. The main loop drains the deque
+    in bounded batches on a timer, yielding back to Tk between batches so
+    redraws and input keep flowing under bursty traffic.
+    """
+
+    def __init__(self, root, handler, batch_size=None, interval_ms=None, high_water=None):
+        self.root = root
+        self.handler = handler
+        self.batch_size = batch_size or settings.UI_DISPATCH_BATCH
+        self.interval_ms = interval_ms or settings.UI_DISPATCH_INTERVAL_MS
+        self.high_water = high_water or settings.UI_DISPATCH_HIGH_WATER
+
+        self._queue = deque()
+        self._running = False
+        self._after_id = None
+        self._backlogged = False
+
+        # Backpressure metrics, only updated from the Tk thread
+        self.stats = {
+            'dispatched': 0,
+            'batches': 0,
+            'max_depth': 0,
+            'high_water_hits': 0,
+            'last_lag_ms': 0.0,
+            'max_lag_ms': 0.0,
+            'errors': 0
+        }
+
+    def post(self, message):
+        """Queue a decoded server message for the handler (any thread)"""
+        self._queue.append((time.monotonic(), self.handler, (message,)))
+
+    def call(self, func, *args):
+        """Queue a callable to run on the Tk thread (any thread)"""
+        self._queue.append((time.monotonic(), func, args))
+
+    def start(self):
+        if not self._running:
+            self._running = True
+            self._after_id = self.root.after(self.interval_ms, self._drain)
+
+    def stop(self):
+        self._running = False
+        if self._after_id is not None:
+            try:
+                self.root.after_cancel(self._after_id)
+            except Exception:
+                pass
+            self._after_id = None
+
+    @property
+    def depth(self):
+        return len(self._queue)
+
+    def get_stats(self):
+        stats = dict(self.stats)
+        stats['depth'] = len(self._queue)
+        return stats
+
+    def _drain(self):
+        self._after_id = None
+        if not self._running:
+            return
+
+        depth = len(self._queue)
+        if depth > self.stats['max_depth']:
+            self.stats['max_depth'] = depth
+        if depth >= self.high_water:
+            # Count each time the backlog crosses the mark, not every tick
+            if not self._backlogged:
+                self._backlogged = True
+                self.stats['high_water_hits'] += 1
+                if settings.DEBUG:
+                    print(f"[DEBUG] UI dispatch backlog: {depth} queued events")
+        else:
+            self._backlogged = False
+
+        now = time.monotonic()
+        handled = 0
+        while handled < self.batch_size:
+            try:
+                enqueued_at, func, args = self._queue.popleft()
+            except IndexError:
+                break
+
+            lag_ms = (now - enqueued_at) * 1000
+            self.stats['last_lag_ms'] = lag_ms
+            if lag_ms > self.stats['max_lag_ms']:
+                self.stats['max_lag_ms'] = lag_ms
+
+            try:
+                func(*args)
+            except Exception as e:
+                self.stats['errors'] += 1
+                if settings.DEBUG:
+                    print(f"[DEBUG] UI dispatch error in {getattr(func, '__name__', func)}: {e}")
+            handled += 1
+
+        if handled:
+            self.stats['batches'] += 1
+            self.stats['dispatched'] += handled
+
+        # More work left: give Tk one tick for redraws and input, then continue
+        delay = 1 if self._queue else self.interval_ms
+        self._after_id = self.root.after(delay, self._drain)
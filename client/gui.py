@@ -4,9 +4,9 @@ import threading
 from datetime import datetime
 import os
 import base64
-from PIL import Image, ImageTk
-from io import BytesIO
 from client.client import ChatClient
+from client.dispatch import UIDispatcher
+from client.thumbnails import ThumbnailCache
 from config import settings
 
 class ChatGUI:
@@ -26,8 +26,21 @@ class ChatGUI:
         self.root.grid_rowconfigure(0, weight=1)
         self.root.grid_columnconfigure(1, weight=1)
         
-        self.setup_ui()
+        # Network threads hand messages to the Tk loop through this queue
+        self.dispatcher = UIDispatcher(self.root, self.handle_message)
+        
+        # Image previews are decoded off the Tk thread
+        self.thumbnails = ThumbnailCache()
+        self.preview_images = {}  # {mark_name: PhotoImage}, keeps images alive
+        self.file_link_count = 0
+        self.files = {}  # {link number: (file_data, file_name)} of the files shown
+        self.repaint = 0  # Bumped when the display is cleared, so late previews are dropped
+        
+        # Connect (and let the server send history) while the widgets are
+        # being built; anything that arrives early waits in the dispatcher
         self.connect_to_server()
+        self.setup_ui()
+        self.dispatcher.start()
     
     def setup_ui(self):
         # Left sidebar
@@ -72,6 +85,37 @@ class ChatGUI:
                                     activeforeground='#3498db')
             room_btn.pack(anchor='w', pady=3)
         
+        # Who is in the current room, kept up to date from presence diffs
+        members_frame = tk.Frame(sidebar, bg='#34495e')
+        members_frame.pack(fill='x', padx=15, pady=(0, 15))
+        
+        self.members_label = tk.Label(members_frame, text="🟢 Online",
+                                    font=('Arial', 12, 'bold'),
+                                    bg='#34495e', fg='white')
+        self.members_label.pack(anchor='w')
+        
+        self.members_list = tk.Listbox(members_frame, height=8,
+                                     font=('Arial', 10),
+                                     bg='#2c3e50', fg='white',
+                                     borderwidth=0, highlightthickness=0,
+                                     activestyle='none')
+        self.members_list.pack(fill='x', pady=3)
+        self.members_list.bind('<Double-Button-1>', self.start_direct_message)
+        
+        # History search
+        search_frame = tk.Frame(sidebar, bg='#34495e')
+        search_frame.pack(fill='x', padx=15, pady=(0, 15))
+        
+        tk.Label(search_frame, text="🔍 Search", 
+                font=('Arial', 12, 'bold'), 
+                bg='#34495e', fg='white').pack(anchor='w')
+        
+        self.search_entry = tk.Entry(search_frame, font=('Arial', 10),
+                                   bg='#ecf0f1', fg='#2c3e50',
+                                   borderwidth=0, relief='flat')
+        self.search_entry.pack(fill='x', pady=3)
+        self.search_entry.bind('<Return>', self.search_history)
+        
         # Disconnect button
         disconnect_btn = tk.Button(sidebar, text="🚪 Disconnect", 
                                  command=self.disconnect,
@@ -95,9 +139,26 @@ class ChatGUI:
         )
         self.chat_display.grid(row=0, column=0, sticky='nsew', padx=5, pady=5)
         
+        # Configure tags for colors once, not per inserted line
+        self.chat_display.tag_config('timestamp', foreground='#7f8c8d')
+        self.chat_display.tag_config('message', foreground='#2c3e50')
+        self.chat_display.tag_config('own_message', foreground='#27ae60')
+        self.chat_display.tag_config('system', foreground='#e67e22')
+        self.chat_display.tag_config('file_message', foreground='#3498db', font=('Arial', 10, 'bold'))
+        self.chat_display.tag_config('download_link', foreground='#e74c3c', font=('Arial', 9, 'underline'))
+        # One handler for every download link, it finds the file by the link's own tag
+        self.chat_display.tag_bind('download_link', '<Button-1>', self.on_download_click)
+        
+        # Who else is typing
+        self.typing_label = tk.Label(chat_frame, text="", anchor='w',
+                                   font=('Arial', 9, 'italic'),
+                                   bg='#2c3e50', fg='#bdc3c7')
+        self.typing_label.grid(row=1, column=0, sticky='ew', padx=5)
+        self.typing_idle_job = None
+        
         # Message input area
         input_frame = tk.Frame(chat_frame, bg='#2c3e50')
-        input_frame.grid(row=1, column=0, sticky='ew', padx=5, pady=5)
+        input_frame.grid(row=2, column=0, sticky='ew', padx=5, pady=5)
         input_frame.grid_columnconfigure(0, weight=1)
         
         self.message_entry = tk.Entry(input_frame, font=('Arial', 12),
@@ -105,6 +166,7 @@ class ChatGUI:
                                     borderwidth=0, relief='flat')
         self.message_entry.grid(row=0, column=0, sticky='ew', padx=(0, 10))
         self.message_entry.bind('<Return>', self.send_message)
+        self.message_entry.bind('<KeyRelease>', self.on_entry_key)
         
         # File attachment button
         attach_btn = tk.Button(input_frame, text="📎", 
@@ -139,15 +201,21 @@ class ChatGUI:
     def connect_to_server(self):
         def connect():
             self.client = ChatClient(self.username, self.current_room)
-            self.client.set_message_callback(self.handle_message)
-            self.client.set_status_callback(self.update_status)
+            self.client.set_message_callback(self.dispatcher.post)
+            self.client.set_status_callback(
+                lambda status: self.dispatcher.call(self.update_status, status))
+            
+            # Paint the cached history first; the server then only sends what's newer.
+            # Queued ahead of anything the connection delivers.
+            cached = self.client.cached_history(self.current_room)
+            self.dispatcher.call(self.show_history, cached)
             
             if self.client.connect():
-                self.update_status("Connected")
-                self.add_system_message("Connected to chat server!")
+                self.dispatcher.call(self.update_status, "Connected")
+                self.dispatcher.call(self.add_system_message, "Connected to chat server!")
             else:
-                self.update_status("Connection failed")
-                messagebox.showerror("Connection Error", 
+                self.dispatcher.call(self.update_status, "Connection failed")
+                self.dispatcher.call(messagebox.showerror, "Connection Error", 
                                    "Failed to connect to server. Please try again.")
         
         connect_thread = threading.Thread(target=connect)
@@ -157,27 +225,50 @@ class ChatGUI:
     def handle_message(self, message):
         msg_type = message.get('type')
         
-        if msg_type == 'message':
-            username = message['username']
-            content = message['content']
-            timestamp = message['timestamp']
-            
-            if username == self.username:
-                self.add_message(f"You: {content}", timestamp, is_own=True)
-            else:
-                self.add_message(f"{username}: {content}", timestamp)
+        if msg_type in ('message', 'file'):
+            self.display_message(message)
         
-        elif msg_type == 'file':
-            username = message['username']
-            file_name = message['file_name']
-            file_type = message['file_type']
-            file_data = message['file_data']
-            timestamp = message['timestamp']
-            
-            if username == self.username:
-                self.add_file_message(f"You sent: {file_name}", file_type, file_data, timestamp, is_own=True)
+        elif msg_type == 'dm':
+            self.display_direct_message(message)
+        
+        elif msg_type == 'ack':
+            if message['sent_type'] == 'file':
+                self.add_system_message(f"✅ File sent successfully: {message['file_name']}")
             else:
-                self.add_file_message(f"{username} sent: {file_name}", file_type, file_data, timestamp)
+                self.mark_sent(message['cid'])
+        
+        elif msg_type == 'dm_history':
+            self.add_system_message(f"💬 Conversation with {message['with']}")
+            for msg in message['messages']:
+                self.display_direct_message(msg)
+        
+        elif msg_type in ('members', 'presence'):
+            if message['room'] == self.current_room:
+                self.show_members()
+        
+        elif msg_type == 'typing':
+            if message['room'] == self.current_room:
+                self.show_typing(message)
+        
+        elif msg_type == 'search_results':
+            results = message['results']
+            self.add_system_message(f"🔍 {len(results)} result(s) for \"{message['query']}\"")
+            for result in results:
+                text = result.get('content') or f"📎 {result.get('file_name')}"
+                self.add_system_message(
+                    f"   {self.format_timestamp(result)} #{result['room']} {result['username']}: {text}")
+        
+        elif msg_type == 'server_shutdown':
+            self.add_system_message("Server is restarting, reconnecting...")
+        
+        elif msg_type == 'error':
+            reason = message.get('message', 'Request refused')
+            if message.get('sent_type') == 'file':
+                self.add_system_message(f"❌ File not sent: {message['file_name']} ({reason})")
+            else:
+                if 'cid' in message:
+                    self.mark_failed(message['cid'])
+                self.add_system_message(f"⚠️ {reason}")
         
         elif msg_type == 'user_joined':
             username = message['username']
@@ -189,26 +280,102 @@ class ChatGUI:
         
         elif msg_type == 'history':
             messages = message['messages']
-            self.chat_display.config(state='normal')
-            self.chat_display.delete(1.0, tk.END)
-            self.chat_display.config(state='disabled')
             
-            for msg in messages:
-                username = msg['username']
-                content = msg['content']
-                timestamp = msg['timestamp']
-                
-                if username == self.username:
-                    self.add_message(f"You: {content}", timestamp, is_own=True)
-                else:
-                    self.add_message(f"{username}: {content}", timestamp)
+            # After a reconnect, or on top of the cached history, only the
+            # missed messages are sent; append them
+            if message.get('resumed'):
+                for msg in messages:
+                    self.display_message(msg)
+            else:
+                self.show_history(messages)
     
-    def add_message(self, text, timestamp, is_own=False):
+    def show_history(self, messages):
+        """Replace the chat display with a room's history"""
+        self.chat_display.config(state='normal')
+        self.chat_display.delete(1.0, tk.END)
+        self.chat_display.config(state='disabled')
+        # Tk keeps tags and marks after their text is gone
+        link_tags = [tag for tag in self.chat_display.tag_names() if tag.startswith('download_') and tag != 'download_link']
+        if link_tags:
+            self.chat_display.tag_delete(*link_tags)
+        for mark in self.chat_display.mark_names():
+            if mark.startswith('preview_'):
+                self.chat_display.mark_unset(mark)
+        self.files.clear()
+        self.preview_images.clear()
+        self.repaint += 1
+        
+        for msg in messages:
+            self.display_message(msg)
+    
+    def display_message(self, message):
+        """Render a chat or file message, live or from history"""
+        username = message['username']
+        timestamp = self.format_timestamp(message)
+        is_own = username == self.username
+        
+        if 'file_name' in message:
+            file_name = message['file_name']
+            text = f"You sent: {file_name}" if is_own else f"{username} sent: {file_name}"
+            self.add_file_message(text, message['file_type'], message['file_data'],
+                                  timestamp, is_own=is_own, file_name=file_name)
+        else:
+            content = message['content']
+            text = f"You: {content}" if is_own else f"{username}: {content}"
+            self.add_message(text, timestamp, is_own=is_own)
+    
+    def display_direct_message(self, message):
+        """Render a direct message inline, marked as private"""
+        timestamp = self.format_timestamp(message)
+        if message['username'] == self.username:
+            self.add_message(f"💬 You → {message['to']}: {message['content']}", timestamp, is_own=True)
+        else:
+            self.add_message(f"💬 {message['username']} → you: {message['content']}", timestamp)
+    
+    def show_members(self):
+        """Redraw the online list from the client's member set"""
+        members = sorted(self.client.members.get(self.current_room, ()), key=str.lower)
+        self.members_list.delete(0, tk.END)
+        for username in members:
+            self.members_list.insert(tk.END, f"{username} (you)" if username == self.username else username)
+        self.members_label.config(text=f"🟢 Online ({len(members)})")
+    
+    def show_typing(self, update):
+        """Show the room's typing aggregate, leaving ourselves out"""
+        others = [name for name in update['users'] if name != self.username]
+        count = update['count'] - (len(update['users']) - len(others))
+        if count <= 0:
+            text = ""
+        elif count == 1:
+            text = f"{others[0]} is typing..." if others else "Someone is typing..."
+        elif count <= len(others):
+            text = f"{', '.join(others[:-1])} and {others[-1]} are typing..."
+        elif others:
+            text = f"{', '.join(others)} and {count - len(others)} more are typing..."
+        else:
+            text = f"{count} people are typing..."
+        self.typing_label.config(text=text)
+    
+    def format_timestamp(self, message):
+        """Show the time for today's messages and the date for older ones"""
+        ts = message.get('ts')
+        if not ts:
+            return message.get('timestamp', '')
+        sent = datetime.fromtimestamp(ts / 1000)
+        if sent.date() == datetime.now().date():
+            return sent.strftime('%H:%M:%S')
+        return sent.strftime('%Y-%m-%d %H:%M')
+    
+    def add_message(self, text, timestamp, is_own=False, cid=None):
         self.chat_display.config(state='normal')
         
         # Add timestamp
         self.chat_display.insert(tk.END, f"[{timestamp}] ", 'timestamp')
         
+        # Our own messages show ⏳ until the server acknowledges them
+        if cid is not None:
+            self.chat_display.insert(tk.END, "⏳ ", ('timestamp', f"cid_{cid}"))
+        
         # Add message with different color for own messages
         if is_own:
             self.chat_display.insert(tk.END, f"{text}\n", 'own_message')
@@ -217,11 +384,25 @@ class ChatGUI:
         
         self.chat_display.config(state='disabled')
         self.chat_display.see(tk.END)
-        
-        # Configure tags for colors
-        self.chat_display.tag_config('timestamp', foreground='#7f8c8d')
-        self.chat_display.tag_config('message', foreground='#2c3e50')
-        self.chat_display.tag_config('own_message', foreground='#27ae60')
+    
+    def mark_sent(self, cid):
+        """Swap a message's ⏳ for ✓ once the server has stored it"""
+        self._settle(cid, "✓ ")
+    
+    def mark_failed(self, cid):
+        """Swap a message's ⏳ for ❌ when the server refused it"""
+        self._settle(cid, "❌ ")
+    
+    def _settle(self, cid, mark):
+        tag = f"cid_{cid}"
+        ranges = self.chat_display.tag_ranges(tag)
+        if not ranges:
+            return
+        self.chat_display.config(state='normal')
+        self.chat_display.delete(ranges[0], ranges[1])
+        self.chat_display.insert(ranges[0], mark, 'timestamp')
+        self.chat_display.tag_delete(tag)
+        self.chat_display.config(state='disabled')
     
     def add_system_message(self, text):
         self.chat_display.config(state='normal')
@@ -229,11 +410,8 @@ class ChatGUI:
         self.chat_display.insert(tk.END, f"[{timestamp}] {text}\n", 'system')
         self.chat_display.config(state='disabled')
         self.chat_display.see(tk.END)
-        
-        # Configure system message color
-        self.chat_display.tag_config('system', foreground='#e67e22')
     
-    def add_file_message(self, text, file_type, file_data, timestamp, is_own=False):
+    def add_file_message(self, text, file_type, file_data, timestamp, is_own=False, file_name=None):
         """Add a file message to the chat display"""
         self.chat_display.config(state='normal')
         
@@ -258,20 +436,55 @@ class ChatGUI:
         icon = file_icons.get(file_type, '📎')
         self.chat_display.insert(tk.END, f"  {icon} {file_type.upper()} file\n", 'file_message')
         
-        # Add download button text
-        self.chat_display.insert(tk.END, "  [Click to download]\n", 'download_link')
+        # Reserve a spot for the image preview, filled in once it is decoded
+        self.file_link_count += 1
+        if file_type == 'image':
+            preview_mark = f"preview_{self.file_link_count}"
+            self.chat_display.insert(tk.END, "  ")
+            self.chat_display.mark_set(preview_mark, 'end-1c')
+            self.chat_display.mark_gravity(preview_mark, 'left')
+            self.chat_display.insert(tk.END, "\n")
+            self.thumbnails.request(
+                file_data,
+                lambda png, mark=preview_mark, repaint=self.repaint:
+                    self.dispatcher.call(self.show_preview, mark, png, repaint)
+            )
+        
+        # Add download button text, with its own tag so the click gets this file
+        link_tag = f"download_{self.file_link_count}"
+        self.chat_display.insert(tk.END, "  [Click to download]\n", ('download_link', link_tag))
         
         self.chat_display.config(state='disabled')
         self.chat_display.see(tk.END)
         
-        # Configure file message styling
-        self.chat_display.tag_config('file_message', foreground='#3498db', font=('Arial', 10, 'bold'))
-        self.chat_display.tag_config('download_link', foreground='#e74c3c', font=('Arial', 9, 'underline'))
+        if file_name is None:
+            file_name = text.split(': ')[-1]
+        self.files[self.file_link_count] = (file_data, file_name)
+    
+    def on_download_click(self, event):
+        """Download the file whose link was clicked"""
+        for tag in self.chat_display.tag_names(f"@{event.x},{event.y}"):
+            if tag.startswith('download_') and tag[9:].isdigit():
+                file = self.files.get(int(tag[9:]))
+                if file is not None:
+                    self.download_file(*file)
+                return
+    
+    def show_preview(self, mark, png, repaint):
+        """Insert a decoded thumbnail at its reserved spot (Tk thread)"""
+        if png is None or repaint != self.repaint or mark not in self.chat_display.mark_names():
+            return
+        try:
+            image = tk.PhotoImage(data=base64.b64encode(png).decode('ascii'), format='png')
+        except tk.TclError as e:
+            if settings.DEBUG:
+                print(f"[DEBUG] Preview render failed: {e}")
+            return
         
-        # Bind click event for download
-        self.chat_display.tag_bind('download_link', '<Button-1>', 
-                                 lambda e, data=file_data, name=text.split(': ')[-1]: 
-                                 self.download_file(data, name))
+        self.preview_images[mark] = image
+        self.chat_display.config(state='normal')
+        self.chat_display.image_create(mark, image=image)
+        self.chat_display.config(state='disabled')
     
     def download_file(self, file_data, file_name):
         """Download and save a file"""
@@ -282,7 +495,7 @@ class ChatGUI:
             # Ask user where to save the file
             save_path = filedialog.asksaveasfilename(
                 title="Save file as",
-                initialvalue=file_name,
+                initialfile=file_name,
                 defaultextension=os.path.splitext(file_name)[1]
             )
             
@@ -371,35 +584,96 @@ class ChatGUI:
                     'file_size': file_size
                 }
                 
-                if self.client.send_file_message(file_message):
-                    # Update GUI from main thread
-                    self.root.after(0, lambda: self.add_system_message(f"✅ File sent successfully: {file_name}"))
-                else:
-                    # Update GUI from main thread
-                    self.root.after(0, lambda: self.add_system_message(f"❌ Failed to send file: {file_name}"))
-                    self.root.after(0, lambda: messagebox.showerror("Error", "Failed to send file"))
+                # Once queued, the server's ack reports when it has been stored
+                if not self.client.send_file_message(file_message):
+                    # Update GUI from the Tk thread
+                    self.dispatcher.call(lambda: self.add_system_message(f"❌ Failed to send file: {file_name}"))
+                    self.dispatcher.call(lambda: messagebox.showerror("Error", "Failed to send file"))
             else:
-                # Update GUI from main thread
-                self.root.after(0, lambda: messagebox.showerror("Error", "Not connected to server"))
+                # Update GUI from the Tk thread
+                self.dispatcher.call(lambda: messagebox.showerror("Error", "Not connected to server"))
                 
         except Exception as e:
-            # Update GUI from main thread
-            self.root.after(0, lambda: self.add_system_message(f"❌ Error sending file: {str(e)}"))
-            self.root.after(0, lambda: messagebox.showerror("Error", f"Failed to send file: {str(e)}"))
+            # Update GUI from the Tk thread (e is unbound once the except block ends)
+            error = str(e)
+            self.dispatcher.call(lambda: self.add_system_message(f"❌ Error sending file: {error}"))
+            self.dispatcher.call(lambda: messagebox.showerror("Error", f"Failed to send file: {error}"))
     
     def send_message(self, event=None):
         content = self.message_entry.get().strip()
         if content and self.client and self.client.connected:
-            if self.client.send_chat_message(content):
+            # '/dm name text' sends a private message
+            parts = content.split(None, 2)
+            if parts[0] == '/dm':
+                if len(parts) < 3:
+                    self.add_system_message("Usage: /dm <username> <message>")
+                    return
+                sent = self.client.send_direct_message(parts[1], parts[2])
+                text = f"💬 You → {parts[1]}: {parts[2]}"
+            else:
+                sent = self.client.send_chat_message(content)
+                text = f"You: {content}"
+            
+            if sent:
                 self.message_entry.delete(0, tk.END)
+                # Shown straight away; 'sent' is the client ID the ack will carry
+                self.add_message(text, datetime.now().strftime('%H:%M:%S'), is_own=True, cid=sent)
             else:
                 messagebox.showerror("Error", "Failed to send message")
     
+    def on_entry_key(self, event=None):
+        """Report typing in the room; the client throttles what is sent"""
+        if not self.client or not self.client.connected or event.keysym == 'Return':
+            return
+        if self.typing_idle_job is not None:
+            self.root.after_cancel(self.typing_idle_job)
+            self.typing_idle_job = None
+        
+        content = self.message_entry.get()
+        if not content.strip() or content.startswith('/dm '):
+            self.client.stop_typing()
+            return
+        self.client.notify_typing()
+        self.typing_idle_job = self.root.after(settings.TYPING_IDLE_MS, self.client.stop_typing)
+    
+    def start_direct_message(self, event=None):
+        """Double-clicking a member starts a '/dm' to them"""
+        selection = self.members_list.curselection()
+        if not selection:
+            return
+        username = self.members_list.get(selection[0])
+        if username.endswith(" (you)"):
+            return
+        self.message_entry.delete(0, tk.END)
+        self.message_entry.insert(0, f"/dm {username} ")
+        self.message_entry.focus_set()
+        if self.client and self.client.connected:
+            self.client.request_dm_history(username)
+    
+    def search_history(self, event=None):
+        """Search all rooms; 'from:name' words filter by sender"""
+        words = self.search_entry.get().split()
+        username = None
+        terms = []
+        for word in words:
+            if word.startswith('from:') and len(word) > 5:
+                username = word[5:]
+            else:
+                terms.append(word)
+        
+        if (terms or username) and self.client and self.client.connected:
+            self.client.search(' '.join(terms), username=username)
+    
     def change_room(self):
         new_room = self.room_var.get()
         if new_room != self.current_room and self.client:
+            # Show the cached messages right away, the server sends the rest
+            cached = self.client.cached_history(new_room)
             if self.client.change_room(new_room):
                 self.current_room = new_room
+                self.show_history(cached)
+                self.show_members()
+                self.typing_label.config(text="")
                 self.add_system_message(f"Switched to #{new_room} room")
             else:
                 messagebox.showerror("Error", "Failed to change room")
@@ -408,6 +682,8 @@ class ChatGUI:
         self.status_bar.config(text=f"Status: {status}")
     
     def disconnect(self):
+        self.dispatcher.stop()
+        self.thumbnails.shutdown()
         if self.client:
             self.client.disconnect()
         self.root.quit()
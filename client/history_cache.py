@@ -0,0 +1,74 @@
+import hashlib
+import json
+import os
+import threading
+from config import settings
+
+
+class HistoryCache:
+    """Recent room messages kept on disk between room switches and sessions.
+
+    One SQLite file per user and server under HISTORY_CACHE_DIR. Messages
+    are keyed by (room, id). Live messages and history the server sends as
+    a delta extend a room, a full history replaces it. That lets the client
+    paint a room straight from the cache and ask the server only for what
+    came after the newest cached ID.
+    """
+
+    def __init__(self, username, server, cache_dir=None, limit=None):
+        import sqlite3
+        directory = os.path.expanduser(cache_dir or settings.HISTORY_CACHE_DIR)
+        os.makedirs(directory, exist_ok=True)
+        # Message IDs are per server, so each server gets its own file
+        name = hashlib.blake2b(f"{username}@{server}".encode('utf-8'), digest_size=16).hexdigest()
+        self.path = os.path.join(directory, f"{name}.sqlite3")
+        self.limit = limit or settings.HISTORY_CACHE_LIMIT
+        self._lock = threading.Lock()
+
+        # Written from the network thread, read from the Tk thread
+        self._db = sqlite3.connect(self.path, check_same_thread=False)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS messages ("
+            " room TEXT NOT NULL, id INTEGER NOT NULL, data TEXT NOT NULL,"
+            " PRIMARY KEY (room, id)) WITHOUT ROWID")
+        self._db.commit()
+
+    def recent(self, room, limit):
+        """The newest cached messages of a room, oldest first"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT data FROM messages WHERE room = ? ORDER BY id DESC LIMIT ?",
+                (room, limit)).fetchall()
+        return [json.loads(data) for data, in reversed(rows)]
+
+    def last_id(self, room):
+        with self._lock:
+            row = self._db.execute("SELECT MAX(id) FROM messages WHERE room = ?", (room,)).fetchone()
+        return row[0]
+
+    def extend(self, room, messages):
+        """Add messages that follow on from what is cached"""
+        self._write(room, messages, replace=False)
+
+    def replace(self, room, messages):
+        """Start a room over, e.g. from a full (non-delta) history"""
+        self._write(room, messages, replace=True)
+
+    def _write(self, room, messages, replace):
+        rows = [(room, message['id'], json.dumps(message)) for message in messages if 'id' in message]
+        with self._lock:
+            with self._db:
+                if replace:
+                    self._db.execute("DELETE FROM messages WHERE room = ?", (room,))
+                if rows:
+                    self._db.executemany("INSERT OR REPLACE INTO messages VALUES (?, ?, ?)", rows)
+                    # IDs are contiguous, so everything below this is beyond the limit
+                    newest = max(row[1] for row in rows)
+                    self._db.execute("DELETE FROM messages WHERE room = ? AND id <= ?",
+                                     (room, newest - self.limit))
+
+    def close(self):
+        with self._lock:
+            self._db.close()
@@ -0,0 +1,118 @@
+import threading
+import time
+from collections import deque
+from config import settings
+
+
+class SendQueue:
+    """Outgoing frames for ChatClient, written by a single writer thread.
+
+    Callers only enqueue, so the Tk thread never blocks on the network.
+    Small frames that queue up while a write is in progress are coalesced
+    into one sendall(). Bulk transfers (chunked file uploads) are queued as
+    iterators and written a chunk at a time, and any waiting chat or
+    control frames go out before the next chunk, so a message typed
+    during an upload isn't stuck behind it.
+
+    The queue starts paused; resume(sock) points it at a connected socket,
+    or at the TLSChannel of a TLS connection.
+    When a write fails, everything queued is dropped and on_error(sock) is
+    called; the client re-sends what was never acknowledged once it has
+    reconnected.
+    """
+
+    def __init__(self, on_error=None, max_batch=None):
+        self.on_error = on_error
+        self.max_batch = max_batch or settings.BUFFER_SIZE
+        self.closed = False
+        self.last_sent = 0.0  # monotonic time of the last write, for heartbeats
+        self._sock = None  # None while paused
+        self._frames = deque()  # Encoded chat and control frames
+        self._bulk = deque()  # Iterators of encoded frames
+        self._cond = threading.Condition()
+
+        writer_thread = threading.Thread(target=self._run)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def put(self, data):
+        with self._cond:
+            if self.closed:
+                return False
+            self._frames.append(data)
+            self._cond.notify()
+        return True
+
+    def put_bulk(self, frames):
+        """Queue an iterator of encoded frames, written in order"""
+        with self._cond:
+            if self.closed:
+                return False
+            self._bulk.append(iter(frames))
+            self._cond.notify()
+        return True
+
+    def resume(self, sock):
+        with self._cond:
+            self._sock = sock
+            self._cond.notify()
+
+    def pause(self):
+        """Stop writing and drop everything queued"""
+        with self._cond:
+            self._sock = None
+            self._frames.clear()
+            self._bulk.clear()
+
+    def close(self):
+        with self._cond:
+            self.closed = True
+            self._sock = None
+            self._frames.clear()
+            self._bulk.clear()
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(
+                    lambda: self.closed or (self._sock is not None and (self._frames or self._bulk)))
+                if self.closed:
+                    return
+                sock = self._sock
+                if self._frames:
+                    # Coalesce whatever is waiting, up to max_batch (at least one frame)
+                    batch = [self._frames.popleft()]
+                    size = len(batch[0])
+                    while self._frames and size + len(self._frames[0]) <= self.max_batch:
+                        size += len(self._frames[0])
+                        batch.append(self._frames.popleft())
+                    data = b''.join(batch)
+                    source = None
+                else:
+                    source = self._bulk[0]
+                    data = None
+
+            if source is not None:
+                # Chunks are encoded lazily, outside the lock
+                data = next(source, None)
+                if data is None:
+                    with self._cond:
+                        if self._bulk and self._bulk[0] is source:
+                            self._bulk.popleft()
+                    continue
+
+            try:
+                sock.sendall(data)
+                self.last_sent = time.monotonic()
+            except OSError as e:
+                if settings.DEBUG:
+                    print(f"[DEBUG] Send failed: {e}")
+                with self._cond:
+                    if self._sock is not sock:
+                        continue  # Already reconnected, this was the old socket
+                    self._sock = None
+                    self._frames.clear()
+                    self._bulk.clear()
+                if self.on_error:
+                    self.on_error(sock)
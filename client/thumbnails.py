@@ -0,0 +1,127 @@
+import base64
+import hashlib
+import os
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from config import settings
+
+
+class ThumbnailCache:
+    """Downscaled previews for image file messages.
+
+    Decoding and resizing run on worker threads so large images never block
+    the Tk loop. Results are PNG bytes keyed by a hash of the file payload,
+    kept in a small in-memory LRU and in an on-disk cache so the same image
+    is only ever decoded once. Pillow is imported on first use; without it
+    previews are simply skipped.
+    """
+
+    def __init__(self, cache_dir=None, size=None, max_items=None, workers=None):
+        self.cache_dir = os.path.expanduser(cache_dir or settings.THUMBNAIL_CACHE_DIR)
+        self.size = size or settings.THUMBNAIL_SIZE
+        self.max_items = max_items or settings.THUMBNAIL_MEMORY_ITEMS
+
+        self._memory = OrderedDict()  # {key: png_bytes}
+        self._lock = threading.Lock()
+        self.workers = workers or settings.THUMBNAIL_WORKERS
+        self._executor = None  # Created on first request
+        self._pil_available = None
+
+    @staticmethod
+    def key_for(file_data):
+        """Content hash of a base64 file payload"""
+        return hashlib.blake2b(file_data.encode('ascii'), digest_size=16).hexdigest()
+
+    def request(self, file_data, callback):
+        """Build a preview in the background
+
+        callback(png_bytes) is invoked on a worker thread, with None when no
+        preview could be made, so it must only hand the result to the UI.
+        """
+        if self._executor is None:
+            from concurrent.futures import ThreadPoolExecutor
+            self._executor = ThreadPoolExecutor(max_workers=self.workers,
+                                                thread_name_prefix='thumbnail')
+        self._executor.submit(self._build, file_data, callback)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def _build(self, file_data, callback):
+        png = None
+        try:
+            key = self.key_for(file_data)
+            png = self._get_memory(key)
+            if png is None:
+                png = self._read_disk(key)
+                if png is None:
+                    png = self._render(base64.b64decode(file_data))
+                    if png is not None:
+                        self._write_disk(key, png)
+                if png is not None:
+                    self._put_memory(key, png)
+        except Exception as e:
+            if settings.DEBUG:
+                print(f"[DEBUG] Thumbnail error: {e}")
+        callback(png)
+
+    def _get_memory(self, key):
+        with self._lock:
+            png = self._memory.get(key)
+            if png is not None:
+                self._memory.move_to_end(key)
+            return png
+
+    def _put_memory(self, key, png):
+        with self._lock:
+            self._memory[key] = png
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_items:
+                self._memory.popitem(last=False)
+
+    def _disk_path(self, key):
+        return os.path.join(self.cache_dir, key[:2], f"{key}.png")
+
+    def _read_disk(self, key):
+        try:
+            with open(self._disk_path(key), 'rb') as f:
+                return f.read()
+        except OSError:
+            return None
+
+    def _write_disk(self, key, png):
+        path = self._disk_path(key)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = f"{path}.{threading.get_ident()}.tmp"
+            with open(tmp_path, 'wb') as f:
+                f.write(png)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if settings.DEBUG:
+                print(f"[DEBUG] Thumbnail cache write failed: {e}")
+
+    def _render(self, file_bytes):
+        """Decode and downscale an image to PNG bytes"""
+        if self._pil_available is False:
+            return None
+        try:
+            from PIL import Image
+        except ImportError:
+            self._pil_available = False
+            if settings.DEBUG:
+                print("[DEBUG] Pillow not installed, image previews disabled")
+            return None
+        self._pil_available = True
+
+        with Image.open(BytesIO(file_bytes)) as image:
+            # Let JPEG decode at reduced scale instead of full resolution
+            image.draft('RGB', self.size)
+            image.thumbnail(self.size)
+            if image.mode not in ('RGB', 'RGBA'):
+                image = image.convert('RGBA')
+            out = BytesIO()
+            image.save(out, format='PNG', optimize=False)
+            return out.getvalue()
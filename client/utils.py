@@ -0,0 +1,15 @@
+# One implementation for both ends of the connection
+from server.utils import MessageDecoder  # noqa: F401
+
+
+def client_context(cafile):
+    """SSLContext for connecting to the chat server over TLS
+
+    cafile is what the client trusts, for a self-signed test server the
+    server's own certificate. ssl is imported here so plain connections
+    don't pay for loading it at startup.
+    """
+    import ssl
+    context = ssl.create_default_context(cafile=cafile)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    return context
@@ -7,16 +7,107 @@ PORT = 5050
 # =======================
 # ⚙️ Server Configuration
 # =======================
-MAX_CONNECTIONS = 10      
+MAX_CONNECTIONS = 10      # Concurrent clients, extra connections are refused
+LISTEN_BACKLOG = 128      
 BUFFER_SIZE = 65536       # Increased for file transfers
 ENCODING = 'utf-8'        
-TIMEOUT = 60       
+TIMEOUT = 60              # Seconds of silence before a connection is dropped
+HEARTBEAT_INTERVAL = 20   # Seconds of silence before sending a ping
+MAX_OUTBOUND_BYTES = 64 * 1024 * 1024   # Queued for one client before it is dropped
+SHUTDOWN_DRAIN_TIMEOUT = 5  # Seconds to flush clients' queues on shutdown
+HISTORY_LIMIT = 50        # Messages sent when joining a room
+RECENT_ACKS_LIMIT = 10000 # Client message IDs remembered to drop re-sent duplicates
+DM_OFFLINE_QUEUE_LIMIT = 500  # Direct messages kept for a user who is offline
+PRESENCE_INTERVAL = 0.25  # Seconds over which member list changes are batched
+HANDOFF_SOCKET_PATH = 'server/handoff.sock'  # Unix socket for --takeover, None disables
+HANDOFF_TIMEOUT = 30      # Seconds to wait on the other process during a handoff
+ADMIN_SOCKET_PATH = 'server/admin.sock'  # Unix socket for server/admin.py commands, None disables
+ADMIN_OUTPUT_DIR = 'server/profiles'  # Default place for profiles written by admin commands
+PROFILE_SAMPLE_INTERVAL = 0.005  # Seconds between stack samples when sampling
+PROFILE_MAX_SECONDS = 3600  # Longest profile the admin socket will start
+
+# =======================
+# 🚦 Rate Limits
+# =======================
+RATE_LIMIT_MESSAGES = 5             # Frames per second per connection
+RATE_LIMIT_BURST = 20
+ROOM_RATE_LIMIT_MESSAGES = 50       # Chat messages per second per room
+ROOM_RATE_LIMIT_BURST = 200
+RATE_LIMIT_MAX_VIOLATIONS = 50      # Dropped frames tolerated before disconnecting
+RATE_LIMIT_BAN_SECONDS = 30         # How long a disconnected abuser can't rejoin
+UPLOAD_BYTES_PER_SECOND = 512 * 1024
+UPLOAD_BURST_BYTES = 16 * 1024 * 1024
+MAX_UPLOAD_SIZE = 16 * 1024 * 1024  # Largest chunked transfer, encoded
+
+# =======================
+# 🔍 Search
+# =======================
+SEARCH_MAX_RESULTS = 100
+SEARCH_MAX_SEGMENTS = 8         # Index segments on disk before they are merged
+
+# =======================
+# 🗄️ Retention
+# =======================
+# Messages past a limit move from memory and chat_logs.json to compressed
+# archive segments (ARCHIVE_DIR); they can still be searched and paged in.
+RETENTION_MAX_AGE_DAYS = 30     # None = no age limit
+RETENTION_MAX_MESSAGES = 5000   # Kept in memory per room or conversation
+RETENTION_MAX_BYTES = 64 * 1024 * 1024   # Per room, inline files included
+ROOM_RETENTION = {}             # Per-room overrides, e.g. {'gaming': {'max_age_days': 7}}
+RETENTION_INTERVAL = 300        # Seconds between retention sweeps
+ARCHIVE_BLOCK_MESSAGES = 256    # Messages per compressed block (and smallest batch archived)
+OLDER_HISTORY_LIMIT = 100       # Most messages sent per page of older history
+
+# =======================
+# 🔁 Replication
+# =======================
+# The server streams every change to its history to followers over a
+# local socket. Start one with: python start_server.py --follow [DATA_DIR] [--port PORT]
+REPLICATION_SOCKET_PATH = 'server/replication.sock'  # Unix socket followers connect to, None disables
+REPLICA_DATA_DIR = 'server/replica'  # A follower's own history, index and archive
+REPLICA_PORT = 5051             # Port a follower serves read-only clients on
+REPLICATION_JOURNAL_ENTRIES = 100000  # Recent changes kept for followers to catch up from
+REPLICATION_JOURNAL_BYTES = 64 * 1024 * 1024  # ...and at most this many bytes of them
+REPLICATION_SYNC_BATCH = 1000   # Messages per frame when copying the whole store
+REPLICATION_HEARTBEAT = 1.0     # Seconds between heartbeats (and lag updates) when idle
+REPLICATION_TIMEOUT = 30        # Seconds before a stalled replication connection is dropped
+REPLICATION_RETRY = 1.0         # Seconds between a follower's attempts to reach the primary
+
+# =======================
+# ⌨️ Typing Indicators
+# =======================
+TYPING_SEND_INTERVAL = 3        # Seconds between a client's "still typing" frames
+TYPING_TIMEOUT = 5              # Seconds before a silent typist is dropped
+TYPING_BROADCAST_INTERVAL = 0.5 # Seconds between a room's typing updates
+TYPING_MAX_NAMES = 3            # Typists named in an update, the rest are counted
+TYPING_IDLE_MS = 2000           # Pause in typing after which the client says it stopped
+
+# =======================
+# 🔒 Encryption
+# =======================
+TLS_ENABLED = False             # Generate a test certificate with: python -m server.encryption
+TLS_CERT_FILE = 'server/certs/server.crt'
+TLS_KEY_FILE = 'server/certs/server.key'
+TLS_CA_FILE = 'server/certs/server.crt'   # What clients trust, the cert itself if self-signed
+TLS_SERVER_NAME = 'localhost'   # Name checked against the server certificate
+TLS_HANDSHAKE_TIMEOUT = 10
+TLS_SESSION_TICKETS = 2         # Issued per handshake, for resuming after a reconnect
+
+# =======================
+# 🔄 Reconnect
+# =======================
+RECONNECT_BASE_DELAY = 0.5      # Seconds, doubled after each failed attempt
+RECONNECT_MAX_DELAY = 30
+RECONNECT_MAX_ATTEMPTS = 0      # 0 = keep trying
 
 # =======================
 # 🛠️ File Paths
 # =======================
 USER_DB_PATH = 'server/user_db.json'
 CHAT_LOG_PATH = 'server/chat_logs.json'
+SEARCH_INDEX_DIR = 'server/search_index'
+SNAPSHOT_PATH = 'server/chat_snapshot.bin'   # Written on clean shutdown
+ARCHIVE_DIR = 'server/archive'  # Compressed history segments, None keeps everything in memory
 
 # =======================
 # 🧪 Debug Mode
@@ -28,3 +119,24 @@ DEBUG = True
 # =======================
 WINDOW_TITLE = "Chat App"
 WINDOW_SIZE = "500x500"
+
+# =======================
+# 🖥️ UI Dispatch
+# =======================
+UI_DISPATCH_INTERVAL_MS = 20    # How often the Tk loop drains network events
+UI_DISPATCH_BATCH = 100         # Max events handled per drain
+UI_DISPATCH_HIGH_WATER = 1000   # Queue depth reported as backpressure
+
+# =======================
+# 💾 History Cache
+# =======================
+HISTORY_CACHE_DIR = '~/.chat_app/history'   # None turns the local cache off
+HISTORY_CACHE_LIMIT = 500       # Messages kept per room
+
+# =======================
+# 🖼️ Image Previews
+# =======================
+THUMBNAIL_CACHE_DIR = '~/.chat_app/thumbnails'
+THUMBNAIL_SIZE = (240, 240)
+THUMBNAIL_MEMORY_ITEMS = 128    # Previews kept in the in-memory LRU
+THUMBNAIL_WORKERS = 2
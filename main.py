@@ -1,5 +1,18 @@
+import threading
 from client.auth import open_auth_window
-from client.gui import open_chat_window
+
+
+def open_chat_window(username):
+    # Imported on demand so the login window doesn't wait for the chat GUI
+    from client.gui import open_chat_window as open_gui
+    open_gui(username)
+
+
+def preload_chat_window():
+    """Import the chat GUI in the background while the user logs in"""
+    import client.gui  # noqa: F401
+
 
 if __name__ == "__main__":
+    threading.Thread(target=preload_chat_window, daemon=True).start()
     open_auth_window(start_chat_callback=open_chat_window)
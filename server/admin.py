@@ -0,0 +1,390 @@
+"""
+Admin control channel for a running chat server.
+
+ChatServer listens on a local Unix socket (ADMIN_SOCKET_PATH, owner-only)
+that takes one command per connection and answers in plain text. It is
+for looking inside a slow server without restarting it. Nothing here
+costs anything while switched off: handler timing and cProfile only
+wrap ChatServer.handle_message while they are on, and the sampling
+profiler is a thread that only exists while sampling.
+
+    python -m server.admin help
+    python -m server.admin timings start
+    python -m server.admin timings
+    python -m server.admin profile sample 30
+    python -m server.admin profile cprofile 10 /tmp/handlers.prof
+    python -m server.admin stacks
+    python -m server.admin --socket server/replica/admin.sock replication
+"""
+
+import cProfile
+import io
+import os
+import pstats
+import socket
+import sys
+import threading
+import time
+import traceback
+from collections import Counter
+from datetime import datetime
+
+from config import settings
+
+HELP = """Commands:
+  timings [show|start|stop|reset]        per-handler timings (join, message, change_room, ...)
+  profile sample SECONDS [PATH]          sample every thread's stack, write folded stacks
+  profile cprofile SECONDS [PATH]        cProfile message handlers, write pstats output
+  profile status | profile stop          check on or end the running profile early
+  stacks [PATH]                          current stack of every thread
+  replication                            replication status and follower lag
+  promote [force]                        make this follower the primary (failover)
+  help
+"""
+
+MAX_TIMED_TYPES = 64  # Message types are client-supplied; the rest count as 'other'
+
+
+class HandlerTimings:
+    """Count, total and worst time per message type"""
+
+    def __init__(self):
+        self.started = time.time()
+        self.stats = {}  # {msg_type: [count, total seconds, max seconds]}
+        self.lock = threading.Lock()
+
+    def record(self, msg_type, seconds):
+        with self.lock:
+            entry = self.stats.get(msg_type)
+            if entry is None:
+                if not isinstance(msg_type, str) or len(self.stats) >= MAX_TIMED_TYPES:
+                    msg_type = 'other'
+                entry = self.stats.setdefault(msg_type, [0, 0.0, 0.0])
+            entry[0] += 1
+            entry[1] += seconds
+            if seconds > entry[2]:
+                entry[2] = seconds
+
+    def report(self):
+        with self.lock:
+            rows = sorted(self.stats.items(), key=lambda item: item[1][1], reverse=True)
+            rows = [(msg_type, list(entry)) for msg_type, entry in rows]
+        lines = [f"Handler timings since {datetime.fromtimestamp(self.started):%Y-%m-%d %H:%M:%S}",
+                 f"{'type':<22} {'count':>9} {'total ms':>11} {'mean ms':>9} {'max ms':>9}"]
+        for msg_type, (count, total, worst) in rows:
+            lines.append(f"{msg_type:<22} {count:>9} {total * 1000:>11.1f} "
+                         f"{total / count * 1000:>9.3f} {worst * 1000:>9.2f}")
+        if not rows:
+            lines.append("(no messages handled yet)")
+        return "\n".join(lines) + "\n"
+
+
+class HandlerProfiler:
+    """cProfile of message handling
+
+    One profile, enabled around one handler at a time: since Python 3.12
+    cProfile sits on sys.monitoring, which takes a single profiler per
+    process. Handlers that run while another is being profiled, or while
+    some other tool holds sys.monitoring, run unprofiled and are counted.
+    """
+
+    kind = 'cprofile'
+
+    def __init__(self):
+        self.profile = cProfile.Profile()
+        self.lock = threading.Lock()
+        self.profiled = 0
+        self.skipped = 0
+
+    def runcall(self, func, *args):
+        if not self.lock.acquire(blocking=False):
+            self.skipped += 1
+            return func(*args)
+        try:
+            try:
+                self.profile.enable()
+            except ValueError:
+                # Another profiling tool is already active
+                self.skipped += 1
+                return func(*args)
+            try:
+                return func(*args)
+            finally:
+                self.profile.disable()
+                self.profiled += 1
+        finally:
+            self.lock.release()
+
+    def write(self, path):
+        """Save the stats to path; returns a short text summary"""
+        # Unhooked by now; let a call already being profiled finish first
+        if not self.lock.acquire(timeout=5):
+            return "A profiled handler is still running, nothing written\n"
+        try:
+            if not self.profiled:
+                return "No messages were handled while profiling\n"
+            stats = pstats.Stats(self.profile)
+        finally:
+            self.lock.release()
+        stats.dump_stats(path)
+
+        summary = io.StringIO()
+        summary.write(f"{self.profiled} handlers profiled, {self.skipped} ran unprofiled alongside them\n")
+        stats.stream = summary
+        stats.sort_stats('cumulative').print_stats(25)
+        return summary.getvalue()
+
+
+class StackSampler:
+    """Samples the stack of every thread at a fixed interval
+
+    Counts are kept as folded stacks ("thread;outer;...;inner count"),
+    the input format of flamegraph.pl and speedscope.
+    """
+
+    kind = 'sample'
+
+    def __init__(self, interval):
+        self.interval = interval
+        self.samples = Counter()
+        self.sample_count = 0
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self._run, name='admin-sampler')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def _run(self):
+        own = threading.get_ident()
+        while not self.stopped.wait(self.interval):
+            names = {thread.ident: thread.name for thread in threading.enumerate()}
+            for ident, frame in sys._current_frames().items():
+                if ident == own:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                stack.append(names.get(ident, str(ident)))
+                self.samples[';'.join(reversed(stack))] += 1
+            self.sample_count += 1
+
+    def write(self, path):
+        self.stopped.set()
+        self.thread.join()
+        with open(path, 'w', encoding='utf-8') as file:
+            for stack, count in self.samples.most_common():
+                file.write(f"{stack} {count}\n")
+
+        # Where the time goes, by innermost frame
+        leaves = Counter()
+        for stack, count in self.samples.items():
+            leaves[stack.rsplit(';', 1)[-1]] += count
+        total = sum(leaves.values()) or 1
+        lines = [f"{self.sample_count} samples every {self.interval * 1000:g} ms; top frames:"]
+        for frame, count in leaves.most_common(15):
+            lines.append(f"  {count * 100 / total:5.1f}%  {frame}")
+        return "\n".join(lines) + "\n"
+
+
+def thread_stacks():
+    """Current stack of every thread, like a Java thread dump"""
+    names = {thread.ident: thread.name for thread in threading.enumerate()}
+    out = []
+    for ident, frame in sys._current_frames().items():
+        out.append(f"--- {names.get(ident, ident)} ({ident}) ---\n")
+        out.extend(traceback.format_stack(frame))
+    return "".join(out)
+
+
+class AdminChannel:
+    """Serves admin commands for one ChatServer"""
+
+    def __init__(self, server):
+        self.server = server
+        self.profile = None  # (profiler, path, timer) while profiling
+        self.lock = threading.Lock()
+
+    def serve(self, path):
+        """Accept admin connections on path (runs on its own thread)"""
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            os.chmod(path, 0o600)
+            listener.listen(4)
+        except OSError as e:
+            print(f"❌ Admin socket unavailable: {e}")
+            listener.close()
+            return
+
+        while not self.server.shutting_down:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                break
+            # A command may take a while (writing a profile); don't hold up the next
+            command_thread = threading.Thread(target=self.serve_command, args=(conn,))
+            command_thread.daemon = True
+            command_thread.start()
+
+    def serve_command(self, conn):
+        try:
+            conn.settimeout(10)
+            data = b''
+            while not data.endswith(b'\n') and len(data) < 4096:
+                chunk = conn.recv(4096)
+                if not chunk:
+                    break
+                data += chunk
+            try:
+                reply = self.run(data.decode('utf-8').split())
+            except Exception as e:
+                reply = f"error: {e}\n"
+            conn.sendall(reply.encode('utf-8'))
+        except OSError:
+            pass
+        finally:
+            conn.close()
+
+    def run(self, args):
+        """Run one command; returns the text reply"""
+        if not args or args[0] == 'help':
+            return HELP
+        command, args = args[0], args[1:]
+        if command == 'timings':
+            return self.timings(args[0] if args else 'show')
+        if command == 'profile' and args:
+            if args[0] == 'status':
+                return self.profile_status()
+            if args[0] == 'stop':
+                return self.stop_profile()
+            if args[0] in ('sample', 'cprofile') and len(args) >= 2:
+                return self.start_profile(args[0], float(args[1]), args[2] if len(args) > 2 else None)
+        if command == 'stacks':
+            stacks = thread_stacks()
+            if args:
+                with open(args[0], 'w', encoding='utf-8') as file:
+                    file.write(stacks)
+                return f"Wrote stacks of {threading.active_count()} threads to {args[0]}\n"
+            return stacks
+        if command == 'replication':
+            return self.replication()
+        if command == 'promote':
+            return self.promote(force=args == ['force'])
+        return f"Unknown command: {' '.join([command] + args)}\n{HELP}"
+
+    def timings(self, action):
+        server = self.server
+        if action == 'start':
+            if server.handler_timings is None:
+                server.handler_timings = HandlerTimings()
+            return "Handler timing on\n"
+        if action == 'stop':
+            timings, server.handler_timings = server.handler_timings, None
+            return (timings.report() if timings else "") + "Handler timing off\n"
+        if action == 'reset':
+            if server.handler_timings is not None:
+                server.handler_timings = HandlerTimings()
+            return "Handler timings reset\n"
+        if server.handler_timings is None:
+            return "Handler timing is off, start it with: timings start\n"
+        return server.handler_timings.report()
+
+    def replication(self):
+        server = self.server
+        if server.follower is not None:
+            return server.follower.report()
+        if server.replication is not None:
+            return server.replication.report()
+        return "Replication is off (REPLICATION_SOCKET_PATH)\n"
+
+    def promote(self, force):
+        follower = self.server.follower
+        if follower is None:
+            return "Already a primary\n"
+        if follower.syncing and not force:
+            return ("Still copying the primary's store, so the copy is incomplete; "
+                    "'promote force' promotes it anyway\n")
+        if follower.connected and not force:
+            return "Still connected to the primary; stop it first, or 'promote force'\n"
+        self.server.promote()
+        return "Promoted to primary, now taking writes\n"
+
+    def start_profile(self, kind, seconds, path):
+        if not 0 < seconds <= settings.PROFILE_MAX_SECONDS:
+            return f"Seconds must be between 0 and {settings.PROFILE_MAX_SECONDS}\n"
+        with self.lock:
+            if self.profile is not None:
+                return f"A {self.profile[0].kind} profile is already running\n"
+            if path is None:
+                os.makedirs(settings.ADMIN_OUTPUT_DIR, exist_ok=True)
+                suffix = 'folded' if kind == 'sample' else 'prof'
+                path = os.path.join(settings.ADMIN_OUTPUT_DIR,
+                                    f"{kind}-{datetime.now():%Y%m%d-%H%M%S}.{suffix}")
+            path = os.path.abspath(path)
+
+            if kind == 'sample':
+                profiler = StackSampler(settings.PROFILE_SAMPLE_INTERVAL)
+                profiler.start()
+            else:
+                profiler = HandlerProfiler()
+                self.server.handler_profiler = profiler
+            timer = threading.Timer(seconds, self.stop_profile)
+            timer.daemon = True
+            self.profile = (profiler, path, timer)
+            timer.start()
+        return f"Profiling ({kind}) for {seconds:g}s, writing {path}\n"
+
+    def stop_profile(self):
+        with self.lock:
+            if self.profile is None:
+                return "No profile is running\n"
+            profiler, path, timer = self.profile
+            self.profile = None
+            timer.cancel()
+            if self.server.handler_profiler is profiler:
+                self.server.handler_profiler = None
+        summary = profiler.write(path)
+        print(f"📈 Wrote {profiler.kind} profile to {path}")
+        return f"Wrote {path}\n{summary}"
+
+    def profile_status(self):
+        with self.lock:
+            if self.profile is None:
+                return "No profile is running\n"
+            profiler, path, _ = self.profile
+        return f"Profiling ({profiler.kind}), writing {path} when done\n"
+
+
+def send_command(args, path=None, timeout=None):
+    """Send one admin command to a running server; returns its reply"""
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+        conn.settimeout(timeout)
+        conn.connect(path or settings.ADMIN_SOCKET_PATH)
+        conn.sendall((' '.join(args) + '\n').encode('utf-8'))
+        reply = bytearray()
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            reply += chunk
+    return reply.decode('utf-8')
+
+
+if __name__ == "__main__":
+    args = sys.argv[1:]
+    path = settings.ADMIN_SOCKET_PATH
+    if args[:1] == ['--socket'] and len(args) > 1:
+        # A follower's admin socket lives in its data directory
+        path, args = args[1], args[2:]
+    try:
+        print(send_command(args, path), end='')
+    except OSError as e:
+        print(f"❌ Can't reach the server's admin socket ({path}): {e}")
+        sys.exit(1)
@@ -0,0 +1,247 @@
+import json
+import os
+import shutil
+import threading
+import zlib
+from bisect import bisect_left, bisect_right
+from collections import OrderedDict
+from urllib.parse import quote
+
+from server.record import MessageRecord
+
+
+class Archive:
+    """Compressed, immutable segments of messages aged out of ChatStore.
+
+    Each room has a directory of segments. A segment is a run of
+    contiguous message IDs, written once as a .seg file of independently
+    zlib-compressed blocks of up to block_size JSON lines, plus a small
+    .idx file. The index is sparse: it keeps the first ID, first 'ts' and
+    byte range of each block, not of each message. Finding a message costs
+    two bisects and one block read. Recently read blocks are kept
+    decompressed for paging.
+    """
+
+    def __init__(self, directory, block_size=256, cached_blocks=32):
+        self.directory = directory
+        self.block_size = block_size
+        self.segments = {}  # {room: [index dict, ...]} in ID order
+        self.lock = threading.Lock()
+        self._blocks = OrderedDict()  # {(path, offset): [messages]}, LRU
+        self._cached_blocks = cached_blocks
+        self.load()
+
+    def _room_dir(self, room):
+        # Room names (and DM conversation keys) become safe directory names
+        return os.path.join(self.directory, quote(room, safe=''))
+
+    def load(self):
+        if not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            room_dir = os.path.join(self.directory, name)
+            indexes = []
+            for file_name in sorted(os.listdir(room_dir)):
+                # A segment without its index was never finished
+                if not file_name.endswith('.idx'):
+                    continue
+                try:
+                    with open(os.path.join(room_dir, file_name), 'r') as f:
+                        index = json.load(f)
+                except Exception:
+                    continue
+                index['path'] = os.path.join(room_dir, file_name[:-4] + '.seg')
+                indexes.append(index)
+            if indexes:
+                indexes.sort(key=lambda index: index['first_id'])
+                self.segments[indexes[0]['room']] = indexes
+
+    def next_id(self, room):
+        """One past the last archived ID of a room (0 if none)"""
+        with self.lock:
+            segments = self.segments.get(room)
+            return segments[-1]['last_id'] + 1 if segments else 0
+
+    def write(self, room, messages):
+        """Archive a run of messages that follows on from what is archived"""
+        if not messages:
+            return
+        room_dir = self._room_dir(room)
+        os.makedirs(room_dir, exist_ok=True)
+        base = f"{messages[0].id:012d}-{messages[-1].id:012d}"
+        path = os.path.join(room_dir, base + '.seg')
+
+        blocks = []
+        offset = 0
+        with open(path + '.tmp', 'wb') as f:
+            for i in range(0, len(messages), self.block_size):
+                block = messages[i:i + self.block_size]
+                data = zlib.compress(
+                    '\n'.join(message.to_json() for message in block).encode('utf-8'), 6)
+                f.write(data)
+                blocks.append([block[0].id, block[0].ts, offset, len(data)])
+                offset += len(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+
+        index = {
+            'room': room,
+            'first_id': messages[0].id,
+            'last_id': messages[-1].id,
+            'first_ts': messages[0].ts,
+            'last_ts': messages[-1].ts,
+            'blocks': blocks
+        }
+        self._commit(room_dir, base, index)
+
+    def _commit(self, room_dir, base, index):
+        index_path = os.path.join(room_dir, base + '.idx')
+        with open(index_path + '.tmp', 'w') as f:
+            json.dump(index, f)
+            f.flush()
+            os.fsync(f.fileno())
+        # The index going in place is what commits the segment
+        os.replace(index_path + '.tmp', index_path)
+
+        index = dict(index, path=os.path.join(room_dir, base + '.seg'))
+        with self.lock:
+            self.segments.setdefault(index['room'], []).append(index)
+        return index
+
+    def segment_indexes(self):
+        """{room: [index dict, ...]} of every segment, e.g. to copy them"""
+        with self.lock:
+            return {room: list(segments) for room, segments in self.segments.items()}
+
+    def read_segment(self, segment):
+        """The compressed .seg bytes of a segment"""
+        with open(segment['path'], 'rb') as f:
+            return f.read()
+
+    def add_segment(self, index, data):
+        """Install a segment copied from another archive (read_segment data)
+
+        It must follow on from what this archive holds for its room.
+        Returns its index.
+        """
+        room_dir = self._room_dir(index['room'])
+        os.makedirs(room_dir, exist_ok=True)
+        base = f"{index['first_id']:012d}-{index['last_id']:012d}"
+        path = os.path.join(room_dir, base + '.seg')
+        with open(path + '.tmp', 'wb') as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(path + '.tmp', path)
+        index = {key: value for key, value in index.items() if key != 'path'}
+        return self._commit(room_dir, base, index)
+
+    def clear(self):
+        """Delete every segment, e.g. before copying another server's"""
+        with self.lock:
+            self.segments = {}
+            self._blocks.clear()
+            shutil.rmtree(self.directory, ignore_errors=True)
+
+    def messages_in(self, segment):
+        """Every message of a segment, oldest first"""
+        for block in range(len(segment['blocks'])):
+            yield from self._read_block(segment, block)
+
+    def _read_block(self, segment, block_number):
+        _, _, offset, length = segment['blocks'][block_number]
+        key = (segment['path'], offset)
+        with self.lock:
+            messages = self._blocks.get(key)
+            if messages is not None:
+                self._blocks.move_to_end(key)
+                return messages
+        with open(segment['path'], 'rb') as f:
+            f.seek(offset)
+            data = zlib.decompress(f.read(length))
+        messages = [MessageRecord.from_dict(json.loads(line)) for line in data.decode('utf-8').split('\n')]
+        with self.lock:
+            self._blocks[key] = messages
+            while len(self._blocks) > self._cached_blocks:
+                self._blocks.popitem(last=False)
+        return messages
+
+    def _segments(self, room):
+        with self.lock:
+            return list(self.segments.get(room, ()))
+
+    def get(self, room, message_id):
+        """Look up a single archived message by ID, or None"""
+        segments = self._segments(room)
+        i = bisect_right(segments, message_id, key=lambda s: s['first_id']) - 1
+        if i < 0 or message_id > segments[i]['last_id']:
+            return None
+        segment = segments[i]
+        block = bisect_right(segment['blocks'], message_id, key=lambda b: b[0]) - 1
+        for message in self._read_block(segment, block):
+            if message.id == message_id:
+                return message
+        return None
+
+    def before(self, room, before_id, limit):
+        """Up to limit archived messages with IDs below before_id, oldest first"""
+        result = []
+        for segment in reversed(self._segments(room)):
+            if segment['first_id'] >= before_id:
+                continue
+            blocks = segment['blocks']
+            block = bisect_left(blocks, before_id, key=lambda b: b[0]) - 1
+            while block >= 0 and len(result) < limit:
+                older = [m for m in self._read_block(segment, block) if m.id < before_id]
+                result[:0] = older[-(limit - len(result)):]
+                block -= 1
+            if len(result) >= limit:
+                break
+        return result
+
+    def id_range(self, room, start_ts=None, end_ts=None):
+        """The (first_id, last_id) archived within a time window, or None
+
+        Only the blocks at either end of the window are read.
+        """
+        segments = [segment for segment in self._segments(room)
+                    if (start_ts is None or segment['last_ts'] >= start_ts) and
+                    (end_ts is None or segment['first_ts'] <= end_ts)]
+        first = last = None
+        for segment in segments:
+            first = self._first_in(segment, start_ts, end_ts)
+            if first is not None:
+                break
+        for segment in reversed(segments):
+            last = self._last_in(segment, start_ts, end_ts)
+            if last is not None:
+                break
+        return None if first is None else (first, last)
+
+    def _in_window(self, message, start_ts, end_ts):
+        return (start_ts is None or message.ts >= start_ts) and \
+            (end_ts is None or message.ts <= end_ts)
+
+    def _first_in(self, segment, start_ts, end_ts):
+        blocks = segment['blocks']
+        # The first match may sit in the block before the first one starting in the window
+        block = 0 if start_ts is None else max(0, bisect_left(blocks, start_ts, key=lambda b: b[1]) - 1)
+        for block in range(block, len(blocks)):
+            if end_ts is not None and blocks[block][1] > end_ts:
+                break
+            for message in self._read_block(segment, block):
+                if self._in_window(message, start_ts, end_ts):
+                    return message.id
+        return None
+
+    def _last_in(self, segment, start_ts, end_ts):
+        blocks = segment['blocks']
+        block = len(blocks) - 1 if end_ts is None else bisect_right(blocks, end_ts, key=lambda b: b[1]) - 1
+        for block in range(block, -1, -1):
+            for message in reversed(self._read_block(segment, block)):
+                if self._in_window(message, start_ts, end_ts):
+                    return message.id
+            if start_ts is not None and blocks[block][1] < start_ts:
+                break
+        return None
@@ -0,0 +1,138 @@
+"""
+TLS transport for the chat server.
+
+Connections are wrapped after accept() and the handshake runs on the
+client's own thread, so a slow handshake never blocks the accept loop.
+The server context keeps OpenSSL's session cache and issues TLS 1.3
+session tickets, so a reconnecting client that presents its previous
+session skips the certificate exchange and key agreement.
+
+An OpenSSL connection can't be read and written from two threads at
+once, and every connection has a reader thread and a writer thread, so
+both go through a TLSChannel that makes one SSL call at a time.
+
+For local testing generate a self-signed certificate with:
+
+    python -m server.encryption
+"""
+
+import os
+import selectors
+import socket
+import ssl
+import subprocess
+import threading
+import time
+
+from config import settings
+
+
+def server_context(certfile=None, keyfile=None):
+    """SSLContext for ChatServer, from TLS_CERT_FILE / TLS_KEY_FILE by default"""
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.minimum_version = ssl.TLSVersion.TLSv1_2
+    context.load_cert_chain(certfile or settings.TLS_CERT_FILE, keyfile or settings.TLS_KEY_FILE)
+    # Tickets a client can come back with; TLS 1.2 clients use the session cache
+    context.num_tickets = settings.TLS_SESSION_TICKETS
+    return context
+
+
+class TLSChannel:
+    """Serializes reads and writes on one SSLSocket across threads.
+
+    The socket is switched to non-blocking and every SSL call is made under
+    one lock, so a call never waits for the network while holding it: when
+    OpenSSL wants more data (or room to write) the lock is released and the
+    thread waits in select() before trying again. The socket's timeout, if
+    it had one, applies to each wait.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.timeout = sock.gettimeout()
+        self.lock = threading.Lock()
+        sock.setblocking(False)
+
+    def pending(self):
+        """Decrypted bytes recv() can return without touching the socket"""
+        with self.lock:
+            return self.sock.pending()
+
+    def recv(self, size, timeout=-1):
+        """Like socket.recv(); timeout defaults to the socket's, 0 doesn't wait"""
+        deadline = self._deadline(timeout)
+        while True:
+            with self.lock:
+                try:
+                    return self.sock.recv(size)
+                except ssl.SSLWantReadError:
+                    events = selectors.EVENT_READ
+                except ssl.SSLWantWriteError:
+                    events = selectors.EVENT_WRITE
+            self._wait(events, deadline)
+
+    def sendall(self, data):
+        view = memoryview(data).cast('B')
+        while view:
+            # A write that couldn't finish must be retried with the same bytes
+            with self.lock:
+                try:
+                    view = view[self.sock.send(view):]
+                    continue
+                except ssl.SSLWantReadError:
+                    events = selectors.EVENT_READ
+                except (ssl.SSLWantWriteError, BlockingIOError):
+                    events = selectors.EVENT_WRITE
+            self._wait(events, self._deadline(-1))
+
+    def shutdown(self, how):
+        # SSLSocket.shutdown() also drops the SSL object, after which the
+        # reader's recv() would return raw ciphertext; shut the transport only
+        with self.lock:
+            socket.socket.shutdown(self.sock, how)
+
+    def close(self):
+        with self.lock:
+            self.sock.close()
+
+    def _deadline(self, timeout):
+        if timeout == -1:
+            timeout = self.timeout
+        return None if timeout is None else time.monotonic() + timeout
+
+    def _wait(self, events, deadline):
+        timeout = None if deadline is None else deadline - time.monotonic()
+        if timeout is not None and timeout <= 0:
+            raise socket.timeout('timed out')
+        with selectors.DefaultSelector() as selector:
+            try:
+                selector.register(self.sock, events)
+            except ValueError:
+                raise OSError("Socket is closed") from None
+            if not selector.select(timeout):
+                raise socket.timeout('timed out')
+
+
+def generate_self_signed(certfile=None, keyfile=None, hostname='localhost', days=365):
+    """Create a self-signed certificate for hostname and 127.0.0.1 with openssl"""
+    certfile = certfile or settings.TLS_CERT_FILE
+    keyfile = keyfile or settings.TLS_KEY_FILE
+    for path in (certfile, keyfile):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+
+    subprocess.run([
+        'openssl', 'req', '-x509', '-newkey', 'ec', '-pkeyopt', 'ec_paramgen_curve:prime256v1',
+        '-nodes', '-keyout', keyfile, '-out', certfile, '-days', str(days),
+        '-subj', f'/CN={hostname}',
+        '-addext', f'subjectAltName=DNS:{hostname},DNS:localhost,IP:127.0.0.1'
+    ], check=True, capture_output=True)
+    os.chmod(keyfile, 0o600)
+    return certfile, keyfile
+
+
+if __name__ == "__main__":
+    cert, key = generate_self_signed()
+    print(f"🔒 Wrote {cert} and {key}")
+    print("Set TLS_ENABLED = True in config/settings.py to use them")
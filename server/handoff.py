@@ -0,0 +1,64 @@
+import json
+import socket
+import struct
+
+MAX_FDS_PER_MESSAGE = 250  # Linux accepts at most 253 per SCM_RIGHTS message
+TAKEOVER_REQUEST = b'TAKEOVER\n'
+
+
+def supported():
+    return hasattr(socket, 'AF_UNIX') and hasattr(socket, 'send_fds')
+
+
+def send_handoff(conn, state, fds):
+    """Send server state and file descriptors to the process taking over
+
+    The state is length-prefixed JSON; the descriptors follow in batches,
+    each attached (SCM_RIGHTS) to a one-byte message. Returns True once the
+    new process confirms it is serving.
+    """
+    payload = json.dumps(dict(state, fd_count=len(fds))).encode('utf-8')
+    conn.sendall(struct.pack('!Q', len(payload)) + payload)
+    for i in range(0, len(fds), MAX_FDS_PER_MESSAGE):
+        socket.send_fds(conn, [b'F'], fds[i:i + MAX_FDS_PER_MESSAGE])
+    return _recv_exact(conn, 2) == b'OK'
+
+
+def request_handoff(path, timeout):
+    """Ask the server listening on path to hand over its sockets
+
+    Returns (state, fds, conn). The caller must call confirm_handoff(conn)
+    once it is serving, which lets the old process exit.
+    """
+    conn = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    conn.settimeout(timeout)
+    conn.connect(path)
+    conn.sendall(TAKEOVER_REQUEST)
+
+    length, = struct.unpack('!Q', _recv_exact(conn, 8))
+    state = json.loads(_recv_exact(conn, length).decode('utf-8'))
+
+    fds = []
+    while len(fds) < state['fd_count']:
+        data, new_fds, _, _ = socket.recv_fds(conn, 1, MAX_FDS_PER_MESSAGE)
+        if not data:
+            raise ConnectionError("Server closed the handoff channel early")
+        fds.extend(new_fds)
+    return state, fds, conn
+
+
+def confirm_handoff(conn):
+    try:
+        conn.sendall(b'OK')
+    finally:
+        conn.close()
+
+
+def _recv_exact(conn, size):
+    data = bytearray()
+    while len(data) < size:
+        chunk = conn.recv(size - len(data))
+        if not chunk:
+            raise ConnectionError("Handoff channel closed")
+        data += chunk
+    return bytes(data)
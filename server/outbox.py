@@ -0,0 +1,82 @@
+import threading
+from collections import deque
+from config import settings
+
+
+class Outbox:
+    """Send queue for one client connection, drained by its own writer thread.
+
+    Broadcasting only appends encoded frames here, so one slow or dead
+    client can't stall the thread that is broadcasting, and frames from
+    different threads are never interleaved on the socket. Frames queued
+    while a write is in progress are coalesced into the next sendall().
+    On a TLS connection writes go through its TLSChannel, so they never
+    run alongside the reader's recv().
+    """
+
+    def __init__(self, sock, on_error=None, max_bytes=None, channel=None):
+        self.sock = sock
+        self.channel = channel
+        self.on_error = on_error
+        self.max_bytes = max_bytes or settings.MAX_OUTBOUND_BYTES
+        self.queued_bytes = 0
+        self.closed = False
+        self._frames = deque()
+        self._writing = False
+        self._cond = threading.Condition()
+
+        writer_thread = threading.Thread(target=self._run)
+        writer_thread.daemon = True
+        writer_thread.start()
+
+    def put(self, data):
+        """Queue encoded bytes; False if closed or the client is too far behind"""
+        with self._cond:
+            if self.closed:
+                return False
+            # A single oversized frame (e.g. a big history) is still allowed
+            if self._frames and self.queued_bytes + len(data) > self.max_bytes:
+                return False
+            self._frames.append(data)
+            self.queued_bytes += len(data)
+            self._cond.notify()
+        return True
+
+    def drain(self, timeout=None):
+        """Wait until everything queued has been written; True if it was"""
+        with self._cond:
+            return self._cond.wait_for(
+                lambda: self.closed or (not self._frames and not self._writing), timeout)
+
+    def close(self):
+        """Stop the writer; anything still queued is dropped"""
+        with self._cond:
+            self.closed = True
+            self._frames.clear()
+            self.queued_bytes = 0
+            self._cond.notify_all()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                self._cond.wait_for(lambda: self.closed or self._frames)
+                if self.closed:
+                    return
+                batch = b''.join(self._frames)
+                self._frames.clear()
+                self.queued_bytes = 0
+                self._writing = True
+
+            try:
+                (self.channel or self.sock).sendall(batch)
+            except OSError as e:
+                if settings.DEBUG:
+                    print(f"[DEBUG] Write failed: {e}")
+                self.close()
+                if self.on_error:
+                    self.on_error(self.sock)
+                return
+            finally:
+                with self._cond:
+                    self._writing = False
+                    self._cond.notify_all()
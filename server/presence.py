@@ -0,0 +1,99 @@
+import threading
+
+
+class Presence:
+    """Who is in each room, published to clients as versioned diffs.
+
+    Joins and leaves only update the live session counts and mark the user
+    as changed. flush() runs every PRESENCE_INTERVAL and turns everything
+    that changed in a room into one diff, so a burst of joins and leaves
+    costs each member a single frame instead of one per event, and a user
+    who leaves and comes back in between isn't reported at all. A user with
+    several sessions in a room is listed once.
+    """
+
+    def __init__(self, rooms):
+        self.lock = threading.Lock()
+        self.sessions = {room: {} for room in rooms}  # {room: {username: open sessions}}
+        self.published = {room: set() for room in rooms}  # Members as of versions[room]
+        self.versions = {room: 0 for room in rooms}
+        self.changed = {room: set() for room in rooms}
+
+    def join(self, room, username):
+        with self.lock:
+            sessions = self.sessions[room]
+            sessions[username] = sessions.get(username, 0) + 1
+            self.changed[room].add(username)
+
+    def leave(self, room, username):
+        with self.lock:
+            sessions = self.sessions[room]
+            if sessions.get(username, 0) > 1:
+                sessions[username] -= 1
+            else:
+                sessions.pop(username, None)
+            self.changed[room].add(username)
+
+    def snapshot(self, room):
+        """Full member list of a room, as of its current version"""
+        with self.lock:
+            return {
+                'type': 'members',
+                'room': room,
+                'version': self.versions[room],
+                'members': sorted(self.published[room])
+            }
+
+    def flush(self):
+        """Publish pending changes, returning one diff frame per changed room
+
+        A client applies a diff only if its 'base' is the version it holds;
+        otherwise it asks for a fresh snapshot.
+        """
+        diffs = []
+        with self.lock:
+            for room, changed in self.changed.items():
+                if not changed:
+                    continue
+                sessions = self.sessions[room]
+                published = self.published[room]
+                joined = sorted(name for name in changed if name in sessions and name not in published)
+                left = sorted(name for name in changed if name not in sessions and name in published)
+                changed.clear()
+                if not joined and not left:
+                    continue
+
+                published.difference_update(left)
+                published.update(joined)
+                base = self.versions[room]
+                self.versions[room] = base + 1
+                diffs.append({
+                    'type': 'presence',
+                    'room': room,
+                    'base': base,
+                    'version': base + 1,
+                    'joined': joined,
+                    'left': left
+                })
+        return diffs
+
+    def export_state(self):
+        """Published members and versions, for a socket handoff"""
+        with self.lock:
+            return {
+                'versions': dict(self.versions),
+                'published': {room: sorted(members) for room, members in self.published.items()}
+            }
+
+    def restore_state(self, state):
+        """Continue the version sequence of the previous server process
+
+        Sessions are re-added by join() as connections are adopted, so
+        the next flush only reports what changed during the handoff.
+        """
+        with self.lock:
+            for room, version in state['versions'].items():
+                if room in self.versions:
+                    self.versions[room] = version
+                    self.published[room] = set(state['published'].get(room, ()))
+                    self.changed[room].update(self.published[room])
@@ -0,0 +1,52 @@
+import threading
+import time
+from config import settings
+
+
+class TokenBucket:
+    """Token bucket: refills at rate tokens per second, holds at most burst"""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, amount=1):
+        """Take amount tokens; return 0 on success or seconds until they'd be available"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= amount:
+                self.tokens -= amount
+                return 0
+            if amount > self.capacity:
+                return float('inf')
+            return (amount - self.tokens) / self.rate
+
+    def full_in(self):
+        """Seconds until the bucket is full again"""
+        with self.lock:
+            tokens = min(self.capacity, self.tokens + (time.monotonic() - self.updated) * self.rate)
+            return (self.capacity - tokens) / self.rate
+
+
+class ConnectionLimits:
+    """Budgets for a single client connection, or for a user across reconnects
+
+    key is the (username, host) a user's budgets belong to, None for a
+    connection that hasn't joined.
+    """
+
+    def __init__(self, key=None):
+        self.key = key
+        self.frames = TokenBucket(settings.RATE_LIMIT_MESSAGES, settings.RATE_LIMIT_BURST)
+        self.upload = TokenBucket(settings.UPLOAD_BYTES_PER_SECOND, settings.UPLOAD_BURST_BYTES)
+        # Refills one per second, a client that keeps ignoring errors runs it dry
+        self.violations = TokenBucket(1, settings.RATE_LIMIT_MAX_VIOLATIONS)
+
+    def full_in(self):
+        """Seconds until every budget is full again, after which it can be forgotten"""
+        return max(self.frames.full_in(), self.upload.full_in(), self.violations.full_in())
@@ -0,0 +1,213 @@
+import json
+import sys
+import time
+from functools import lru_cache
+
+_encode_str = json.encoder.encode_basestring_ascii  # What json.dumps uses for str, in C
+
+# Fields in the order they appear on the wire, as the dicts used to have them
+FIELDS = ('username', 'to', 'content', 'file_name', 'file_type', 'file_data', 'file_size', 'id', 'ts')
+OPTIONAL = ('to', 'content', 'file_name', 'file_type', 'file_data', 'file_size')
+KNOWN_KEYS = frozenset(FIELDS + ('timestamp',))
+
+
+@lru_cache(maxsize=1024)
+def _utc_offset(hour):
+    """Local UTC offset in seconds during an epoch hour"""
+    return time.localtime(hour * 3600).tm_gmtoff
+
+
+_HOURS_MINUTES = [f'{minute // 60:02d}:{minute % 60:02d}' for minute in range(24 * 60)]
+_SECONDS = [f':{second:02d}' for second in range(60)]
+
+
+def clock_time(ts_seconds):
+    """'HH:MM:SS' local time of an epoch second (strftime is too slow per message)"""
+    t = (ts_seconds + _utc_offset(ts_seconds // 3600)) % 86400
+    return _HOURS_MINUTES[t // 60] + _SECONDS[t % 60]
+
+
+@lru_cache(maxsize=1024)
+def _encoded_name(name):
+    return _encode_str(name)
+
+
+def _encode(value):
+    return _encode_str(value) if isinstance(value, str) else json.dumps(value)
+
+
+class RawJSON(str):
+    """Text that is already JSON, inserted as is by encode_frame()"""
+
+
+class MessageRecord:
+    """A stored message, without a per-message dict.
+
+    Fields live in __slots__, None for ones the message doesn't have.
+    Usernames and file types are interned, and the 'timestamp' shown to
+    users is derived from the integer 'ts' rather than kept as a string
+    (a legacy one that doesn't match is kept in 'extra').
+
+    Records read like the dicts they replace: message['id'],
+    message.get('content'), message.items() and {**message} all work, and
+    to_json() writes the same JSON json.dumps would for the dict without
+    building one.
+    """
+
+    __slots__ = FIELDS + ('extra',)
+
+    def __init__(self, username, id, ts, to=None, content=None, file_name=None, file_type=None,
+                 file_data=None, file_size=None, timestamp=None, extra=None):
+        self.username = sys.intern(username)
+        self.id = id
+        self.ts = ts
+        self.to = sys.intern(to) if to is not None else None
+        self.content = content
+        self.file_name = file_name
+        self.file_type = sys.intern(file_type) if file_type is not None else None
+        self.file_data = file_data
+        self.file_size = file_size
+        if timestamp is not None and timestamp != clock_time(ts // 1000):
+            extra = dict(extra or (), timestamp=timestamp)
+        self.extra = extra
+
+    @classmethod
+    def from_dict(cls, message):
+        """Build a record from a message dict that has its 'id' and 'ts'"""
+        if message.keys() <= KNOWN_KEYS:
+            try:
+                return cls(**message)
+            except TypeError:
+                pass  # e.g. a username that isn't a string
+        fields = {}
+        extra = {}
+        for key, value in message.items():
+            if key in KNOWN_KEYS and (key not in ('username', 'to', 'file_type') or isinstance(value, str)):
+                fields[key] = value
+            else:
+                extra[key] = value
+        return cls(extra=extra or None, **fields)
+
+    def __reduce__(self):
+        # Pickled as a constructor call on a tuple, not a dict of slots
+        return (MessageRecord, (self.username, self.id, self.ts, self.to, self.content, self.file_name,
+                                self.file_type, self.file_data, self.file_size, None, self.extra))
+
+    @property
+    def timestamp(self):
+        if self.extra is not None and 'timestamp' in self.extra:
+            return self.extra['timestamp']
+        return clock_time(self.ts // 1000)
+
+    def size(self):
+        """Rough bytes held, dominated by content and file data"""
+        size = 64
+        for value in (self.content, self.file_name, self.file_data):
+            if isinstance(value, str):
+                size += len(value)
+        return size
+
+    # Mapping interface, so code written for message dicts keeps working
+
+    def __getitem__(self, key):
+        if key in FIELDS:
+            value = getattr(self, key)
+            if value is not None:
+                return value
+        elif key == 'timestamp':
+            return self.timestamp
+        elif self.extra is not None and key in self.extra:
+            return self.extra[key]
+        raise KeyError(key)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def __contains__(self, key):
+        try:
+            self[key]
+        except KeyError:
+            return False
+        return True
+
+    def keys(self):
+        return [key for key, _ in self.items()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def values(self):
+        return [value for _, value in self.items()]
+
+    def items(self):
+        items = [(field, getattr(self, field)) for field in FIELDS if getattr(self, field) is not None]
+        items.append(('timestamp', self.timestamp))
+        if self.extra is not None:
+            items.extend((key, value) for key, value in self.extra.items() if key != 'timestamp')
+        return items
+
+    def to_dict(self):
+        return dict(self.items())
+
+    def __eq__(self, other):
+        if isinstance(other, (MessageRecord, dict)):
+            return dict(self.items()) == dict(other.items())
+        return NotImplemented
+
+    def __repr__(self):
+        return f"MessageRecord({self.to_dict()!r})"
+
+    def to_json(self, **head):
+        """This message as a JSON object, after the keys in head
+
+        to_json(type='message', room='general') gives the same text as
+        json.dumps({'type': 'message', 'room': 'general', **message}).
+        """
+        prefix = ''.join(f'{_encode_str(key)}: {_encode(value)}, ' for key, value in head.items())
+        content = self.content
+        if (self.to is None and self.file_name is None and self.extra is None
+                and content.__class__ is str):
+            # A plain chat message, by far the most common
+            return (f'{{{prefix}"username": {_encoded_name(self.username)}, '
+                    f'"content": {_encode_str(content)}, "id": {self.id}, "ts": {self.ts}, '
+                    f'"timestamp": "{clock_time(self.ts // 1000)}"}}')
+
+        parts = [f'"username": {_encoded_name(self.username)}']
+        for field in OPTIONAL:
+            value = getattr(self, field)
+            if value is not None:
+                parts.append(f'"{field}": {_encode(value)}')
+        parts.append(f'"id": {self.id}, "ts": {self.ts}, "timestamp": {_encode(self.timestamp)}')
+        if self.extra is not None:
+            parts.extend(f'{_encode(key)}: {json.dumps(value)}'
+                         for key, value in self.extra.items() if key != 'timestamp')
+        return '{' + prefix + ', '.join(parts) + '}'
+
+
+def encode_frame(frame):
+    """json.dumps for a frame whose values may hold records, e.g. 'messages'"""
+    parts = []
+    for key, value in frame.items():
+        if isinstance(value, RawJSON):
+            encoded = value
+        elif isinstance(value, MessageRecord):
+            encoded = value.to_json()
+        elif isinstance(value, list) and value and isinstance(value[0], MessageRecord):
+            encoded = '[' + ', '.join(
+                item.to_json() if isinstance(item, MessageRecord) else json.dumps(item)
+                for item in value) + ']'
+        else:
+            encoded = _encode(value)
+        parts.append(f'{_encode_str(key)}: {encoded}')
+    return '{' + ', '.join(parts) + '}'
+
+
+def with_head(message_json, **head):
+    """Put keys in front of an encoded message, like to_json(**head)"""
+    return '{' + ''.join(f'{_encode_str(key)}: {_encode(value)}, ' for key, value in head.items()) + message_json[1:]
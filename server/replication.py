@@ -0,0 +1,411 @@
+"""
+Hot-standby replication of the chat store.
+
+A primary ChatServer numbers every change to its store (a message stored,
+or a run of messages moved to the archive) with a log sequence number
+(LSN) and keeps the recent ones in a Journal. Followers connect to
+REPLICATION_SOCKET_PATH, a local Unix socket, and are streamed the
+journal as newline-delimited JSON. A follower that is new, or too far
+behind for the journal to cover, is first sent a copy of the whole
+store: archive segments as they are on disk, then the hot history.
+
+A follower is a ChatServer of its own with separate files and port
+(python start_server.py --follow [DATA_DIR] [--port PORT]). It applies
+changes as they come, passes new messages on to its own clients, and
+answers history and search requests, but refuses to store anything
+itself. For failover it can be promoted to a primary from its admin
+socket (python -m server.admin --socket DATA_DIR/admin.sock promote);
+other followers then copy the new primary from scratch.
+
+Replication is asynchronous: the primary never waits on a follower.
+How far behind each one is shows in the 'replication' admin command:
+in LSNs, and in seconds of the primary's history the follower's copy
+is known to be missing.
+"""
+
+import base64
+import json
+import os
+import socket
+import threading
+import time
+from collections import deque
+from itertools import islice
+
+from config import settings
+from server.record import RawJSON, encode_frame
+
+
+def use_follower_paths(data_dir, port):
+    """Point this process's files and port away from the primary's"""
+    if os.path.abspath(data_dir) == os.path.abspath(os.path.dirname(settings.CHAT_LOG_PATH)):
+        raise ValueError(f"A follower needs a data directory of its own, not {data_dir}")
+    os.makedirs(data_dir, exist_ok=True)
+    settings.CHAT_LOG_PATH = os.path.join(data_dir, 'chat_logs.json')
+    settings.SEARCH_INDEX_DIR = os.path.join(data_dir, 'search_index')
+    settings.SNAPSHOT_PATH = os.path.join(data_dir, 'chat_snapshot.bin')
+    if settings.ARCHIVE_DIR:
+        settings.ARCHIVE_DIR = os.path.join(data_dir, 'archive')
+    if settings.ADMIN_SOCKET_PATH:
+        settings.ADMIN_SOCKET_PATH = os.path.join(data_dir, 'admin.sock')
+    settings.HANDOFF_SOCKET_PATH = None  # A takeover would start a primary
+    settings.PORT = port
+
+
+def _line(frame):
+    return (encode_frame(frame) + '\n').encode('utf-8')
+
+
+class Journal:
+    """Recent store changes, encoded and numbered, for followers to read
+
+    Holds at most max_entries changes and max_bytes of them; a follower
+    that needs an older one has to copy the whole store instead. The
+    epoch tells one primary process's LSNs from another's.
+    """
+
+    def __init__(self, max_entries, max_bytes):
+        self.epoch = os.urandom(8).hex()
+        self.lsn = 0
+        self.entries = deque()  # (lsn, encoded line)
+        self.size = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.cond = threading.Condition()
+
+    def record(self, kind, **fields):
+        """Add one change; called under the store lock, so in store order"""
+        with self.cond:
+            self.lsn += 1
+            line = _line({'type': kind, 'lsn': self.lsn, 'time': time.time(), **fields})
+            self.entries.append((self.lsn, line))
+            self.size += len(line)
+            while len(self.entries) > self.max_entries or (self.size > self.max_bytes and len(self.entries) > 1):
+                self.size -= len(self.entries.popleft()[1])
+            self.cond.notify_all()
+
+    def first_lsn(self):
+        with self.cond:
+            return self.entries[0][0] if self.entries else self.lsn + 1
+
+    def covers(self, lsn):
+        """Whether every change after lsn is still kept"""
+        return isinstance(lsn, int) and self.first_lsn() - 1 <= lsn <= self.lsn
+
+    def wait(self, after, timeout):
+        """Encoded changes after LSN 'after', waiting up to timeout for one
+
+        Returns None once they are no longer all kept.
+        """
+        with self.cond:
+            self.cond.wait_for(lambda: self.lsn > after, timeout)
+            first = self.entries[0][0] if self.entries else self.lsn + 1
+            if after + 1 < first:
+                return None
+            return [line for _, line in islice(self.entries, after + 1 - first, None)]
+
+
+class ReplicationPrimary:
+    """Streams a ChatServer's store to followers"""
+
+    def __init__(self, server):
+        self.server = server
+        self.store = server.store
+        self.journal = Journal(settings.REPLICATION_JOURNAL_ENTRIES, settings.REPLICATION_JOURNAL_BYTES)
+        self.followers = {}  # {connection: status dict}
+        self.lock = threading.Lock()
+        self.store.on_append.append(self.record_append)
+        self.store.on_archive.append(self.record_archive)
+
+    def record_append(self, room, message):
+        self.journal.record('append', room=room, message=RawJSON(self.store.message_json(room, message)))
+
+    def record_archive(self, room, last_id):
+        self.journal.record('archive', room=room, last_id=last_id)
+
+    def serve(self, path):
+        """Accept followers on path (runs on its own thread)"""
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            os.chmod(path, 0o600)
+            listener.listen(4)
+        except OSError as e:
+            print(f"❌ Replication socket unavailable: {e}")
+            listener.close()
+            return
+        print(f"🔁 Serving followers on {path}")
+
+        while not self.server.shutting_down:
+            try:
+                conn, _ = listener.accept()
+            except OSError:
+                break
+            follower_thread = threading.Thread(target=self.serve_follower, args=(conn,), name='replication-sender')
+            follower_thread.daemon = True
+            follower_thread.start()
+
+    def serve_follower(self, conn):
+        """Bring one follower up to date, then stream it every change"""
+        status = {'name': '?', 'acked_lsn': None, 'lag': None, 'ack_time': time.monotonic(), 'syncs': 0,
+                  'closed': False}
+        try:
+            conn.settimeout(settings.REPLICATION_TIMEOUT)
+            hello = json.loads(conn.makefile('rb').readline())
+            status['name'] = str(hello.get('name'))[:64]
+            with self.lock:
+                self.followers[conn] = status
+            print(f"🔁 Follower connected: {status['name']}")
+
+            ack_thread = threading.Thread(target=self.read_acks, args=(conn, status), name='replication-acks')
+            ack_thread.daemon = True
+            ack_thread.start()
+
+            sent = None
+            if hello.get('epoch') == self.journal.epoch and self.journal.covers(hello.get('lsn')):
+                sent = hello['lsn']
+            while not (self.server.shutting_down or status['closed']):
+                if sent is None:
+                    sent = self.send_store(conn)
+                    status['syncs'] += 1
+                lines = self.journal.wait(sent, settings.REPLICATION_HEARTBEAT)
+                if lines is None:
+                    print(f"⚠️ Follower {status['name']} fell out of the journal, copying the store again")
+                    sent = None
+                    continue
+                sent += len(lines)
+                # Every batch ends with a heartbeat, which the follower acknowledges
+                lines.append(_line({'type': 'heartbeat', 'lsn': self.journal.lsn, 'time': time.time()}))
+                conn.sendall(b''.join(lines))
+        except (OSError, ValueError) as e:
+            if not self.server.shutting_down:
+                print(f"🔌 Follower {status['name']} disconnected: {e}")
+        finally:
+            with self.lock:
+                self.followers.pop(conn, None)
+            conn.close()
+
+    def send_store(self, conn):
+        """Send a copy of the whole store; returns the LSN it is current to"""
+        store = self.store
+        with store.lock:
+            # Changes are journalled under the store lock, so nothing can
+            # come between this LSN and the copy
+            lsn = self.journal.lsn
+            history = {room: list(messages) for room, messages in store.history.items()}
+            first_ids = {room: messages[0].id if messages else store.next_ids[room]
+                         for room, messages in history.items()}
+            segments = store.archive.segment_indexes() if store.archive is not None else {}
+
+        conn.sendall(_line({'type': 'snapshot', 'epoch': self.journal.epoch, 'lsn': lsn,
+                            'time': time.time(), 'first_ids': first_ids}))
+        for indexes in segments.values():
+            for index in indexes:
+                conn.sendall(_line({
+                    'type': 'segment',
+                    'index': {key: value for key, value in index.items() if key != 'path'},
+                    'data': base64.b64encode(store.archive.read_segment(index)).decode('ascii')
+                }))
+        batch = settings.REPLICATION_SYNC_BATCH
+        for room, messages in history.items():
+            for i in range(0, len(messages), batch):
+                conn.sendall(_line({'type': 'messages', 'room': room,
+                                    'messages': store.encode(room, messages[i:i + batch])}))
+        conn.sendall(_line({'type': 'snapshot_end', 'lsn': lsn}))
+        return lsn
+
+    def read_acks(self, conn, status):
+        """Track what a follower has applied, from its acks"""
+        buffered = b''
+        while True:
+            try:
+                chunk = conn.recv(4096)
+            except socket.timeout:
+                continue  # Busy copying the store, the sender notices a dead peer
+            except OSError:
+                break
+            if not chunk:
+                break
+            *lines, buffered = (buffered + chunk).split(b'\n')
+            for line in lines:
+                try:
+                    ack = json.loads(line)
+                except ValueError:
+                    continue
+                status['acked_lsn'] = ack.get('lsn')
+                status['lag'] = ack.get('lag')
+                status['ack_time'] = time.monotonic()
+        status['closed'] = True
+        try:
+            conn.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+
+    def report(self):
+        journal = self.journal
+        with self.lock:
+            followers = [dict(status) for status in self.followers.values()]
+        lines = [f"Primary, epoch {journal.epoch}, LSN {journal.lsn} "
+                 f"(journal keeps {journal.first_lsn()}-{journal.lsn}, {journal.size / 1024:.0f} KB)",
+                 f"{'follower':<28} {'acked':>9} {'behind':>8} {'lag s':>8} {'ack age s':>10} {'syncs':>6}"]
+        now = time.monotonic()
+        for status in followers:
+            acked = status['acked_lsn']
+            behind = journal.lsn - acked if isinstance(acked, int) else '-'
+            lag = f"{status['lag']:.2f}" if isinstance(status['lag'], (int, float)) else '-'
+            lines.append(f"{status['name']:<28} {acked if acked is not None else '-':>9} {behind:>8} "
+                         f"{lag:>8} {now - status['ack_time']:>10.1f} {status['syncs']:>6}")
+        if not followers:
+            lines.append("(no followers connected)")
+        return "\n".join(lines) + "\n"
+
+
+class ReplicationFollower:
+    """Keeps a ChatServer's store a copy of a primary's"""
+
+    def __init__(self, server, path):
+        self.server = server
+        self.store = server.store
+        self.path = path
+        self.name = f"pid {os.getpid()}, port {server.port}"
+        self.epoch = None  # Of the primary copied, None until a copy is complete
+        self.sync_epoch = None  # Of the primary being copied
+        self.applied_lsn = 0
+        self.applied_time = None  # Primary's clock when the last applied change was made
+        self.primary_lsn = 0  # As of the last heartbeat
+        self.heartbeat_time = None
+        self.connected = False
+        self.syncing = False  # The store is half copied
+        self.conn = None
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='replication-follower')
+        self.thread.daemon = True
+
+    def start(self):
+        self.thread.start()
+
+    def stop(self):
+        """Stop applying changes, e.g. to be promoted"""
+        self.stopped.set()
+        conn = self.conn
+        if conn is not None:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        if self.thread.is_alive() and threading.current_thread() is not self.thread:
+            self.thread.join(settings.REPLICATION_TIMEOUT)
+
+    def run(self):
+        """Follow the primary, reconnecting whenever the connection drops"""
+        warned = False
+        while not self.stopped.is_set():
+            try:
+                self.replicate()
+                error = "connection closed"
+            except OSError as e:
+                error = str(e)
+            except Exception as e:
+                # A bad frame, or one that failed to apply: the copy can't
+                # be trusted, start over rather than stop following
+                print(f"⚠️ Replication error ({type(e).__name__}: {e}), copying the primary's store again")
+                self.epoch = None
+                error = str(e)
+            if self.stopped.is_set():
+                break
+            if self.connected or not warned:
+                print(f"🔌 No connection to the primary ({error}), retrying...")
+                warned = True
+            self.connected = False
+            self.stopped.wait(settings.REPLICATION_RETRY)
+
+    def replicate(self):
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as conn:
+            conn.settimeout(settings.REPLICATION_TIMEOUT)
+            conn.connect(self.path)
+            self.conn = conn
+            if self.stopped.is_set():
+                return
+            conn.sendall(_line({'type': 'hello', 'name': self.name, 'epoch': self.epoch,
+                                'lsn': self.applied_lsn}))
+            self.connected = True
+            print(f"🔁 Following the primary on {self.path}")
+            for line in conn.makefile('rb'):
+                if self.stopped.is_set():
+                    break
+                self.apply(json.loads(line), conn)
+
+    def apply(self, frame, conn):
+        kind = frame['type']
+        store = self.store
+        if kind == 'append':
+            message = store.insert(frame['room'], frame['message'])
+            if message is not None and not self.syncing:
+                self.server.deliver(frame['room'], message)
+            self.applied(frame)
+            if store.unsaved >= 10:
+                self.server.save_chat_history()
+        elif kind == 'archive':
+            store.archive_through(frame['room'], frame['last_id'])
+            self.applied(frame)
+        elif kind == 'heartbeat':
+            self.primary_lsn = frame['lsn']
+            self.heartbeat_time = frame['time']
+            _, lag = self.lag()
+            conn.sendall(_line({'type': 'ack', 'lsn': self.applied_lsn, 'lag': lag}))
+        elif kind == 'snapshot':
+            print("📥 Copying the primary's store...")
+            self.syncing = True
+            self.epoch = None
+            self.server.search_index.clear()
+            if store.archive is not None:
+                store.archive.clear()
+            store.reset(frame['first_ids'])
+            self.sync_epoch = frame['epoch']
+            self.applied_time = frame['time']
+        elif kind == 'segment':
+            if store.archive is not None:
+                segment = store.archive.add_segment(frame['index'], base64.b64decode(frame['data']))
+                # Searchable here too; the index only takes IDs in order,
+                # and archived messages come before the hot ones
+                for message in store.archive.messages_in(segment):
+                    self.server.search_index.add(segment['room'], message)
+        elif kind == 'messages':
+            for message in frame['messages']:
+                store.insert(frame['room'], message)
+        elif kind == 'snapshot_end':
+            self.applied_lsn = frame['lsn']
+            self.epoch = self.sync_epoch
+            self.syncing = False
+            self.server.save_chat_history()
+            sizes = sum(len(messages) for messages in store.history.values())
+            print(f"✅ Copied the primary's store ({sizes} messages in memory) at LSN {self.applied_lsn}")
+
+    def applied(self, frame):
+        self.applied_lsn = frame['lsn']
+        self.applied_time = frame['time']
+
+    def lag(self):
+        """(changes, seconds) this copy is behind the primary, or (None, None)
+
+        The copy is known to be current as of the last heartbeat it had
+        caught up with, or else as of the last change applied.
+        """
+        if self.heartbeat_time is None or self.syncing:
+            return None, None
+        behind = max(0, self.primary_lsn - self.applied_lsn)
+        as_of = self.applied_time if behind else self.heartbeat_time
+        return behind, max(0.0, round(time.time() - as_of, 3))
+
+    def report(self):
+        behind, lag = self.lag()
+        state = 'copying the store' if self.syncing else 'connected' if self.connected else 'disconnected'
+        lines = [f"Follower of {self.path}, {state}",
+                 f"applied LSN {self.applied_lsn} of {self.primary_lsn}, epoch {self.epoch or '-'}"]
+        if lag is not None:
+            lines.append(f"behind {behind} changes, lag {lag:.2f} s")
+        return "\n".join(lines) + "\n"
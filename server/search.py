@@ -0,0 +1,210 @@
+import json
+import os
+import re
+import threading
+from bisect import bisect_left, bisect_right
+from collections import defaultdict
+
+TOKEN_RE = re.compile(r'\w+')
+MAX_TOKEN_LENGTH = 64
+USER_PREFIX = 'user:'  # Can't collide with \w+ text tokens
+
+
+def tokenize(text):
+    """Lowercased unique word tokens of a piece of text"""
+    return {token for token in TOKEN_RE.findall(text.lower()) if len(token) <= MAX_TOKEN_LENGTH}
+
+
+def message_terms(message):
+    # Stored or imported history isn't guaranteed to hold strings, and this
+    # runs under the store's lock: skip anything that isn't one
+    content, file_name, username = message.get('content'), message.get('file_name'), message.get('username')
+    terms = tokenize(content) if isinstance(content, str) else set()
+    if isinstance(file_name, str):
+        terms |= tokenize(file_name)
+    if isinstance(username, str):
+        terms.add(USER_PREFIX + username.lower())
+    return terms
+
+
+class SearchIndex:
+    """Inverted index from terms to message IDs, per room.
+
+    Postings are {term: {room: [ids]}} with IDs ascending, since messages
+    are indexed in the order the store assigns IDs. Usernames are indexed
+    as 'user:<name>' terms so a username filter is just one more postings
+    list to intersect. New postings are written as small JSON segment files
+    when the history is saved and merged into one when too many pile up.
+    """
+
+    def __init__(self, directory, max_segments=8, load=True):
+        self.directory = directory
+        self.max_segments = max_segments
+        self.lock = threading.Lock()
+        self.postings = defaultdict(lambda: defaultdict(list))
+        self.indexed = {}  # {room: highest indexed message ID}
+        self._pending = defaultdict(lambda: defaultdict(list))
+        self._segments = []
+        self._flush_lock = threading.Lock()
+        if load:
+            self.load()
+
+    def add(self, room, message):
+        """Index one stored message"""
+        terms = message_terms(message)
+        message_id = message['id']
+        with self.lock:
+            if message_id <= self.indexed.get(room, -1):
+                return
+            for term in terms:
+                self.postings[term][room].append(message_id)
+                self._pending[term][room].append(message_id)
+            self.indexed[room] = message_id
+
+    def catch_up(self, store):
+        """Index stored messages newer than what the segments cover"""
+        for room in list(store.history):
+            for message in store.after(room, self.indexed.get(room, -1)):
+                self.add(room, message)
+
+    def search(self, query='', rooms=None, username=None, id_ranges=None, limit=50):
+        """Return [(room, id)] for messages matching every term, newest first
+
+        id_ranges optionally maps a room to an inclusive (first_id, last_id)
+        window, which is how time filters are applied.
+        """
+        terms = list(tokenize(query))
+        if username:
+            terms.append(USER_PREFIX + username.strip().lower())
+        if not terms:
+            return []
+
+        results = []
+        with self.lock:
+            lists_by_room = {}
+            for term in terms:
+                by_room = self.postings.get(term)
+                if not by_room:
+                    return []
+                for room in (rooms if rooms is not None else by_room.keys()):
+                    lists_by_room.setdefault(room, []).append(by_room.get(room, ()))
+
+            for room, lists in lists_by_room.items():
+                if len(lists) < len(terms):
+                    continue
+                lists.sort(key=len)
+                smallest, others = lists[0], lists[1:]
+
+                lo, hi = 0, len(smallest)
+                if id_ranges and room in id_ranges:
+                    first_id, last_id = id_ranges[room]
+                    lo = bisect_left(smallest, first_id)
+                    hi = bisect_right(smallest, last_id)
+
+                # Walk the rarest term's postings newest first, probing the rest
+                found = 0
+                for i in range(hi - 1, lo - 1, -1):
+                    message_id = smallest[i]
+                    if all(_contains(other, message_id) for other in others):
+                        results.append((room, message_id))
+                        found += 1
+                        if found >= limit:
+                            break
+        return results
+
+    def export_state(self):
+        """Picklable copy of the flushed index, for snapshots"""
+        with self.lock:
+            return {
+                'postings': {term: dict(by_room) for term, by_room in self.postings.items()},
+                'indexed': dict(self.indexed)
+            }
+
+    def restore_state(self, state):
+        """Adopt a snapshot instead of reading every segment"""
+        with self.lock:
+            for term, by_room in state['postings'].items():
+                self.postings[term].update(by_room)
+            self.indexed.update(state['indexed'])
+        if os.path.isdir(self.directory):
+            self._segments = sorted(name for name in os.listdir(self.directory)
+                                    if name.startswith('segment-') and name.endswith('.json'))
+
+    def clear(self):
+        """Forget everything indexed and delete the segments"""
+        with self._flush_lock, self.lock:
+            self.postings = defaultdict(lambda: defaultdict(list))
+            self.indexed = {}
+            self._pending = defaultdict(lambda: defaultdict(list))
+            for name in self._segments:
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+            self._segments = []
+
+    def load(self):
+        if not os.path.isdir(self.directory):
+            return
+        names = sorted(name for name in os.listdir(self.directory)
+                       if name.startswith('segment-') and name.endswith('.json'))
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name), 'r') as f:
+                    segment = json.load(f)
+            except Exception:
+                # Unreadable segment: drop it and everything after it, and
+                # let catch_up() reindex those messages from the store
+                for stale in names[names.index(name):]:
+                    try:
+                        os.remove(os.path.join(self.directory, stale))
+                    except OSError:
+                        pass
+                break
+            for term, by_room in segment['postings'].items():
+                for room, ids in by_room.items():
+                    self.postings[term][room].extend(ids)
+            for room, last_id in segment['indexed'].items():
+                self.indexed[room] = max(self.indexed.get(room, -1), last_id)
+            self._segments.append(name)
+
+    def flush(self):
+        """Persist postings added since the last flush as a new segment"""
+        with self._flush_lock:
+            self._flush()
+
+    def _flush(self):
+        with self.lock:
+            if not self._pending:
+                return
+            pending = self._pending
+            self._pending = defaultdict(lambda: defaultdict(list))
+            indexed = dict(self.indexed)
+            compact = len(self._segments) + 1 > self.max_segments
+            if compact:
+                pending = {term: {room: list(ids) for room, ids in by_room.items()}
+                           for term, by_room in self.postings.items()}
+
+        os.makedirs(self.directory, exist_ok=True)
+        number = int(self._segments[-1][8:-5]) + 1 if self._segments else 0
+        name = f"segment-{number:08d}.json"
+        tmp_path = os.path.join(self.directory, name + '.tmp')
+        with open(tmp_path, 'w') as f:
+            json.dump({'indexed': indexed, 'postings': pending}, f, separators=(',', ':'))
+        os.replace(tmp_path, os.path.join(self.directory, name))
+
+        if compact:
+            # The new segment holds everything, drop the ones it replaces
+            for old in self._segments:
+                try:
+                    os.remove(os.path.join(self.directory, old))
+                except OSError:
+                    pass
+            self._segments = [name]
+        else:
+            self._segments.append(name)
+
+
+def _contains(ids, message_id):
+    i = bisect_left(ids, message_id)
+    return i < len(ids) and ids[i] == message_id
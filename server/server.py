@@ -1,43 +1,182 @@
+import base64
+import selectors
+import signal
 import socket
+import ssl
 import threading
 import json
 import time
+from collections import OrderedDict, deque
 from datetime import datetime
 from config import settings
+from server import handoff
+from server.admin import AdminChannel
+from server.archive import Archive
+from server.outbox import Outbox
+from server.presence import Presence
+from server.ratelimit import ConnectionLimits, TokenBucket
+from server.record import encode_frame, with_head
+from server.replication import ReplicationFollower, ReplicationPrimary, use_follower_paths
+from server.search import SearchIndex
+from server.snapshot import load_snapshot, write_snapshot
+from server.store import ChatStore, conversation_key
+from server.timerwheel import TimerWheel
+from server.typing_status import TypingTracker
+from server.utils import MessageDecoder
 import os
 
+# Requests a read-only follower refuses, since only the primary stores messages
+READ_ONLY_REFUSED = ('message', 'file', 'dm', 'large_message_start')
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool)
+
+
+def _interrupt(signum, frame):
+    raise KeyboardInterrupt
+
+
 class ChatServer:
     def __init__(self):
         self.host = settings.HOST
         self.port = settings.PORT
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
         self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if settings.TLS_ENABLED:
+            from server.encryption import server_context
+            self.tls = server_context()
+        else:
+            self.tls = None
         
         # Store active connections and rooms
         self.clients = {}  # {client_socket: {'username': str, 'room': str}}
+        self.sessions = {}  # {username: set of client_sockets}, for direct messages
         self.rooms = {
             'general': [],
             'random': [],
             'tech': [],
             'gaming': []
         }
-        self.chat_history = self.load_chat_history()
+        
+        # Member lists, sent to clients as coalesced diffs
+        self.presence = Presence(self.rooms)
+        self.typing = TypingTracker(self.rooms, settings.TYPING_TIMEOUT, settings.TYPING_MAX_NAMES)
+        
+        # A snapshot from a clean shutdown restores the store and index
+        # without parsing the JSON log or the index segments
+        snapshot = load_snapshot(settings.SNAPSHOT_PATH, settings.CHAT_LOG_PATH)
+        archive = Archive(settings.ARCHIVE_DIR, settings.ARCHIVE_BLOCK_MESSAGES) if settings.ARCHIVE_DIR else None
+        self.store = ChatStore(settings.CHAT_LOG_PATH, self.rooms.keys(), load=snapshot is None,
+                               archive=archive, json_window=settings.HISTORY_LIMIT)
+        
+        # Full-text index, kept current as messages are stored
+        self.search_index = SearchIndex(settings.SEARCH_INDEX_DIR, settings.SEARCH_MAX_SEGMENTS,
+                                        load=snapshot is None)
+        if snapshot is not None:
+            self.store.restore_state(snapshot['store'])
+            self.search_index.restore_state(snapshot['search'])
+            print("⚡ Restored chat history from snapshot")
+        self.search_index.catch_up(self.store)
+        self.store.on_append.append(self.search_index.add)
+        
+        # Direct messages waiting for their recipient to come online
+        self.offline_dms = {}  # {username: deque of (conversation, message ID)}
+        self.dm_lock = threading.Lock()  # Queue or deliver, never both
+        
+        # Acks of recently stored messages by client message ID, so a message
+        # re-sent after a reconnect is acknowledged again instead of stored twice
+        self.recent_acks = OrderedDict()  # {(username, cid): ack frame}
+        self.ack_lock = threading.Lock()
+        if snapshot is not None:
+            for username, queued in snapshot.get('offline_dms', {}).items():
+                self.offline_dms[username] = deque(queued, maxlen=settings.DM_OFFLINE_QUEUE_LIMIT)
+        
+        # Outgoing frames are queued per connection and written by its own thread
+        self.outboxes = {}  # {client_socket: Outbox}
+        self.channels = {}  # {client_socket: TLSChannel}, all I/O on a TLS connection goes through it
+        self.shutting_down = False
         
         # Large message transfer state
-        self.large_messages = {}  # {client_socket: {'data': b'', 'total_size': 0, 'received_size': 0}}
+        self.large_messages = {}  # {client_socket: {'data': bytearray, 'total_size': 0, 'received_size': 0, 'cid': ...}}
         
-    def load_chat_history(self):
-        if os.path.exists(settings.CHAT_LOG_PATH):
-            try:
-                with open(settings.CHAT_LOG_PATH, 'r') as f:
-                    return json.load(f)
-            except:
-                return {'general': [], 'random': [], 'tech': [], 'gaming': []}
-        return {'general': [], 'random': [], 'tech': [], 'gaming': []}
+        # Admission control
+        self.limits = {}  # {client_socket: ConnectionLimits}
+        self.user_limits = {}  # {(username, host): ConnectionLimits}, survive reconnects
+        self.banned = {}  # {(username, host): monotonic time the ban ends}
+        # Expiry of bans, and of user budgets nobody is using once they are
+        # full again; keys are ('ban' or 'limits', (username, host))
+        self.budget_timers = TimerWheel(64, 1.0, time.monotonic())
+        self.room_limits = {
+            room: TokenBucket(settings.ROOM_RATE_LIMIT_MESSAGES, settings.ROOM_RATE_LIMIT_BURST)
+            for room in self.rooms
+        }
+        self.connection_count = 0
+        self.stats_lock = threading.Lock()
+        self.stats = {
+            'connections_rejected': 0,
+            'rate_limited': 0,
+            'room_rate_limited': 0,
+            'upload_rejected': 0,
+            'clients_dropped': 0,
+            'slow_clients_dropped': 0
+        }
+    
+        # Heartbeats: last time each connection sent anything, and a wheel
+        # of deadlines at which to check on it
+        self.last_seen = {}  # {client_socket: monotonic time}
+        self.idle_timers = TimerWheel(int(settings.TIMEOUT) + 1, 1.0, time.monotonic())
+        
+        # Socket handoff to a new server process. Reader loops also wait on
+        # the wakeup socket so they can be stopped without touching clients.
+        self.listening = False
+        self.handing_off = False
+        self.handed_off = False
+        self.handoff_done = threading.Event()
+        self.handoff_conn = None  # Set in the new process until it is serving
+        self.parked = {}  # {client_socket: bytes received but not yet handled}
+        self.handler_cond = threading.Condition()
+        self._wakeup_reader, self._wakeup_writer = socket.socketpair()
+        
+        # Switched on and off at runtime from the admin socket
+        self.admin = AdminChannel(self)
+        self.handler_timings = None  # HandlerTimings while timing handlers
+        self.handler_profiler = None  # HandlerProfiler while profiling them
+        
+        # Hot-standby replication: a primary streams its store to followers
+        self.replication = None  # ReplicationPrimary while serving followers
+        self.follower = None  # ReplicationFollower while following a primary
+    
+    @classmethod
+    def take_over(cls, path=None):
+        """Create a server that replaces the one running, keeping its clients"""
+        state, fds, conn = handoff.request_handoff(path or settings.HANDOFF_SOCKET_PATH,
+                                                   settings.HANDOFF_TIMEOUT)
+        # Created after the old process saved its snapshot, so this loads it
+        server = cls()
+        server.adopt(state, fds)
+        server.handoff_conn = conn
+        return server
+    
+    @classmethod
+    def follow(cls, data_dir=None, port=None):
+        """Create a read-only server that keeps a copy of the primary's store"""
+        use_follower_paths(data_dir or settings.REPLICA_DATA_DIR, port or settings.REPLICA_PORT)
+        server = cls()
+        server.follower = ReplicationFollower(server, settings.REPLICATION_SOCKET_PATH)
+        return server
+    
+    def promote(self):
+        """Stop following and take writes, for failover to this server"""
+        follower, self.follower = self.follower, None
+        follower.stop()
+        self.save_chat_history()
+        self.start_primary_threads()
+        print("👑 Promoted to primary")
     
     def save_chat_history(self):
-        with open(settings.CHAT_LOG_PATH, 'w') as f:
-            json.dump(self.chat_history, f, indent=2)
+        self.store.save()
+        self.search_index.flush()
     
     def broadcast(self, message, room, sender_socket=None):
         """Send message to all clients in a room"""
@@ -54,14 +193,41 @@ class ChatServer:
             except Exception:
                 pass
 
+        data = message.encode(settings.ENCODING)
         for client_socket in recipients:
             if client_socket != sender_socket:
-                try:
-                    client_socket.send(message.encode(settings.ENCODING))
-                except Exception as e:
-                    if settings.DEBUG:
-                        print(f"[DEBUG] Failed to send to {client_socket}: {e}")
-                    self.remove_client(client_socket)
+                self.send_to(client_socket, data)
+    
+    def deliver(self, room, message):
+        """Pass a message stored by the primary on to this follower's clients"""
+        if room in self.rooms:
+            msg_type = 'message' if message.file_name is None else 'file'
+            self.broadcast(with_head(self.store.message_json(room, message), type=msg_type, room=room), room)
+        elif message.to is not None:
+            frame = with_head(self.store.message_json(room, message), type='dm', conversation=room)
+            with self.dm_lock:
+                targets = set(self.sessions.get(message.to, ())) | set(self.sessions.get(message.username, ()))
+            for target in targets:
+                self.send_to(target, frame)
+    
+    def send_to(self, client_socket, message):
+        """Queue a message (str or encoded bytes) for one client"""
+        if isinstance(message, str):
+            message = message.encode(settings.ENCODING)
+        
+        outbox = self.outboxes.get(client_socket)
+        if outbox is None:
+            # Not being served (e.g. refused at accept), write directly
+            try:
+                client_socket.sendall(message)
+            except OSError:
+                pass
+            return
+        
+        if not outbox.put(message) and not outbox.closed:
+            # Too far behind to catch up, treat it like a dead connection
+            self.count('slow_clients_dropped')
+            self.evict(client_socket)
     
     def remove_client(self, client_socket):
         """Remove client from server"""
@@ -71,9 +237,13 @@ class ChatServer:
             
             if room in self.rooms and client_socket in self.rooms[room]:
                 self.rooms[room].remove(client_socket)
+                self.presence.leave(room, username)
+                self.typing.stop(room, username)
             
             del self.clients[client_socket]
-            client_socket.close()
+            self._remove_session(username, client_socket)
+            if self.shutting_down:
+                return
             
             # Notify others in the room
             leave_msg = json.dumps({
@@ -84,137 +254,646 @@ class ChatServer:
             })
             self.broadcast(leave_msg, room)
     
-    def handle_client(self, client_socket, address):
+    def _remove_session(self, username, client_socket):
+        with self.dm_lock:
+            sessions = self.sessions.get(username)
+            if sessions is not None:
+                sessions.discard(client_socket)
+                if not sessions:
+                    del self.sessions[username]
+    
+    def handle_client(self, client_socket, address, buffered=b''):
         """Handle individual client connection"""
+        decoder = MessageDecoder(settings.ENCODING, settings.MAX_UPLOAD_SIZE * 2)
+        client = self.clients.get(client_socket)
+        if client is not None:
+            # Adopted from the previous server process, already joined
+            key = self.budget_key(client_socket, client['username'])
+            self.limits[client_socket] = self.user_limits.setdefault(key, ConnectionLimits(key))
+        else:
+            self.limits[client_socket] = ConnectionLimits()
+        self.last_seen[client_socket] = time.monotonic()
+        self.idle_timers.schedule(client_socket, time.monotonic() + settings.HEARTBEAT_INTERVAL)
+        channel = self.channels.get(client_socket)
+        self.outboxes[client_socket] = Outbox(client_socket, on_error=self.evict, channel=channel)
+        selector = selectors.DefaultSelector()
+        selector.register(client_socket, selectors.EVENT_READ)
+        selector.register(self._wakeup_reader, selectors.EVENT_READ)
+        detached = False
         try:
+            for data in decoder.feed(buffered):
+                self.handle_message(client_socket, data)
+            
             while True:
-                message = client_socket.recv(settings.BUFFER_SIZE).decode(settings.ENCODING)
-                if not message:
+                # TLS may hold decrypted bytes already, the selector can't see those
+                if channel is None or not channel.pending():
+                    selector.select()
+                if self.handing_off:
+                    detached = True
                     break
+                if channel is None:
+                    chunk = client_socket.recv(settings.BUFFER_SIZE)
+                else:
+                    try:
+                        chunk = channel.recv(settings.BUFFER_SIZE, 0)
+                    except socket.timeout:
+                        continue  # Only part of a TLS record so far
+                if not chunk:
+                    break
+                self.last_seen[client_socket] = time.monotonic()
                 
-                data = json.loads(message)
-                msg_type = data.get('type')
-                
-                # Handle large message transfer
-                if msg_type == 'large_message_start':
-                    self.handle_large_message_start(client_socket, data)
-                elif msg_type == 'large_message_chunk':
-                    self.handle_large_message_chunk(client_socket, data)
-                elif msg_type == 'large_message_end':
-                    self.handle_large_message_end(client_socket)
-                
-                if msg_type == 'join':
-                    username = data.get('username', '')
-                    room = data.get('room', 'general')
-
-                    # Normalize username
-                    username = username.strip() if isinstance(username, str) else ''
-                    if not username:
-                        username = 'Anonymous'
-
-                    self.clients[client_socket] = {'username': username, 'room': room}
-                    self.rooms[room].append(client_socket)
-                    
-                    # Send room history
-                    history_msg = json.dumps({
-                        'type': 'history',
-                        'messages': self.chat_history[room][-50:]  # Last 50 messages
-                    })
-                    client_socket.send(history_msg.encode(settings.ENCODING))
-                    
-                    # Notify others
-                    join_msg = json.dumps({
-                        'type': 'user_joined',
-                        'username': username,
-                        'room': room,
-                        'timestamp': datetime.now().strftime('%H:%M:%S')
-                    })
-                    self.broadcast(join_msg, room)
-                
-                elif msg_type == 'message':
-                    username = self.clients[client_socket]['username']
-                    room = self.clients[client_socket]['room']
-                    content = data['content']
-                    timestamp = datetime.now().strftime('%H:%M:%S')
-                    
-                    # Store message
-                    message_data = {
-                        'username': username,
-                        'content': content,
-                        'timestamp': timestamp
-                    }
-                    self.chat_history[room].append(message_data)
-                    
-                    # Broadcast to room
-                    broadcast_msg = json.dumps({
-                        'type': 'message',
-                        'username': username,
-                        'content': content,
-                        'timestamp': timestamp,
-                        'room': room
-                    })
-                    self.broadcast(broadcast_msg, room, client_socket)
-                    
-                    # Save periodically
-                    if len(self.chat_history[room]) % 10 == 0:
-                        self.save_chat_history()
-                
-
-                
-                elif msg_type == 'change_room':
-                    old_room = self.clients[client_socket]['room']
-                    new_room = data['room']
-                    username = self.clients[client_socket]['username']
-                    
-                    # Remove from old room
-                    if client_socket in self.rooms[old_room]:
-                        self.rooms[old_room].remove(client_socket)
-                    
-                    # Add to new room
-                    self.rooms[new_room].append(client_socket)
-                    self.clients[client_socket]['room'] = new_room
-                    
-                    # Send new room history
-                    history_msg = json.dumps({
-                        'type': 'history',
-                        'messages': self.chat_history[new_room][-50:]
-                    })
-                    client_socket.send(history_msg.encode(settings.ENCODING))
-                    
-                    # Notify both rooms
-                    leave_msg = json.dumps({
-                        'type': 'user_left',
-                        'username': username,
-                        'room': old_room,
-                        'timestamp': datetime.now().strftime('%H:%M:%S')
-                    })
-                    self.broadcast(leave_msg, old_room)
-                    
-                    join_msg = json.dumps({
-                        'type': 'user_joined',
-                        'username': username,
-                        'room': new_room,
-                        'timestamp': datetime.now().strftime('%H:%M:%S')
-                    })
-                    self.broadcast(join_msg, new_room)
+                for data in decoder.feed(chunk):
+                    self.handle_message(client_socket, data)
         
         except Exception as e:
             if settings.DEBUG:
                 print(f"Client error: {e}")
         finally:
-            # Clean up large message state
-            if client_socket in self.large_messages:
-                del self.large_messages[client_socket]
-            self.remove_client(client_socket)
+            selector.close()
+            if detached:
+                # Being handed to another process, leave the socket open
+                with self.handler_cond:
+                    self.parked[client_socket] = decoder.remaining()
+                    self.handler_cond.notify_all()
+            else:
+                # Clean up large message state
+                if client_socket in self.large_messages:
+                    del self.large_messages[client_socket]
+                limits = self.limits.pop(client_socket, None)
+                if limits is not None and limits.key is not None:
+                    self.budget_timers.schedule(('limits', limits.key), time.monotonic() + limits.full_in())
+                self.idle_timers.cancel(client_socket)
+                self.last_seen.pop(client_socket, None)
+                self.remove_client(client_socket)
+                self.outboxes.pop(client_socket).close()
+                self.channels.pop(client_socket, client_socket).close()
+                with self.stats_lock:
+                    self.connection_count -= 1
+                with self.handler_cond:
+                    self.handler_cond.notify_all()
+    
+    def handle_tls_client(self, client_socket, address):
+        """Run the TLS handshake on the client's own thread, then serve it"""
+        client_socket.settimeout(settings.TLS_HANDSHAKE_TIMEOUT)
+        try:
+            client_socket = self.tls.wrap_socket(client_socket, server_side=True)
+        except (ssl.SSLError, OSError) as e:
+            if settings.DEBUG:
+                print(f"TLS handshake with {address} failed: {e}")
+            client_socket.close()
+            with self.stats_lock:
+                self.connection_count -= 1
+            with self.handler_cond:
+                self.handler_cond.notify_all()
+            return
+        client_socket.settimeout(None)
+        from server.encryption import TLSChannel
+        self.channels[client_socket] = TLSChannel(client_socket)
+        self.handle_client(client_socket, address)
+    
+    def handle_message(self, client_socket, data):
+        """Handle one decoded message, timed or profiled if switched on"""
+        timings, profiler = self.handler_timings, self.handler_profiler
+        if timings is None and profiler is None:
+            self.dispatch_message(client_socket, data)
+            return
+        
+        started = time.perf_counter()
+        if profiler is not None:
+            profiler.runcall(self.dispatch_message, client_socket, data)
+        else:
+            self.dispatch_message(client_socket, data)
+        if timings is not None:
+            timings.record(data.get('type'), time.perf_counter() - started)
+    
+    def dispatch_message(self, client_socket, data):
+        """Dispatch one decoded message from a client"""
+        msg_type = data.get('type')
+        if self.shutting_down or not self.admit(client_socket, data):
+            return
+        if self.follower is not None and msg_type in READ_ONLY_REFUSED:
+            self.send_error(client_socket, 'read_only', "This server is a read-only replica, connect to the primary to send",
+                            request=data)
+            return
+        
+        # Handle large message transfer
+        if msg_type == 'large_message_start':
+            self.handle_large_message_start(client_socket, data)
+        elif msg_type == 'large_message_chunk':
+            self.handle_large_message_chunk(client_socket, data)
+        elif msg_type == 'large_message_end':
+            self.handle_large_message_end(client_socket)
+        
+        if msg_type in ('join', 'resume'):
+            self.handle_join(client_socket, data, last_id=data.get('last_id'))
+        
+        elif msg_type == 'message':
+            self.process_chat_message(client_socket, data)
+        
+        elif msg_type == 'file':
+            # Small enough to be sent without chunking
+            self.process_file_message(client_socket, data)
+        
+        elif msg_type == 'ping':
+            self.send_frame(client_socket, {'type': 'pong'})
+        
+        elif msg_type == 'search':
+            self.handle_search(client_socket, data)
+        
+        elif msg_type == 'dm':
+            self.handle_direct_message(client_socket, data)
+        
+        elif msg_type == 'dm_history':
+            self.handle_dm_history(client_socket, data)
+        
+        elif msg_type == 'older_history':
+            self.handle_older_history(client_socket, data)
+        
+        elif msg_type == 'members':
+            room = data.get('room')
+            if room in self.rooms:
+                self.send_frame(client_socket, self.presence.snapshot(room))
+        
+        elif msg_type == 'typing':
+            if client_socket in self.clients:
+                client = self.clients[client_socket]
+                if data.get('active', True):
+                    self.typing.start(client['room'], client['username'], time.monotonic())
+                else:
+                    self.typing.stop(client['room'], client['username'])
+        
+        elif msg_type == 'change_room':
+            old_room = self.clients[client_socket]['room']
+            new_room = data['room']
+            username = self.clients[client_socket]['username']
+            
+            # Remove from old room
+            if client_socket in self.rooms[old_room]:
+                self.rooms[old_room].remove(client_socket)
+                self.presence.leave(old_room, username)
+                self.typing.stop(old_room, username)
+            
+            # Add to new room
+            self.rooms[new_room].append(client_socket)
+            self.clients[client_socket]['room'] = new_room
+            self.presence.join(new_room, username)
+            
+            # Send new room history, only what's newer than the client's cache
+            messages, resumed = self.store.since(new_room, data.get('last_id'), settings.HISTORY_LIMIT)
+            history_msg = encode_frame({
+                'type': 'history',
+                'room': new_room,
+                'messages': self.store.encode(new_room, messages),
+                'resumed': resumed
+            })
+            self.send_to(client_socket, history_msg)
+            self.send_frame(client_socket, self.presence.snapshot(new_room))
+            
+            # Notify both rooms
+            leave_msg = json.dumps({
+                'type': 'user_left',
+                'username': username,
+                'room': old_room,
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            })
+            self.broadcast(leave_msg, old_room)
+            
+            join_msg = json.dumps({
+                'type': 'user_joined',
+                'username': username,
+                'room': new_room,
+                'timestamp': datetime.now().strftime('%H:%M:%S')
+            })
+            self.broadcast(join_msg, new_room)
+    
+    def count(self, name):
+        with self.stats_lock:
+            self.stats[name] += 1
+    
+    def send_frame(self, client_socket, frame):
+        """Send a frame, ignoring connections that just died"""
+        self.send_to(client_socket, encode_frame(frame))
+    
+    def already_stored(self, client_socket, message):
+        """Re-acknowledge a message whose client ID was stored before"""
+        cid = message.get('cid')
+        if not isinstance(cid, str) or client_socket not in self.clients:
+            return False
+        with self.ack_lock:
+            ack = self.recent_acks.get((self.clients[client_socket]['username'], cid))
+        if ack is None:
+            return False
+        self.send_frame(client_socket, ack)
+        return True
+    
+    def acknowledge(self, client_socket, message, room, stored):
+        """Tell the sender its message was stored, and under which ID"""
+        cid = message.get('cid')
+        if not isinstance(cid, str) or len(cid) > 64:
+            return
+        ack = {'type': 'ack', 'cid': cid, 'room': room, 'id': stored['id'],
+               'ts': stored['ts'], 'timestamp': stored['timestamp']}
+        with self.ack_lock:
+            self.recent_acks[(stored['username'], cid)] = ack
+            while len(self.recent_acks) > settings.RECENT_ACKS_LIMIT:
+                self.recent_acks.popitem(last=False)
+        self.send_frame(client_socket, ack)
+    
+    def send_error(self, client_socket, code, message, request=None, **extra):
+        """Tell a client its request was refused
+
+        The client ID of the refused frame, if it had one, is echoed so the
+        client can settle it instead of waiting for an ack that won't come.
+        """
+        error = {'type': 'error', 'code': code, 'message': message, **extra}
+        cid = request.get('cid') if request is not None else None
+        if isinstance(cid, str) and len(cid) <= 64:
+            error['cid'] = cid
+        self.send_frame(client_socket, error)
+    
+    def reap_idle_connections(self):
+        """Ping quiet connections and evict the ones that stay silent
+
+        Runs on its own thread. A connection is checked HEARTBEAT_INTERVAL
+        after it was last heard from and pinged if still quiet; if nothing
+        arrives by TIMEOUT it is dropped. Activity only updates last_seen,
+        the wheel entry is moved when it comes due, so each tick costs
+        O(due connections).
+        """
+        while True:
+            time.sleep(self.idle_timers.tick)
+            if self.handing_off:
+                continue
+            now = time.monotonic()
+            for client_socket in self.idle_timers.advance(now):
+                last_seen = self.last_seen.get(client_socket)
+                if last_seen is None:
+                    continue
+                
+                idle = now - last_seen
+                if idle >= settings.TIMEOUT:
+                    if settings.DEBUG:
+                        print(f"[DEBUG] Evicting idle connection after {idle:.0f}s")
+                    self.evict(client_socket)
+                elif idle >= settings.HEARTBEAT_INTERVAL:
+                    self.send_frame(client_socket, {'type': 'ping'})
+                    self.idle_timers.schedule(client_socket, last_seen + settings.TIMEOUT)
+                else:
+                    self.idle_timers.schedule(client_socket, last_seen + settings.HEARTBEAT_INTERVAL)
+            self.prune_budgets(now)
+    
+    def budget_key(self, client_socket, username):
+        """Whose rate limit budgets and ban a connection shares
+
+        The username and the host it connects from: usernames aren't
+        authenticated, and anyone elsewhere could otherwise use up someone
+        else's budget or get them banned.
+        """
+        try:
+            host = client_socket.getpeername()[0]
+        except (OSError, IndexError, TypeError):
+            host = None
+        return (username, host)
+    
+    def prune_budgets(self, now):
+        """Forget expired bans, and user budgets that are unused and full again"""
+        for kind, key in self.budget_timers.advance(now):
+            if kind == 'ban':
+                if self.banned.get(key, now) <= now:
+                    self.banned.pop(key, None)
+                continue
+            limits = self.user_limits.get(key)
+            if limits is None or any(in_use is limits for in_use in list(self.limits.values())):
+                continue  # Scheduled again when its last connection closes
+            full_in = limits.full_in()
+            if full_in > 0:
+                self.budget_timers.schedule(('limits', key), now + full_in)
+            else:
+                del self.user_limits[key]
+    
+    def publish_presence(self):
+        """Broadcast member list changes, batched every PRESENCE_INTERVAL"""
+        while True:
+            time.sleep(settings.PRESENCE_INTERVAL)
+            if self.handing_off:
+                continue
+            for diff in self.presence.flush():
+                self.broadcast(json.dumps(diff), diff['room'])
+    
+    def publish_typing(self):
+        """Broadcast who is typing, at most once per room per TYPING_BROADCAST_INTERVAL"""
+        while True:
+            time.sleep(settings.TYPING_BROADCAST_INTERVAL)
+            if self.handing_off:
+                continue
+            for update in self.typing.flush(time.monotonic()):
+                self.broadcast(json.dumps(update), update['room'])
+    
+    def enforce_retention(self):
+        """Archive history past its retention limits, every RETENTION_INTERVAL"""
+        while True:
+            if not (self.handing_off or self.shutting_down):
+                self.apply_retention()
+            time.sleep(settings.RETENTION_INTERVAL)
+    
+    def retention_policy(self, room):
+        """Retention limits of a room or conversation, with ROOM_RETENTION applied"""
+        policy = {
+            'max_age_days': settings.RETENTION_MAX_AGE_DAYS,
+            'max_messages': settings.RETENTION_MAX_MESSAGES,
+            'max_bytes': settings.RETENTION_MAX_BYTES
+        }
+        policy.update(settings.ROOM_RETENTION.get(room, {}))
+        return policy
+    
+    def apply_retention(self):
+        """Move messages past the retention limits into the archive"""
+        archived = 0
+        for room in list(self.store.history):
+            policy = self.retention_policy(room)
+            max_age_days = policy['max_age_days']
+            try:
+                archived += self.store.trim(
+                    room,
+                    max_age=max_age_days * 86400 if max_age_days is not None else None,
+                    max_messages=policy['max_messages'],
+                    max_bytes=policy['max_bytes'],
+                    min_batch=settings.ARCHIVE_BLOCK_MESSAGES
+                )
+            except OSError as e:
+                print(f"❌ Archiving {room} failed: {e}")
+        if archived:
+            self.save_chat_history()
+            print(f"🗄️ Archived {archived} messages")
+        return archived
+    
+    def evict(self, client_socket):
+        """Drop a dead connection from its room and wake its handler thread"""
+        try:
+            self.channels.get(client_socket, client_socket).shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.remove_client(client_socket)
+    
+    def admit(self, client_socket, data):
+        """Apply per-connection and per-room rate limits to one frame
+
+        Chunks of a large message are paid for up front by the upload budget
+        in handle_large_message_start. Returns False if the frame is dropped;
+        a client that keeps exceeding its limits is disconnected.
+        """
+        msg_type = data.get('type')
+        limits = self.limits.get(client_socket)
+        if limits is None or msg_type in ('large_message_chunk', 'large_message_end'):
+            return True
+        
+        code = 'rate_limited'
+        retry_after = limits.frames.consume()
+        if not retry_after and msg_type == 'message' and client_socket in self.clients:
+            room = self.clients[client_socket]['room']
+            retry_after = self.room_limits[room].consume()
+            code = 'room_rate_limited'
+        if not retry_after:
+            return True
+        
+        self.count(code)
+        if limits.violations.consume():
+            self.count('clients_dropped')
+            if limits.key is not None:
+                until = time.monotonic() + settings.RATE_LIMIT_BAN_SECONDS
+                self.banned[limits.key] = until
+                self.budget_timers.schedule(('ban', limits.key), until)
+            raise ConnectionError("Client exceeded rate limits too often")
+        self.send_error(client_socket, code, "Slow down, message dropped", request=data,
+                        retry_after=round(retry_after, 3))
+        return False
+    
+    def handle_join(self, client_socket, data, last_id=None):
+        """Add a client to a room and send it the room history
+
+        A reconnecting client sends 'resume' with the last message ID it saw
+        and only gets the messages it missed; a 'join' may carry one too,
+        from the client's local history cache.
+        """
+        username = data.get('username', '')
+        room = data.get('room', 'general')
+
+        # Normalize username
+        username = username.strip() if isinstance(username, str) else ''
+        if not username:
+            username = 'Anonymous'
+
+        # Budgets follow the user, so reconnecting doesn't refill them
+        key = self.budget_key(client_socket, username)
+        if self.banned.get(key, 0) > time.monotonic():
+            self.send_error(client_socket, 'banned', "Too many dropped messages, try again later")
+            raise ConnectionError(f"{username} is temporarily banned")
+        self.limits[client_socket] = self.user_limits.setdefault(key, ConnectionLimits(key))
+
+        self.clients[client_socket] = {'username': username, 'room': room}
+        self.rooms[room].append(client_socket)
+        with self.dm_lock:
+            self.sessions.setdefault(username, set()).add(client_socket)
+            queued = self.offline_dms.pop(username, None)
+        self.presence.join(room, username)
+        
+        # Send room history
+        messages, resumed = self.store.since(room, last_id, settings.HISTORY_LIMIT)
+        history_msg = encode_frame({
+            'type': 'history',
+            'room': room,
+            'messages': self.store.encode(room, messages),
+            'resumed': resumed
+        })
+        self.send_to(client_socket, history_msg)
+        self.send_frame(client_socket, self.presence.snapshot(room))
+        
+        # Notify others
+        join_msg = json.dumps({
+            'type': 'user_joined',
+            'username': username,
+            'room': room,
+            'timestamp': datetime.now().strftime('%H:%M:%S')
+        })
+        self.broadcast(join_msg, room)
+        
+        # Direct messages sent while the user was offline
+        while queued:
+            conversation, message_id = queued.popleft()
+            message = self.store.get(conversation, message_id)
+            if message is not None:
+                self.send_to(client_socket, with_head(self.store.message_json(conversation, message),
+                                                      type='dm', conversation=conversation))
+    
+    def handle_direct_message(self, client_socket, data):
+        """Store a direct message and deliver it to every session of both users
+        
+        Recipients are found through the username index, so routing doesn't
+        depend on how many clients are connected. A recipient with no open
+        session gets the message when they next join.
+        """
+        if client_socket not in self.clients or self.already_stored(client_socket, data):
+            return
+        sender = self.clients[client_socket]['username']
+        recipient = data.get('to')
+        content = data.get('content')
+        if not isinstance(recipient, str) or not recipient.strip() or not isinstance(content, str):
+            self.send_error(client_socket, 'bad_request', "A direct message needs 'to' and 'content'", request=data)
+            return
+        recipient = recipient.strip()
+        
+        conversation = conversation_key(sender, recipient)
+        self.store.open_partition(conversation)
+        message = self.store.append(conversation, {
+            'username': sender,
+            'to': recipient,
+            'content': content
+        })
+        self.acknowledge(client_socket, data, conversation, message)
+        frame = with_head(self.store.message_json(conversation, message), type='dm', conversation=conversation)
+        
+        with self.dm_lock:
+            recipient_sessions = list(self.sessions.get(recipient, ()))
+            if not recipient_sessions:
+                self.offline_dms.setdefault(
+                    recipient, deque(maxlen=settings.DM_OFFLINE_QUEUE_LIMIT)).append((conversation, message['id']))
+            # The sender's other sessions see it too
+            targets = set(recipient_sessions) | set(self.sessions.get(sender, ()))
+        for target in targets:
+            if target is not client_socket:
+                self.send_to(target, frame)
+        
+        if self.store.unsaved >= 10:
+            self.save_chat_history()
+    
+    def handle_dm_history(self, client_socket, data):
+        """Send the history of a conversation with another user"""
+        if client_socket not in self.clients or not isinstance(data.get('with'), str):
+            return
+        username = self.clients[client_socket]['username']
+        conversation = conversation_key(username, data['with'].strip())
+        messages, resumed = [], False
+        if conversation in self.store.history:
+            messages, resumed = self.store.since(conversation, data.get('last_id'), settings.HISTORY_LIMIT)
+        self.send_frame(client_socket, {
+            'type': 'dm_history',
+            'with': data['with'].strip(),
+            'conversation': conversation,
+            'messages': self.store.encode(conversation, messages),
+            'resumed': resumed
+        })
+    
+    def handle_older_history(self, client_socket, data):
+        """Send a page of messages from before 'before_id', archived or not
+
+        For a room ('room') or a conversation with another user ('with').
+        """
+        before_id = data.get('before_id')
+        if client_socket not in self.clients or not isinstance(before_id, int):
+            return
+        if isinstance(data.get('with'), str):
+            room = conversation_key(self.clients[client_socket]['username'], data['with'].strip())
+            if room not in self.store.history:
+                return
+        elif data.get('room') in self.rooms:
+            room = data['room']
+        else:
+            return
+        limit = data.get('limit', settings.OLDER_HISTORY_LIMIT)
+        if not isinstance(limit, int) or not 0 < limit <= settings.OLDER_HISTORY_LIMIT:
+            limit = settings.OLDER_HISTORY_LIMIT
+        try:
+            messages = self.store.before(room, before_id, limit)
+        except OSError as e:
+            print(f"❌ Error reading archive of {room}: {e}")
+            messages = []
+        self.send_frame(client_socket, {
+            'type': 'older_history',
+            'room': data.get('room'),
+            'with': data.get('with'),
+            'before_id': before_id,
+            'messages': messages
+        })
+    
+    def handle_search(self, client_socket, data):
+        """Answer a full-text search over room history
+
+        Optional filters: 'room' (name or list), 'username', and 'since' /
+        'until' in epoch ms. Time filters become per-room ID windows through
+        the store, so every step is an index or bisect lookup.
+        """
+        query = data.get('query') or ''
+        username = data.get('username') or None
+        limit = data.get('limit', settings.SEARCH_MAX_RESULTS)
+        if not isinstance(limit, int) or not 0 < limit <= settings.SEARCH_MAX_RESULTS:
+            limit = settings.SEARCH_MAX_RESULTS
+        since, until = data.get('since'), data.get('until')
+        rooms = data.get('room') or list(self.rooms)
+        if isinstance(rooms, str):
+            rooms = [rooms]
+        
+        if not (isinstance(query, str) and isinstance(username, (str, type(None)))
+                and isinstance(rooms, list) and all(isinstance(room, str) for room in rooms)
+                and all(when is None or _is_number(when) for when in (since, until))):
+            self.send_error(client_socket, 'bad_request',
+                            "Search takes text 'query', 'username' and 'room', and 'since'/'until' in epoch ms")
+            return
+        rooms = [room for room in rooms if room in self.rooms]
+        
+        id_ranges = None
+        if since is not None or until is not None:
+            id_ranges = {}
+            for room in list(rooms):
+                id_range = self.store.id_range(room, since, until)
+                if id_range is None:
+                    rooms.remove(room)
+                else:
+                    id_ranges[room] = id_range
+        
+        results = []
+        for room, message_id in self.search_index.search(query, rooms, username, id_ranges, limit):
+            message = self.store.get(room, message_id)
+            if message is not None:
+                # File contents stay out of search results
+                results.append({'room': room, **{k: v for k, v in message.items() if k != 'file_data'}})
+        results.sort(key=lambda m: (m['ts'], m['id']), reverse=True)
+        
+        response = json.dumps({
+            'type': 'search_results',
+            'query': query,
+            'results': results[:limit]
+        })
+        self.send_to(client_socket, response)
     
     def handle_large_message_start(self, client_socket, data):
         """Handle large message transfer start"""
         try:
+            total_size = int(data['total_size'])
+            if client_socket in self.large_messages:
+                self.count('upload_rejected')
+                self.send_error(client_socket, 'upload_rejected', "Another transfer is in progress", request=data)
+                return
+            if total_size > settings.MAX_UPLOAD_SIZE:
+                self.count('upload_rejected')
+                self.send_error(client_socket, 'upload_rejected', "Upload too large", request=data,
+                                max_size=settings.MAX_UPLOAD_SIZE)
+                return
+            
+            # Reserve the whole transfer against the upload bandwidth budget
+            limits = self.limits.get(client_socket)
+            retry_after = limits.upload.consume(total_size) if limits else 0
+            if retry_after:
+                self.count('upload_rejected')
+                self.send_error(client_socket, 'upload_rejected', "Upload bandwidth exceeded", request=data,
+                                retry_after=round(retry_after, 3))
+                return
+            
             # Initialize large message state
             self.large_messages[client_socket] = {
-                'data': b'',
-                'total_size': data['total_size'],
-                'received_size': 0
+                'data': bytearray(),
+                'total_size': total_size,
+                'received_size': 0,
+                'cid': data.get('cid')  # Of the message being uploaded, for errors
             }
             
         except Exception as e:
@@ -227,8 +906,16 @@ class ChatServer:
             if client_socket in self.large_messages:
                 # Convert hex back to bytes and append
                 chunk_data = bytes.fromhex(data['chunk_data'])
-                self.large_messages[client_socket]['data'] += chunk_data
-                self.large_messages[client_socket]['received_size'] += len(chunk_data)
+                transfer = self.large_messages[client_socket]
+                if transfer['received_size'] + len(chunk_data) > transfer['total_size']:
+                    # More than was announced and paid for
+                    del self.large_messages[client_socket]
+                    self.count('upload_rejected')
+                    self.send_error(client_socket, 'upload_rejected', "Upload exceeds announced size",
+                                    request=transfer)
+                    return
+                transfer['data'] += chunk_data
+                transfer['received_size'] += len(chunk_data)
             
         except Exception as e:
             if settings.DEBUG:
@@ -240,7 +927,7 @@ class ChatServer:
             if client_socket in self.large_messages:
                 # Reconstruct the original message
                 message_data = self.large_messages[client_socket]['data']
-                message_str = message_data.decode(settings.ENCODING)
+                message_str = bytes(message_data).decode(settings.ENCODING)
                 original_message = json.loads(message_str)
                 
                 # Process the message based on its type
@@ -261,40 +948,31 @@ class ChatServer:
     def process_file_message(self, client_socket, message):
         """Process a file message"""
         try:
+            if self.already_stored(client_socket, message):
+                return
+            if not isinstance(message.get('file_name'), str) or not isinstance(message.get('file_data'), str):
+                self.send_error(client_socket, 'bad_request', "A file needs 'file_name' and 'file_data'",
+                                request=message)
+                return
             username = self.clients[client_socket]['username']
             room = self.clients[client_socket]['room']
-            file_name = message['file_name']
-            file_type = message['file_type']
-            file_data = message['file_data']
-            file_size = message['file_size']
-            timestamp = datetime.now().strftime('%H:%M:%S')
             
-            # Store file message
-            file_message_data = {
+            # Store file message, the store assigns its ID and timestamp
+            file_message_data = self.store.append(room, {
                 'username': username,
-                'file_name': file_name,
-                'file_type': file_type,
-                'file_data': file_data,
-                'file_size': file_size,
-                'timestamp': timestamp
-            }
-            self.chat_history[room].append(file_message_data)
+                'file_name': message['file_name'],
+                'file_type': message['file_type'],
+                'file_data': message['file_data'],
+                'file_size': message['file_size']
+            })
+            self.acknowledge(client_socket, message, room, file_message_data)
             
             # Broadcast to room
-            broadcast_msg = json.dumps({
-                'type': 'file',
-                'username': username,
-                'file_name': file_name,
-                'file_type': file_type,
-                'file_data': file_data,
-                'file_size': file_size,
-                'timestamp': timestamp,
-                'room': room
-            })
+            broadcast_msg = with_head(self.store.message_json(room, file_message_data), type='file', room=room)
             self.broadcast(broadcast_msg, room, client_socket)
             
             # Save periodically
-            if len(self.chat_history[room]) % 10 == 0:
+            if self.store.unsaved >= 10:
                 self.save_chat_history()
                 
         except Exception as e:
@@ -304,51 +982,318 @@ class ChatServer:
     def process_chat_message(self, client_socket, message):
         """Process a chat message"""
         try:
+            if self.already_stored(client_socket, message):
+                return
+            if not isinstance(message.get('content'), str):
+                self.send_error(client_socket, 'bad_request', "A message needs 'content'", request=message)
+                return
             username = self.clients[client_socket]['username']
             room = self.clients[client_socket]['room']
-            content = message['content']
-            timestamp = datetime.now().strftime('%H:%M:%S')
             
-            # Store message
-            message_data = {
+            # Store message, the store assigns its ID and timestamp
+            message_data = self.store.append(room, {
                 'username': username,
-                'content': content,
-                'timestamp': timestamp
-            }
-            self.chat_history[room].append(message_data)
+                'content': message['content']
+            })
+            self.typing.stop(room, username)
+            self.acknowledge(client_socket, message, room, message_data)
             
             # Broadcast to room
-            broadcast_msg = json.dumps({
-                'type': 'message',
-                'username': username,
-                'content': content,
-                'timestamp': timestamp,
-                'room': room
-            })
+            broadcast_msg = with_head(self.store.message_json(room, message_data), type='message', room=room)
             self.broadcast(broadcast_msg, room, client_socket)
             
             # Save periodically
-            if len(self.chat_history[room]) % 10 == 0:
+            if self.store.unsaved >= 10:
                 self.save_chat_history()
                 
         except Exception as e:
             if settings.DEBUG:
                 print(f"Process chat message error: {e}")
     
+    def shutdown(self):
+        """Stop serving and persist everything for a fast restart
+
+        New connections are refused, clients are told the server is going
+        away and get their queued frames flushed (up to
+        SHUTDOWN_DRAIN_TIMEOUT), then the history, the search index and a
+        binary snapshot of both are written.
+        """
+        if self.shutting_down:
+            return
+        self.shutting_down = True
+        if self.follower is not None:
+            self.follower.stop()
+        
+        # shutdown() stops listening and wakes a thread blocked in accept()
+        try:
+            self.server_socket.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.server_socket.close()
+        
+        notice = json.dumps({'type': 'server_shutdown'}).encode(settings.ENCODING)
+        outboxes = list(self.outboxes.items())
+        for client_socket, outbox in outboxes:
+            outbox.put(notice)
+        deadline = time.monotonic() + settings.SHUTDOWN_DRAIN_TIMEOUT
+        for client_socket, outbox in outboxes:
+            outbox.drain(max(0, deadline - time.monotonic()))
+        for client_socket, outbox in outboxes:
+            try:
+                self.channels.get(client_socket, client_socket).shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        
+        self.save_snapshot()
+        print("💾 Chat history saved")
+    
+    def save_snapshot(self):
+        """Persist history and index, plus a binary snapshot of both"""
+        self.save_chat_history()
+        try:
+            write_snapshot(settings.SNAPSHOT_PATH, settings.CHAT_LOG_PATH, {
+                'store': self.store.export_state(),
+                'search': self.search_index.export_state(),
+                'offline_dms': {username: list(queued) for username, queued in self.offline_dms.items()}
+            })
+        except Exception as e:
+            print(f"❌ Snapshot failed: {e}")
+    
+    def serve_handoff(self):
+        """Wait for a new server process to ask for our sockets
+        
+        Runs on its own thread, listening on HANDOFF_SOCKET_PATH. Only one
+        takeover is served; afterwards this process exits.
+        """
+        path = settings.HANDOFF_SOCKET_PATH
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            listener.bind(path)
+            os.chmod(path, 0o600)
+            listener.listen(1)
+        except OSError as e:
+            print(f"❌ Handoff socket unavailable: {e}")
+            listener.close()
+            return
+        
+        while not self.shutting_down:
+            conn, _ = listener.accept()
+            try:
+                conn.settimeout(settings.HANDOFF_TIMEOUT)
+                if conn.recv(len(handoff.TAKEOVER_REQUEST)) != handoff.TAKEOVER_REQUEST:
+                    conn.close()
+                    continue
+            except OSError:
+                conn.close()
+                continue
+            
+            # Free the path for the new process before it starts listening
+            listener.close()
+            try:
+                os.unlink(path)
+            except OSError:
+                pass
+            try:
+                self.hand_off(conn)
+            except Exception as e:
+                print(f"❌ Handoff failed, shutting down instead: {e}")
+            finally:
+                conn.close()
+                self.handoff_done.set()
+            return
+    
+    def hand_off(self, conn):
+        """Pass the listening socket and every live connection to a new process
+        
+        Reader threads are parked without closing their sockets, queued
+        frames are flushed and the history snapshotted, then the sockets
+        are sent over conn with SCM_RIGHTS together with each connection's
+        user, room and unread bytes. Clients see no disconnect.
+        """
+        print("🔀 Handing connections over to the new server...")
+        self.handing_off = True
+        self._wakeup_writer.send(b'\0')
+        with self.handler_cond:
+            if not self.handler_cond.wait_for(
+                    lambda: not self.listening and len(self.parked) >= self.connection_count,
+                    settings.HANDOFF_TIMEOUT):
+                raise TimeoutError("Connections did not stop in time")
+        
+        deadline = time.monotonic() + settings.SHUTDOWN_DRAIN_TIMEOUT
+        connections = []
+        fds = [self.server_socket.fileno()]
+        for client_socket, buffered in self.parked.items():
+            outbox = self.outboxes[client_socket]
+            drained = outbox.drain(max(0, deadline - time.monotonic()))
+            outbox.close()
+            if not drained or isinstance(client_socket, ssl.SSLSocket):
+                # Can't tell how much was written, or the TLS state lives in
+                # this process; let it reconnect and resume
+                self.evict(client_socket)
+                continue
+            
+            client = self.clients.get(client_socket)
+            upload = self.large_messages.get(client_socket)
+            connections.append({
+                'username': client['username'] if client else None,
+                'room': client['room'] if client else None,
+                'buffered': base64.b64encode(buffered).decode('ascii'),
+                'upload': upload and {
+                    'data': base64.b64encode(bytes(upload['data'])).decode('ascii'),
+                    'total_size': upload['total_size'],
+                    'received_size': upload['received_size'],
+                    'cid': upload['cid']
+                }
+            })
+            fds.append(client_socket.fileno())
+        
+        self.save_snapshot()
+        now = time.monotonic()
+        banned = [[username, host, until - now] for (username, host), until in self.banned.items() if until > now]
+        state = {'connections': connections, 'banned': banned, 'presence': self.presence.export_state()}
+        if not handoff.send_handoff(conn, state, fds):
+            raise ConnectionError("New server did not confirm the handoff")
+        self.handed_off = True
+        print(f"✅ Handed off {len(connections)} connections")
+    
+    def adopt(self, state, fds):
+        """Serve the listening socket and connections of the previous process"""
+        self.server_socket.close()
+        self.server_socket = socket.socket(fileno=fds[0])
+        self.listening = True
+        
+        now = time.monotonic()
+        for username, host, remaining in state.get('banned', []):
+            self.banned[(username, host)] = now + remaining
+            self.budget_timers.schedule(('ban', (username, host)), now + remaining)
+        if 'presence' in state:
+            self.presence.restore_state(state['presence'])
+        
+        for info, fd in zip(state['connections'], fds[1:]):
+            client_socket = socket.socket(fileno=fd)
+            if info['username'] is not None and info['room'] in self.rooms:
+                self.clients[client_socket] = {'username': info['username'], 'room': info['room']}
+                self.rooms[info['room']].append(client_socket)
+                self.sessions.setdefault(info['username'], set()).add(client_socket)
+                self.presence.join(info['room'], info['username'])
+            if info.get('upload'):
+                upload = info['upload']
+                self.large_messages[client_socket] = {
+                    'data': bytearray(base64.b64decode(upload['data'])),
+                    'total_size': upload['total_size'],
+                    'received_size': upload['received_size'],
+                    'cid': upload.get('cid')
+                }
+            with self.stats_lock:
+                self.connection_count += 1
+            
+            try:
+                address = client_socket.getpeername()
+            except OSError:
+                address = None
+            client_thread = threading.Thread(
+                target=self.handle_client,
+                args=(client_socket, address, base64.b64decode(info['buffered']))
+            )
+            client_thread.daemon = True
+            client_thread.start()
+        print(f"🔀 Took over {len(state['connections'])} connections")
+    
+    def start_primary_threads(self):
+        """Start what only a primary runs: retention and serving followers"""
+        if self.store.archive is not None:
+            retention_thread = threading.Thread(target=self.enforce_retention)
+            retention_thread.daemon = True
+            retention_thread.start()
+        
+        if settings.REPLICATION_SOCKET_PATH and hasattr(socket, 'AF_UNIX'):
+            self.replication = ReplicationPrimary(self)
+            replication_thread = threading.Thread(target=self.replication.serve,
+                                                  args=(settings.REPLICATION_SOCKET_PATH,))
+            replication_thread.daemon = True
+            replication_thread.start()
+    
     def start(self):
         """Start the server"""
+        if threading.current_thread() is threading.main_thread():
+            # Treat SIGTERM like Ctrl-C so service managers get a clean shutdown
+            signal.signal(signal.SIGTERM, _interrupt)
+        
         try:
-            self.server_socket.bind((self.host, self.port))
-            self.server_socket.listen(settings.MAX_CONNECTIONS)
+            if not self.listening:
+                self.server_socket.bind((self.host, self.port))
+                self.server_socket.listen(settings.LISTEN_BACKLOG)
+                self.listening = True
             print(f"🚀 Chat server started on {self.host}:{self.port}")
             print(f"📝 Available rooms: {list(self.rooms.keys())}")
             
+            reaper_thread = threading.Thread(target=self.reap_idle_connections)
+            reaper_thread.daemon = True
+            reaper_thread.start()
+            
+            presence_thread = threading.Thread(target=self.publish_presence)
+            presence_thread.daemon = True
+            presence_thread.start()
+            
+            typing_thread = threading.Thread(target=self.publish_typing)
+            typing_thread.daemon = True
+            typing_thread.start()
+            
+            if self.follower is not None:
+                self.follower.start()
+            else:
+                self.start_primary_threads()
+            
+            if settings.HANDOFF_SOCKET_PATH and handoff.supported():
+                handoff_thread = threading.Thread(target=self.serve_handoff)
+                handoff_thread.daemon = True
+                handoff_thread.start()
+            if settings.ADMIN_SOCKET_PATH and hasattr(socket, 'AF_UNIX'):
+                admin_thread = threading.Thread(target=self.admin.serve, args=(settings.ADMIN_SOCKET_PATH,))
+                admin_thread.daemon = True
+                admin_thread.start()
+            if self.handoff_conn is not None:
+                # Serving now, the old process can exit
+                handoff.confirm_handoff(self.handoff_conn)
+                self.handoff_conn = None
+            
+            selector = selectors.DefaultSelector()
+            selector.register(self.server_socket, selectors.EVENT_READ)
+            selector.register(self._wakeup_reader, selectors.EVENT_READ)
             while True:
+                selector.select()
+                if self.handing_off:
+                    # Leave the listening socket open for the new process
+                    with self.handler_cond:
+                        self.listening = False
+                        self.handler_cond.notify_all()
+                    self.handoff_done.wait()
+                    break
                 client_socket, address = self.server_socket.accept()
+                
+                # Enforce the connection cap before spending a thread on it
+                with self.stats_lock:
+                    admitted = self.connection_count < settings.MAX_CONNECTIONS
+                    if admitted:
+                        self.connection_count += 1
+                    else:
+                        self.stats['connections_rejected'] += 1
+                if not admitted:
+                    if self.tls is None:
+                        self.send_error(client_socket, 'server_full', "Server is full, try again later")
+                    client_socket.close()
+                    continue
+                
                 print(f"🔗 New connection from {address}")
+                # Outboxes already batch frames, don't let Nagle hold them back
+                client_socket.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
                 
                 client_thread = threading.Thread(
-                    target=self.handle_client,
+                    target=self.handle_client if self.tls is None else self.handle_tls_client,
                     args=(client_socket, address)
                 )
                 client_thread.daemon = True
@@ -357,9 +1302,11 @@ class ChatServer:
         except KeyboardInterrupt:
             print("\n🛑 Server shutting down...")
         except Exception as e:
-            print(f"❌ Server error: {e}")
+            if not self.shutting_down:
+                print(f"❌ Server error: {e}")
         finally:
-            self.server_socket.close()
+            if not self.handed_off:
+                self.shutdown()
 
 if __name__ == "__main__":
     server = ChatServer()
@@ -0,0 +1,44 @@
+import os
+import pickle
+
+MAGIC = b'CHATSNAP'
+VERSION = 1
+
+
+def _log_marker(log_path):
+    """Size and mtime of the JSON history the snapshot was taken with"""
+    try:
+        stat = os.stat(log_path)
+    except OSError:
+        return None
+    return stat.st_size, stat.st_mtime_ns
+
+
+def write_snapshot(path, log_path, state):
+    """Write server state as a binary snapshot next to the JSON history
+
+    The snapshot records which version of the history log it matches, so
+    it is ignored if the log was written again afterwards (e.g. by a
+    server that never shut down cleanly).
+    """
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, 'wb') as f:
+        f.write(MAGIC + bytes([VERSION]))
+        pickle.dump({'log': _log_marker(log_path), 'state': state}, f,
+                    protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_path, path)
+
+
+def load_snapshot(path, log_path):
+    """Return the saved state if the snapshot still matches the log, else None"""
+    try:
+        with open(path, 'rb') as f:
+            if f.read(len(MAGIC) + 1) != MAGIC + bytes([VERSION]):
+                return None
+            data = pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError, AttributeError, ValueError):
+        return None
+
+    if data.get('log') is None or data['log'] != _log_marker(log_path):
+        return None
+    return data['state']
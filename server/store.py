@@ -0,0 +1,369 @@
+import json
+import os
+import threading
+from bisect import bisect_left, bisect_right
+from collections import deque
+from datetime import datetime
+
+from server.record import MessageRecord, RawJSON
+
+DM_PREFIX = 'dm:'
+
+
+def conversation_key(user_a, user_b):
+    """History partition holding the direct messages between two users"""
+    # JSON-encoded so no username can make two conversations collide
+    return DM_PREFIX + json.dumps(sorted([user_a, user_b]), ensure_ascii=False)
+
+
+class ChatStore:
+    """Per-room message history with sequence IDs.
+
+    Every stored message gets an 'id' that increases by one per room and a
+    'ts' in epoch milliseconds that never goes backwards within a room, so
+    both can be binary searched. The history is persisted as JSON in the
+    same {room: [messages]} layout as before; messages from older logs
+    without an ID are numbered on load. In memory each message is a
+    MessageRecord rather than a dict. The newest json_window messages of
+    each room are kept encoded as well, so broadcasts and history replies
+    reuse the JSON written when the message was stored. Direct message conversations are
+    partitions of their own, created on first use (see conversation_key).
+
+    With an Archive, trim() moves the oldest messages of a partition into
+    it, and lookups by ID, time window or paging fall through to it, so
+    the in-memory (hot) history stays small without deleting anything.
+
+    A replication follower keeps its copy in step with reset(), insert()
+    and archive_through(); on_append and on_archive report the changes a
+    primary has to stream.
+    """
+
+    def __init__(self, path, rooms, load=True, archive=None, json_window=50):
+        self.path = path
+        self.archive = archive
+        # {room: deque of (id, JSON or None for large messages)}, in ID order.
+        # Only for the fixed rooms; DM conversations are too many to keep.
+        self.recent_json = {room: deque(maxlen=json_window) for room in rooms}
+        self.lock = threading.RLock()
+        self.history = {room: [] for room in rooms}
+        self.next_ids = {room: 0 for room in rooms}
+        self.sizes = {room: 0 for room in rooms}  # Approximate bytes held per partition
+        self.unsaved = 0
+        self.on_append = []  # [callback(room, message)], run under the lock in ID order
+        self.on_archive = []  # [callback(room, last_id)], run under the lock once archived
+        self._save_lock = threading.Lock()
+        if load:
+            self.load()
+
+    def load(self):
+        data = {}
+        if os.path.exists(self.path):
+            try:
+                with open(self.path, 'r') as f:
+                    data = json.load(f)
+            except Exception:
+                pass
+
+        for room, messages in data.items():
+            next_id = 0
+            last_ts = 0
+            for message in messages:
+                # Number legacy messages and keep IDs/timestamps monotonic
+                if not isinstance(message.get('id'), int) or message['id'] < next_id:
+                    message['id'] = next_id
+                if not isinstance(message.get('ts'), int) or message['ts'] < last_ts:
+                    message['ts'] = last_ts
+                next_id = message['id'] + 1
+                last_ts = message['ts']
+            self.history[room] = [MessageRecord.from_dict(message) for message in messages]
+            self.next_ids[room] = next_id
+            self.sizes[room] = sum(message.size() for message in self.history[room])
+
+        # A partition may be entirely archived; IDs carry on from there
+        if self.archive is not None:
+            for room in self.archive.segments:
+                self.open_partition(room)
+                self.next_ids[room] = max(self.next_ids[room], self.archive.next_id(room))
+
+    def export_state(self):
+        """Picklable copy of the store, for snapshots"""
+        with self.lock:
+            return {
+                'history': {room: list(messages) for room, messages in self.history.items()},
+                'next_ids': dict(self.next_ids)
+            }
+
+    def restore_state(self, state):
+        with self.lock:
+            for room, messages in state['history'].items():
+                # Snapshots from before MessageRecord hold dicts
+                self.history[room] = [message if isinstance(message, MessageRecord)
+                                      else MessageRecord.from_dict(message) for message in messages]
+                self.sizes[room] = sum(message.size() for message in self.history[room])
+            self.next_ids.update(state['next_ids'])
+
+    def reset(self, first_ids):
+        """Drop all history; each partition starts again at the given ID
+
+        For a follower about to copy a primary's store.
+        """
+        with self.lock:
+            rooms = list(self.recent_json)
+            self.history = {room: [] for room in rooms}
+            self.next_ids = {room: 0 for room in rooms}
+            self.sizes = {room: 0 for room in rooms}
+            for encoded in self.recent_json.values():
+                encoded.clear()
+            for room, first_id in first_ids.items():
+                self.open_partition(room)
+                self.next_ids[room] = first_id
+            self.unsaved += 1
+
+    def open_partition(self, room):
+        """Make sure a partition exists, e.g. for a new conversation"""
+        with self.lock:
+            self.history.setdefault(room, [])
+            self.next_ids.setdefault(room, 0)
+            self.sizes.setdefault(room, 0)
+
+    def save(self):
+        """Write the history to disk atomically"""
+        with self.lock:
+            snapshot = {room: list(messages) for room, messages in self.history.items()}
+            self.unsaved = 0
+
+        with self._save_lock:
+            tmp_path = f"{self.path}.tmp"
+            with open(tmp_path, 'w') as f:
+                # Same JSON as json.dump of the dicts, one message per line
+                f.write('{')
+                for i, (room, messages) in enumerate(snapshot.items()):
+                    f.write(f'{"," if i else ""}\n  {json.dumps(room)}: [')
+                    f.write(','.join('\n    ' + message.to_json() for message in messages))
+                    f.write('\n  ]' if messages else ']')
+                f.write('\n}\n')
+            os.replace(tmp_path, self.path)
+
+    def append(self, room, message):
+        """Assign an ID and server timestamp to a message dict and store it
+
+        Returns the stored MessageRecord, whose 'timestamp' is derived
+        from 'ts'.
+        """
+        ts = int(datetime.now().timestamp() * 1000)
+        with self.lock:
+            messages = self.history[room]
+            if messages and messages[-1].ts > ts:
+                ts = messages[-1].ts  # Clock stepped back, keep order
+            message['id'] = self.next_ids[room]
+            message['ts'] = ts
+            message = MessageRecord.from_dict(message)
+            self._add(room, message)
+        return message
+
+    def insert(self, room, message):
+        """Store a message dict that already has its 'id' and 'ts'
+
+        How a follower applies messages stored by its primary. They must
+        come in ID order; one already stored is skipped and None returned,
+        a gap raises ValueError.
+        """
+        with self.lock:
+            self.open_partition(room)
+            next_id = self.next_ids[room]
+            if message['id'] < next_id:
+                return None
+            if message['id'] > next_id:
+                raise ValueError(f"Message {message['id']} of {room} is out of order, expected {next_id}")
+            message = MessageRecord.from_dict(message)
+            self._add(room, message)
+        return message
+
+    def _add(self, room, message):
+        # Under the lock
+        self.history[room].append(message)
+        encoded = self.recent_json.get(room)
+        if encoded is not None:
+            if encoded and encoded[-1][0] != message.id - 1:
+                encoded.clear()  # Keep the window contiguous
+            # Not worth a second copy of a file
+            encoded.append((message.id, message.to_json() if message.file_data is None else None))
+        self.next_ids[room] = message.id + 1
+        self.sizes[room] += message.size()
+        self.unsaved += 1
+        self._notify(self.on_append, room, message)
+
+    def _notify(self, callbacks, room, change):
+        # Each one on its own: a failing consumer (say, the search index)
+        # must not keep the replication journal from seeing the change
+        for callback in callbacks:
+            try:
+                callback(room, change)
+            except Exception as e:
+                print(f"❌ Store callback {getattr(callback, '__qualname__', callback)} failed for {room}: {e}")
+
+    def message_json(self, room, message):
+        """The JSON of a stored message, encoded once while it is recent"""
+        with self.lock:
+            encoded = self.recent_json.get(room)
+            if encoded and encoded[0][0] <= message.id <= encoded[-1][0]:
+                cached = encoded[message.id - encoded[0][0]][1]
+                if cached is not None:
+                    return cached
+        return message.to_json()
+
+    def encode(self, room, messages):
+        """A JSON array of stored messages of a room, for a frame"""
+        with self.lock:
+            encoded = self.recent_json.get(room)
+            first_id = encoded[0][0] if encoded else None
+            parts = [(first_id is not None and first_id <= message.id <= encoded[-1][0] and
+                      encoded[message.id - first_id][1]) or message.to_json() for message in messages]
+        return RawJSON('[' + ', '.join(parts) + ']')
+
+    def _position(self, messages, message_id):
+        return bisect_left(messages, message_id, key=lambda m: m.id)
+
+    def get(self, room, message_id):
+        """Look up a single message by ID, or None"""
+        with self.lock:
+            messages = self.history[room]
+            i = self._position(messages, message_id)
+            if i < len(messages) and messages[i].id == message_id:
+                return messages[i]
+            archived = self.archive is not None and (not messages or message_id < messages[0].id)
+        if archived:
+            return self.archive.get(room, message_id)
+        return None
+
+    def before(self, room, before_id, limit):
+        """Up to limit messages older than before_id, oldest first
+
+        For paging back through history; reads the archive once the hot
+        history runs out.
+        """
+        with self.lock:
+            messages = self.history[room]
+            end = self._position(messages, before_id)
+            result = messages[max(0, end - limit):end]
+            oldest = result[0].id if result else before_id
+        if len(result) < limit and self.archive is not None:
+            result = self.archive.before(room, oldest, limit - len(result)) + result
+        return result
+
+    def recent(self, room, limit):
+        with self.lock:
+            return self.history[room][-limit:]
+
+    def since(self, room, last_id, limit):
+        """Return (messages, resumed) for a client that has seen up to last_id
+
+        When every message after last_id fits in limit they are returned
+        with resumed=True. Otherwise, or when last_id is unknown to this
+        server, the newest limit messages are returned with resumed=False.
+        """
+        with self.lock:
+            messages = self.history[room]
+            next_id = self.next_ids[room]
+            if isinstance(last_id, int) and last_id < next_id:
+                start = self._position(messages, last_id + 1)
+                # Nothing may be missing between last_id and what we send,
+                # e.g. because it has been archived
+                first_id = messages[0].id if messages else next_id
+                if first_id <= last_id + 1 and len(messages) - start <= limit:
+                    return messages[start:], True
+            return messages[-limit:], False
+
+    def after(self, room, last_id):
+        """Return every message with an ID greater than last_id"""
+        with self.lock:
+            messages = self.history[room]
+            return messages[self._position(messages, last_id + 1):]
+
+    def id_range(self, room, start_ts=None, end_ts=None):
+        """Return the (first_id, last_id) sent within a time window, or None"""
+        with self.lock:
+            messages = self.between(room, start_ts, end_ts)
+            hot = messages and (messages[0].id, messages[-1].id)
+            # Archived messages are all older, so only the start can be there
+            check_archive = self.archive is not None and (
+                not self.history[room] or start_ts is None or start_ts < self.history[room][0].ts)
+        archived = check_archive and self.archive.id_range(room, start_ts, end_ts)
+        if archived and hot:
+            return archived[0], hot[1]
+        return archived or hot or None
+
+    def between(self, room, start_ts=None, end_ts=None):
+        """Return the messages with start_ts <= ts <= end_ts (epoch ms)"""
+        with self.lock:
+            messages = self.history[room]
+            lo = 0 if start_ts is None else bisect_left(messages, start_ts, key=lambda m: m.ts)
+            hi = len(messages) if end_ts is None else bisect_right(messages, end_ts, key=lambda m: m.ts)
+            return messages[lo:hi]
+
+    def trim(self, room, max_age=None, max_messages=None, max_bytes=None, min_batch=1):
+        """Archive the oldest messages of a partition that are over a limit
+
+        max_age is in seconds. Age and count limits only act once at least
+        min_batch messages are due, so segments aren't written one message
+        at a time; the byte limit always acts. Returns how many messages
+        were archived. Without an archive nothing is trimmed.
+        """
+        if self.archive is None:
+            return 0
+        with self.lock:
+            messages = self.history[room]
+            due = 0
+            if max_age is not None:
+                cutoff = int((datetime.now().timestamp() - max_age) * 1000)
+                due = bisect_left(messages, cutoff, key=lambda m: m.ts)
+            if max_messages is not None:
+                due = max(due, len(messages) - max_messages)
+            if due < min_batch:
+                due = 0
+            if max_bytes is not None:
+                size = self.sizes[room]
+                over = 0
+                while over < len(messages) and size > max_bytes:
+                    size -= messages[over].size()
+                    over += 1
+                due = max(due, over)
+            if not due:
+                return 0
+            aged = messages[:due]
+
+        # After a crash between writing a segment and saving the log, the
+        # oldest hot messages may already be archived; don't write them twice
+        archived_to = self.archive.next_id(room)
+        self._archive(room, aged, [message for message in aged if message.id >= archived_to])
+        return due
+
+    def archive_through(self, room, last_id):
+        """Archive the hot messages of a partition up to last_id
+
+        How a follower repeats its primary's trim(). Messages the archive
+        already holds, e.g. from segments copied over, only leave memory.
+        Returns how many messages left the hot history.
+        """
+        if self.archive is None:
+            return 0
+        with self.lock:
+            messages = self.history.get(room, [])
+            aged = messages[:bisect_right(messages, last_id, key=lambda m: m.id)]
+        archived_to = self.archive.next_id(room)
+        self._archive(room, aged, [message for message in aged if message.id >= archived_to])
+        return len(aged)
+
+    def _archive(self, room, aged, unarchived):
+        """Move the oldest hot messages of a partition, aged, to the archive"""
+        if not aged:
+            return
+        # Written before they leave the hot history, so a reader always finds
+        # them in one or the other. Appends only ever go on the end.
+        self.archive.write(room, unarchived)
+        with self.lock:
+            del self.history[room][:len(aged)]
+            self.sizes[room] -= sum(message.size() for message in aged)
+            self.unsaved += 1
+            self._notify(self.on_archive, room, aged[-1].id)
+
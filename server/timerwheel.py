@@ -0,0 +1,64 @@
+import threading
+
+
+class TimerWheel:
+    """Hashed timing wheel for connection timeouts.
+
+    Keys are dropped into the slot of their deadline. Each advance() only
+    looks at the slots whose time has come, so a tick costs O(expired)
+    regardless of how many keys are scheduled. Keys whose deadline is more
+    than one turn of the wheel away simply stay in their slot until the
+    right turn comes around.
+    """
+
+    def __init__(self, slots, tick, now):
+        self.tick = tick
+        self.slots = [set() for _ in range(slots)]
+        self.deadlines = {}  # {key: deadline}
+        self.lock = threading.Lock()
+        self._next_tick = int(now / tick)
+
+    def schedule(self, key, deadline):
+        """Set (or move) the deadline for key"""
+        with self.lock:
+            self.deadlines[key] = deadline
+            self.slots[self._slot_index(deadline)].add(key)
+
+    def cancel(self, key):
+        with self.lock:
+            # The slot entry is skipped lazily once its deadline is gone
+            self.deadlines.pop(key, None)
+
+    def _slot_index(self, deadline):
+        # Deadlines in ticks already processed go in the next one to run
+        return max(int(deadline / self.tick), self._next_tick) % len(self.slots)
+
+    def advance(self, now):
+        """Return the keys whose deadline has passed, removing them
+
+        Only whole ticks that are over are processed, so a key expires at
+        most one tick late and never a full turn late.
+        """
+        expired = []
+        with self.lock:
+            end_tick = int(now / self.tick)
+            start_tick = max(self._next_tick, end_tick - len(self.slots))
+            for tick in range(start_tick, end_tick):
+                index = tick % len(self.slots)
+                slot = self.slots[index]
+                for key in list(slot):
+                    deadline = self.deadlines.get(key)
+                    if deadline is None:
+                        slot.discard(key)
+                    elif deadline <= now:
+                        slot.discard(key)
+                        del self.deadlines[key]
+                        expired.append(key)
+                    elif self._slot_index(deadline) != index:
+                        # Rescheduled into another slot since it was added here
+                        slot.discard(key)
+            self._next_tick = max(self._next_tick, end_tick)
+        return expired
+
+    def __len__(self):
+        return len(self.deadlines)
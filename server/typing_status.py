@@ -0,0 +1,54 @@
+import threading
+
+
+class TypingTracker:
+    """Who is typing in each room, published as one aggregate per interval.
+
+    Clients send a 'typing' frame when they start (repeated every
+    TYPING_SEND_INTERVAL while they keep typing) and when they stop. The
+    server only records a deadline per typist; flush() reports each room
+    whose set of typists changed since the last call as a single frame, so
+    a room with hundreds of typists still gets at most one update per
+    interval. Typists that go quiet expire after TYPING_TIMEOUT.
+    """
+
+    def __init__(self, rooms, timeout, max_names):
+        self.timeout = timeout
+        self.max_names = max_names
+        self.lock = threading.Lock()
+        self.typing = {room: {} for room in rooms}  # {room: {username: expires at}}
+        self.dirty = set()
+
+    def start(self, room, username, now):
+        with self.lock:
+            typists = self.typing[room]
+            if username not in typists:
+                self.dirty.add(room)
+            typists[username] = now + self.timeout
+
+    def stop(self, room, username):
+        with self.lock:
+            if self.typing[room].pop(username, None) is not None:
+                self.dirty.add(room)
+
+    def flush(self, now):
+        """Expire stale typists and return an update for each changed room"""
+        updates = []
+        with self.lock:
+            for room, typists in self.typing.items():
+                expired = [username for username, expires in typists.items() if expires <= now]
+                for username in expired:
+                    del typists[username]
+                if expired:
+                    self.dirty.add(room)
+
+            for room in self.dirty:
+                typists = self.typing[room]
+                updates.append({
+                    'type': 'typing',
+                    'room': room,
+                    'users': sorted(typists)[:self.max_names],
+                    'count': len(typists)
+                })
+            self.dirty.clear()
+        return updates
@@ -1,8 +1,115 @@
-import tkinter
-
-window = tkinter.Tk()
-window.title("Chat")
-label = tkinter.Label(window,text="hello").pack()
-window.geometry('350*200')
-window.grid(column=0,row=0)
-window.mainloop()
\ No newline at end of file
+import codecs
+import json
+import re
+
+_WHITESPACE = re.compile(r'\s*')
+_STRUCTURE = re.compile(r'["{}]')  # What matters outside strings
+_STRING_END = re.compile(r'["\\]')  # ...and inside them
+
+
+class MessageDecoder:
+    """Incrementally decode a stream of JSON messages.
+
+    Messages are written back to back with no delimiter, so one recv() may
+    hold several messages (e.g. quick successive chats) or only part of one
+    (e.g. a large_message_chunk or a history payload with file data).
+
+    Partial data is kept as the chunks it arrived in, and scanned once:
+    only quotes, backslashes and braces are looked at, so the decoder knows
+    where a message ends without re-parsing it on every recv. A message is
+    joined and parsed once its closing brace arrives. Used by both the
+    server and the client.
+    """
+
+    def __init__(self, encoding, max_buffer=64 * 1024 * 1024):
+        self.encoding = encoding
+        self._decoder = codecs.getincrementaldecoder(encoding)()
+        self._json = json.JSONDecoder()
+        self._parts = []  # Text of the message in progress
+        self._pending = 0
+        self.max_buffer = max_buffer
+        # Scan state within the message in progress
+        self._depth = 0
+        self._in_string = False
+        self._escaped = False
+
+    def feed(self, data):
+        """Add raw bytes and return the list of complete messages"""
+        text = self._decoder.decode(data)
+        messages = []
+        pos = 0
+        end_of_text = len(text)
+
+        while pos < end_of_text:
+            if not self._parts:
+                pos = _WHITESPACE.match(text, pos).end()
+                if pos == end_of_text:
+                    break
+                if text[pos] != '{':
+                    raise ValueError(f"Unexpected data in message stream at offset {pos}")
+            end = self._scan(text, pos)
+            if end is None:
+                # Incomplete message, wait for more data
+                self._parts.append(text[pos:])
+                self._pending += end_of_text - pos
+                if self._pending > self.max_buffer:
+                    raise ValueError("Incoming message exceeds maximum size")
+                break
+            self._parts.append(text[pos:end])
+            message = ''.join(self._parts)
+            self._parts = []
+            self._pending = 0
+            messages.append(self._json.decode(message))
+            pos = end
+        return messages
+
+    def _scan(self, text, pos):
+        """Follow the message in progress through text from pos
+
+        Returns the index just past its closing brace, or None if it
+        doesn't end in text.
+        """
+        depth, in_string = self._depth, self._in_string
+        if self._escaped:
+            # A backslash ended the last chunk, skip what it escapes
+            self._escaped = False
+            pos += 1
+        end_of_text = len(text)
+        while pos < end_of_text:
+            if in_string:
+                match = _STRING_END.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                if match.group() == '"':
+                    in_string = False
+                elif pos == end_of_text:
+                    self._escaped = True
+                else:
+                    pos += 1
+            else:
+                match = _STRUCTURE.search(text, pos)
+                if match is None:
+                    break
+                pos = match.end()
+                char = match.group()
+                if char == '"':
+                    in_string = True
+                elif char == '{':
+                    depth += 1
+                else:
+                    depth -= 1
+                    if depth == 0:
+                        self._depth, self._in_string = 0, False
+                        return pos
+        self._depth, self._in_string = depth, in_string
+        return None
+
+    @property
+    def pending(self):
+        """Characters buffered for an incomplete message"""
+        return self._pending
+
+    def remaining(self):
+        """Raw bytes received but not yet returned as messages"""
+        return ''.join(self._parts).encode(self.encoding) + self._decoder.getstate()[0]
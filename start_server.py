@@ -2,6 +2,13 @@
 """
 Server launcher script for the chat application.
 Run this to start the chat server.
+
+Pass --takeover to start a new server that takes the listening socket and
+connected clients over from the one already running (zero-downtime deploy).
+
+Pass --follow [DATA_DIR] [--port PORT] to start a read-only hot standby
+that replicates the running server's history into DATA_DIR and serves
+it on PORT (REPLICA_DATA_DIR and REPLICA_PORT by default).
 """
 
 import sys
@@ -15,7 +22,16 @@ try:
     print("🚀 Starting Chat Server...")
     print("=" * 50)
     
-    server = ChatServer()
+    if '--takeover' in sys.argv:
+        # Replace the running server without disconnecting its clients
+        server = ChatServer.take_over()
+    elif '--follow' in sys.argv:
+        args = sys.argv[sys.argv.index('--follow') + 1:]
+        data_dir = args[0] if args and not args[0].startswith('--') else None
+        port = int(args[args.index('--port') + 1]) if '--port' in args else None
+        server = ChatServer.follow(data_dir, port)
+    else:
+        server = ChatServer()
     server.start()
     
 except KeyboardInterrupt:
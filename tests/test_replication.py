@@ -0,0 +1,114 @@
+import os
+import tempfile
+import threading
+import time
+import unittest
+
+from config import settings
+from server.replication import ReplicationFollower, ReplicationPrimary
+from server.search import SearchIndex
+from server.store import ChatStore
+
+ROOMS = ('general',)
+
+
+class StubServer:
+    """The parts of ChatServer that replication uses"""
+
+    def __init__(self, data_dir):
+        self.store = ChatStore(os.path.join(data_dir, 'chat_logs.json'), ROOMS, load=False)
+        self.search_index = SearchIndex(os.path.join(data_dir, 'search_index'), load=False)
+        self.store.on_append.append(self.search_index.add)
+        self.shutting_down = False
+        self.port = 0
+        self.delivered = []
+
+    def deliver(self, room, message):
+        self.delivered.append((room, message['id']))
+
+    def save_chat_history(self):
+        pass
+
+
+def wait_for(predicate, timeout=5.0):
+    deadline = time.monotonic() + timeout
+    while not predicate():
+        if time.monotonic() > deadline:
+            return False
+        time.sleep(0.01)
+    return True
+
+
+class ReplicationTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = {name: getattr(settings, name) for name in ('REPLICATION_HEARTBEAT', 'REPLICATION_RETRY')}
+        settings.REPLICATION_HEARTBEAT = 0.05
+        settings.REPLICATION_RETRY = 0.05
+        self.data_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.data_dir, 'replication.sock')
+        self.primary_server = StubServer(os.path.join(self.data_dir, 'primary'))
+        self.primary = ReplicationPrimary(self.primary_server)
+        threading.Thread(target=self.primary.serve, args=(self.path,), daemon=True).start()
+        self.assertTrue(wait_for(lambda: os.path.exists(self.path)))
+        self.follower_server = StubServer(os.path.join(self.data_dir, 'follower'))
+        self.follower = ReplicationFollower(self.follower_server, self.path)
+
+    def tearDown(self):
+        self.follower.stop()
+        self.primary_server.shutting_down = True
+        for name, value in self.saved.items():
+            setattr(settings, name, value)
+
+    def follower_has(self, count):
+        return lambda: len(self.follower_server.store.history['general']) == count
+
+    def test_malformed_message_is_journaled_and_replicated(self):
+        self.follower.start()
+        self.assertTrue(wait_for(lambda: self.follower.epoch is not None))
+        self.primary_server.store.append('general', {'username': 'mallory', 'content': 5})
+        self.primary_server.store.append('general', {'username': 'alice', 'content': 'hello world'})
+
+        self.assertEqual(self.primary.journal.lsn, 2)
+        self.assertTrue(wait_for(self.follower_has(2)))
+        self.assertEqual(self.follower.applied_lsn, 2)
+        self.assertEqual(self.follower.epoch, self.primary.journal.epoch)  # No re-copy
+        self.assertEqual(self.follower_server.search_index.search('hello'), [('general', 1)])
+        self.assertTrue(self.follower.thread.is_alive())
+
+    def test_failing_callback_does_not_block_journal(self):
+        def broken(room, message):
+            raise AttributeError("indexer bug")
+        self.primary_server.store.on_append.insert(0, broken)
+        self.follower_server.store.on_append.insert(0, broken)
+        self.follower.start()
+        self.primary_server.store.append('general', {'username': 'alice', 'content': 'first'})
+        self.assertTrue(wait_for(self.follower_has(1)))
+        self.primary_server.store.append('general', {'username': 'alice', 'content': 'second'})
+
+        self.assertEqual(self.primary.journal.lsn, 2)
+        self.assertTrue(wait_for(self.follower_has(2)))
+        self.assertEqual(self.follower_server.delivered, [('general', 1)])
+        self.assertTrue(self.follower.thread.is_alive())
+
+    def test_follower_retries_after_unexpected_error(self):
+        calls = []
+        replicate = self.follower.replicate
+
+        def flaky():
+            calls.append(None)
+            if len(calls) == 1:
+                raise RuntimeError("apply failed")
+            replicate()
+        self.follower.replicate = flaky
+        self.follower.epoch = 'stale'
+        self.follower.start()
+
+        self.assertTrue(wait_for(lambda: self.follower.epoch == self.primary.journal.epoch))
+        self.assertEqual(len(calls), 2)
+        self.primary_server.store.append('general', {'username': 'alice', 'content': 'after'})
+        self.assertTrue(wait_for(self.follower_has(1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import json
+import os
+import tempfile
+import time
+import unittest
+
+from config import settings
+from server.server import ChatServer
+
+PATHS = ('CHAT_LOG_PATH', 'SEARCH_INDEX_DIR', 'SNAPSHOT_PATH', 'ARCHIVE_DIR')
+
+
+class SearchRequestTest(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = {name: getattr(settings, name) for name in PATHS}
+        data_dir = tempfile.mkdtemp()
+        settings.CHAT_LOG_PATH = os.path.join(data_dir, 'chat_logs.json')
+        settings.SEARCH_INDEX_DIR = os.path.join(data_dir, 'search_index')
+        settings.SNAPSHOT_PATH = os.path.join(data_dir, 'chat_snapshot.bin')
+        settings.ARCHIVE_DIR = None
+        self.server = ChatServer()
+        self.sent = []
+        self.server.send_to = lambda client_socket, message: self.sent.append(json.loads(message))
+        self.client = object()
+        self.server.store.append('general', {'username': 'alice', 'content': 'hello world'})
+
+    def tearDown(self):
+        self.server.server_socket.close()
+        for name, value in self.saved.items():
+            setattr(settings, name, value)
+
+    def search(self, **fields):
+        self.sent.clear()
+        self.server.dispatch_message(self.client, {'type': 'search', **fields})
+        self.assertEqual(len(self.sent), 1)
+        return self.sent[0]
+
+    def assertRefused(self, **fields):
+        reply = self.search(**fields)
+        self.assertEqual((reply['type'], reply['code']), ('error', 'bad_request'))
+
+    def test_valid_search(self):
+        now = int(time.time() * 1000)
+        reply = self.search(query='hello', username='alice', room='general', since=0, until=now + 1000.5)
+        self.assertEqual(reply['type'], 'search_results')
+        self.assertEqual([result['content'] for result in reply['results']], ['hello world'])
+
+    def test_since_must_be_a_number(self):
+        self.assertRefused(query='hello', since='yesterday')
+        self.assertRefused(query='hello', since=True)
+
+    def test_until_must_be_a_number(self):
+        self.assertRefused(query='hello', until=[1])
+
+    def test_query_must_be_text(self):
+        self.assertRefused(query=5)
+
+    def test_username_must_be_text(self):
+        self.assertRefused(query='hello', username=['alice'])
+
+    def test_room_must_be_text(self):
+        self.assertRefused(query='hello', room=5)
+        self.assertRefused(query='hello', room=[{'name': 'general'}])
+
+
+if __name__ == '__main__':
+    unittest.main()